@@ -0,0 +1,321 @@
+"""
+Benchmarks of the compiler and the Quad execution backends.
+Run with the name of a benchmark, e.g. `python bench.py exec`.
+"""
+
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from typing import Callable, List, Tuple
+
+from cpl_compiler import Compiler
+from cpl_lexer import CplLexer
+from cpl_parser import CplParser
+from cpl_translator import CplTranslator
+from quad_binary import read_binary, write_binary
+from quad_cfg import ControlFlowGraph
+from quad_code import QuadCode
+from quad_dataflow import ReachingDefinitions
+from quad_exec import QuadInterpreter, compile_quad, sequence_input
+from quad_fusion import fuse_superinstructions
+from quad_optimize import optimize
+from quad_profile import QuadProfiler
+from quad_sccp import propagate_constants
+from quad_ssa import SSAForm
+
+LOOPS_SOURCE = """
+i, j, n, s: int;
+x: float;
+{
+    input(n);
+    i = 0;
+    s = 0;
+    while (i < n) {
+        j = 0;
+        while (j < 10) {
+            s = s + (i * j) / 3 - j;
+            x = x + s / 7.0;
+            j = j + 1;
+        }
+        if (s > 1000) { s = s - 1000; } else { s = s + 1; }
+        i = i + 1;
+    }
+    output(s);
+    output(x);
+}
+"""
+""" A CPU-bound CPL program, running n * 10 iterations of an inner loop. """
+
+def compile_cpl(source: str) -> QuadCode:
+    """ Compiles CPL source into resolved Quad code. """
+    prog = CplParser().parse(CplLexer().tokenize(source))
+    assert prog is not None and prog.visit() and prog.code is not None, "Benchmark program failed to compile!"
+    prog.code.apply_labels()
+    return prog.code
+
+def best_of(repeat: int, func: Callable[[], None]) -> float:
+    """ Returns the best wall-clock time of running func repeat times. """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def bench_exec(n: int, repeat: int) -> None:
+    """ Compares the Quad interpreter with the compiled python backend. """
+    code = compile_cpl(LOOPS_SOURCE)
+    outputs: List[List] = [[], []]
+
+    def interpret() -> None:
+        outputs[0] = []
+        QuadInterpreter(code, lambda dtype: n, outputs[0].append).run()
+
+    start = time.perf_counter()
+    program = compile_quad(code)
+    compile_time = time.perf_counter() - start
+
+    def run_compiled() -> None:
+        outputs[1] = []
+        program.run(lambda dtype: n, outputs[1].append)
+
+    interpreted = best_of(repeat, interpret)
+    compiled = best_of(repeat, run_compiled)
+    assert outputs[0] == outputs[1], f"Backends disagree: {outputs[0]} != {outputs[1]}"
+    print(f"{len(code.code)} quads, n={n}, output={outputs[1]}")
+    print(f"interpreter: {interpreted * 1000:.1f}ms")
+    print(f"compiled:    {compiled * 1000:.1f}ms (+{compile_time * 1000:.1f}ms compilation), "
+          f"speedup x{interpreted / compiled:.1f}")
+
+def bench_batch(n: int, repeat: int) -> None:
+    """ Compares a single vectorized batch run with separate compiled runs, over n input sets. """
+    from quad_batch import BatchQuadExecutor
+
+    code = compile_cpl(LOOPS_SOURCE)
+    inputs = [[i % 50] for i in range(n)]
+    scalar_outputs: List[List] = []
+
+    def run_scalar() -> None:
+        scalar_outputs.clear()
+        program = compile_quad(code)
+        for values in inputs:
+            scalar_outputs.append([])
+            program.run(sequence_input(values), scalar_outputs[-1].append)
+
+    executor = BatchQuadExecutor(code)
+    results = []
+
+    def run_vectorized() -> None:
+        results[:] = [executor.run(inputs)]
+
+    scalar = best_of(repeat, run_scalar)
+    vectorized = best_of(repeat, run_vectorized)
+    assert results[0].outputs == scalar_outputs, "Batch execution differs from scalar execution!"
+    print(f"{n} lanes, {len(code.code)} quads")
+    print(f"compiled, lane by lane: {scalar * 1000:.1f}ms")
+    print(f"batch:                  {vectorized * 1000:.1f}ms, speedup x{scalar / vectorized:.1f}")
+
+def large_source(n: int) -> str:
+    """ Returns a CPL program made of n copies of the loops program's body (compiling to about 30n quads). """
+    body = LOOPS_SOURCE[LOOPS_SOURCE.index('{') + 1:LOOPS_SOURCE.rindex('}')]
+    declarations = LOOPS_SOURCE[:LOOPS_SOURCE.index('{')]
+    return declarations + "{" + body * n + "}"
+
+def bench_load(n: int, repeat: int) -> None:
+    """ Compares loading a large program from the text and the binary Quad formats. """
+    code = compile_cpl(large_source(n))
+    with tempfile.TemporaryDirectory() as temp_dir:
+        text_path = os.path.join(temp_dir, "large.quad")
+        binary_path = os.path.join(temp_dir, "large.qbin")
+        code.write(text_path)
+        write_binary(code, binary_path)
+        loaded: List[QuadCode] = []
+        text = best_of(repeat, lambda: loaded.append(QuadCode.read(text_path)))
+        binary = best_of(repeat, lambda: loaded.append(read_binary(binary_path)))
+        text_size, binary_size = os.path.getsize(text_path), os.path.getsize(binary_path)
+    assert all(c.code == code.code for c in loaded), "Loaded code differs from the written code!"
+    print(f"{len(code.code)} quads")
+    print(f"text:   {text * 1000:.1f}ms, {text_size} bytes")
+    print(f"binary: {binary * 1000:.1f}ms, {binary_size} bytes (with source lines), "
+          f"speedup x{text / binary:.1f}, size x{binary_size / text_size:.2f}")
+
+def bench_fuse(n: int, repeat: int) -> None:
+    """ Compares running the standard code with running it fused into superinstructions, on both backends. """
+    code = compile_cpl(LOOPS_SOURCE)
+    fused = fuse_superinstructions(compile_cpl(LOOPS_SOURCE))
+    print(f"n={n}, {len(code.code)} quads, {len(fused.code)} after fusion")
+    programs = {c: compile_quad(c) for c in (code, fused)}
+    for name, run in (("interpreter", lambda c, out: QuadInterpreter(c, lambda dtype: n, out.append).run()),
+                      ("compiled", lambda c, out: programs[c].run(lambda dtype: n, out.append))):
+        outputs: List[List] = [[], []]
+        standard = best_of(repeat, lambda: run(code, outputs[0]))
+        superinstructions = best_of(repeat, lambda: run(fused, outputs[1]))
+        assert outputs[0] == outputs[1], f"Fused code differs: {outputs[0]} != {outputs[1]}"
+        print(f"{name + ':':12} standard {standard * 1000:.1f}ms, fused {superinstructions * 1000:.1f}ms, "
+              f"speedup x{standard / superinstructions:.2f}")
+
+def bench_dataflow(n: int, repeat: int) -> None:
+    """ Compares the code before and after copy propagation and dead store elimination. """
+    code = compile_cpl(LOOPS_SOURCE)
+    optimized = optimize(compile_cpl(LOOPS_SOURCE), ['copies', 'deadstores'])
+    print(f"n={n}")
+    results = []
+    for name, c in (("before", code), ("after", optimized)):
+        profiler = QuadProfiler(c)
+        outputs: List = []
+        profiler.run(lambda dtype: n, outputs.append)
+        program = compile_quad(c)
+        elapsed = best_of(repeat, lambda: program.run(lambda dtype: n, lambda value: None))
+        executed = sum(profiler.profile().instructions)
+        results.append((outputs, elapsed))
+        print(f"{name + ':':7} {len(c.code):4} quads, {executed:9} executed, compiled run {elapsed * 1000:.1f}ms")
+    assert results[0][0] == results[1][0], f"Optimized code differs: {results[0][0]} != {results[1][0]}"
+    print(f"speedup x{results[0][1] / results[1][1]:.2f}")
+
+def peak_memory(func: Callable[[], None]) -> int:
+    """ Returns the peak memory allocated while running func, in bytes. """
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def bench_frontend(n: int, repeat: int) -> None:
+    """ Compares compiling a large program through the AST with the single-pass translator. """
+    source = large_source(n)
+    lexer = CplLexer()
+    parser, translator = CplParser(), CplTranslator()
+    results: List[QuadCode] = []
+
+    def compile_ast() -> None:
+        prog = parser.parse(lexer.tokenize(source))
+        assert prog is not None and prog.visit() and prog.code is not None, "Benchmark program failed to compile!"
+        results.append(prog.code)
+
+    def compile_single_pass() -> None:
+        code = translator.parse(lexer.tokenize(source))
+        assert code is not None and translator.success, "Benchmark program failed to compile!"
+        results.append(code)
+
+    lines = source.count('\n') + 1
+    print(f"{lines} source lines, {len(source)} bytes")
+    timings = []
+    for name, func in (("AST:", compile_ast), ("single pass:", compile_single_pass)):
+        elapsed = best_of(repeat, func)
+        peak = peak_memory(func)
+        timings.append(elapsed)
+        print(f"{name:13} {elapsed * 1000:.1f}ms, {lines / elapsed:,.0f} lines/s, peak memory {peak / 2 ** 20:.1f}MiB")
+    # Labels may be named differently, but must be emitted at the same lines.
+    for c in results:
+        c.apply_labels()
+    assert all(c.code == results[0].code for c in results), "Single-pass code differs from the AST's code!"
+    print(f"speedup x{timings[0] / timings[1]:.2f}")
+
+def expression_source(n: int, seed: int = 0) -> str:
+    """ Returns a CPL program of n statements over random expressions, mixing int and float operands. """
+    rng = random.Random(seed)
+    operands = ['a', 'b', 'c', 'x', 'y', 'z', '2', '7', '1.5', '0.25']
+
+    def expression(depth: int) -> str:
+        if depth == 0 or rng.random() < 0.2:
+            return rng.choice(operands)
+        op = rng.choice(['+', '-', '*', '/'])
+        return f"({expression(depth - 1)} {op} {expression(depth - 1)})"
+
+    def condition() -> str:
+        relop = rng.choice(['==', '!=', '<', '>', '<=', '>='])
+        compare = f"{expression(2)} {relop} {expression(2)}"
+        logical = rng.choice(['&&', '||', None])
+        return f"{compare} {logical} {expression(1)} < {expression(1)}" if logical else compare
+
+    statements = []
+    for _ in range(n):
+        target = rng.choice(['x', 'y', 'z'])
+        if rng.random() < 0.3:
+            statements.append(f"if ({condition()}) {target} = {expression(3)}; else {target} = {expression(2)};")
+        else:
+            statements.append(f"{target} = {expression(4)};")
+    return "a, b, c: int;\nx, y, z: float;\n{\n" + "\n".join(statements) + "\n}\n"
+
+def bench_codegen(n: int, repeat: int) -> None:
+    """ Measures code generation (visiting a parsed AST) over a program of n expression-heavy statements. """
+    source = expression_source(n)
+    prog = CplParser().parse(CplLexer().tokenize(source))
+    assert prog is not None, "Benchmark program failed to parse!"
+    assert prog.visit() and prog.code is not None, "Benchmark program failed to compile!"
+    quads = len(prog.code.code)
+    elapsed = best_of(repeat, prog.visit)
+    print(f"{n} statements, {quads} quads")
+    print(f"code generation: {elapsed * 1000:.1f}ms, {quads / elapsed:,.0f} quads/s")
+
+def bench_ssa(n: int, repeat: int) -> None:
+    """
+    Compares finding the definitions reaching each use by dataflow (as the dataflow based passes do)
+    with building the SSA form, on a large program (of n / 20 copies of the loops program's body).
+    """
+    code = compile_cpl(large_source(max(n // 20, 1)))
+    dataflow = best_of(repeat, lambda: ReachingDefinitions(ControlFlowGraph.from_code(code)).solve().def_use_chains())
+    ssa = best_of(repeat, lambda: SSAForm(ControlFlowGraph.from_code(code)))
+    round_trip = best_of(repeat, lambda: SSAForm(ControlFlowGraph.from_code(code)).to_graph())
+    sccp = best_of(repeat, lambda: propagate_constants(code))
+    print(f"{len(code.code)} quads")
+    for name, elapsed in (("reaching definitions:", dataflow), ("SSA construction:", ssa),
+                          ("SSA round trip:", round_trip), ("sccp pass:", sccp)):
+        print(f"{name:22} {elapsed * 1000:.1f}ms")
+    print(f"SSA construction speedup x{dataflow / ssa:.1f}")
+
+def bench_incremental(n: int, repeat: int) -> None:
+    """
+    Compares recompiling a large program (of n / 10 copies of the loops program's body) from scratch
+    with recompiling it incrementally, after editing a single statement in its middle.
+    """
+    source = large_source(max(n // 10, 1))
+    middle = source.index("s = s + 1;", len(source) // 2)
+    edited = source[:middle] + "s = s + 2;" + source[middle + len("s = s + 1;"):]
+    incremental = Compiler(incremental=True)
+    assert incremental.compile(source).success, "Benchmark program failed to compile!"
+    results: List[Tuple[str, str]] = []
+    versions = [edited, source]
+
+    def recompile(compiler: Compiler) -> None:
+        # Alternate between the versions, so each compilation follows an edit.
+        versions.reverse()
+        result = compiler.compile(versions[-1])
+        assert result.success, "Benchmark program failed to compile!"
+        results.append((versions[-1], result.text()))
+
+    lines = source.count('\n') + 1
+    print(f"{lines} source lines, {len(source)} bytes, a single statement edited")
+    timings = []
+    for name, compiler in (("from scratch:", Compiler()), ("incremental:", incremental)):
+        versions[:] = [edited, source]
+        elapsed = best_of(repeat, lambda: recompile(compiler))
+        timings.append(elapsed)
+        print(f"{name:14} {elapsed * 1000:.1f}ms")
+    expected = {version: Compiler().compile(version).text() for version in (source, edited)}
+    assert all(text == expected[version] for version, text in results), "Incremental code differs from a full compile!"
+    print(f"speedup x{timings[0] / timings[1]:.1f}")
+
+BENCHMARKS = {
+    'exec': bench_exec,
+    'batch': bench_batch,
+    'load': bench_load,
+    'fuse': bench_fuse,
+    'dataflow': bench_dataflow,
+    'frontend': bench_frontend,
+    'ssa': bench_ssa,
+    'codegen': bench_codegen,
+    'incremental': bench_incremental,
+}
+
+if __name__ == '__main__':
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument('benchmark', choices=list(BENCHMARKS))
+    arg_parser.add_argument('-n', type=int, default=2000, help='Size of the benchmark workload.')
+    arg_parser.add_argument('--repeat', type=int, default=3)
+    args = arg_parser.parse_args()
+    BENCHMARKS[args.benchmark](args.n, args.repeat)
@@ -1,6 +1,6 @@
 from __future__ import annotations
 from enum import Enum, auto
-from typing import Dict, Tuple
+from typing import Dict, NamedTuple, Optional, Tuple
 
 class Dtype(Enum):
     """ This enum describes the data types supported by the compiler. """
@@ -21,8 +21,11 @@ class SemanticError(Exception):
     """ 
     This exception is raised when a semantic error is encountered.
     The semantic analyzer catches this exception and prints the error message.
+    The source line is filled in by the AST node the error was raised from, if not given.
     """
-    pass
+    def __init__(self, message: str, lineno: Optional[int] = None):
+        super().__init__(message)
+        self.lineno = lineno
 
 class QuadInstruction(Enum):
     """ This enum describes the instruction set of the Quad code. """
@@ -54,6 +57,31 @@ class QuadInstruction(Enum):
     JMPZ = auto()
     HALT = auto()  
 
+class QuadSuperInstruction(Enum):
+    """
+    This enum describes the extended instruction set: superinstructions, each replacing
+    a sequence of Quad instructions (see quad_fusion), which may be lowered back to it.
+    The values follow the QuadInstruction values, so both fit the same opcode space.
+    """
+    # dest := a + b > 1 (or > 0), the && (or ||) of two booleans.
+    IAND = 64
+    IOR = auto()
+    RAND = auto()
+    ROR = auto()
+    # JZ<op> target a b: jumps to target if (a <op> b) is zero.
+    JZIEQL = auto()
+    JZINQL = auto()
+    JZILSS = auto()
+    JZIGRT = auto()
+    JZIAND = auto()
+    JZIOR = auto()
+    JZREQL = auto()
+    JZRNQL = auto()
+    JZRLSS = auto()
+    JZRGRT = auto()
+    JZRAND = auto()
+    JZROR = auto()
+
 class CplBinaryOp(Enum):
     """
     This enum describes the binary operators supported by the compiler - 
@@ -79,22 +107,11 @@ class CplBinaryOp(Enum):
         Converts the CplBinaryOp to the QuadInstructionType, returns it's value, combined
         with an optional boolean value to indicate whether flipping the operand order is required. 
         """
-        return {
-            self.ADD: (QuadInstructionType.ADD, False),
-            self.SUB: (QuadInstructionType.SUB, False),
-            self.MLT: (QuadInstructionType.MLT, False),
-            self.DIV: (QuadInstructionType.DIV, False),
-            self.EQL: (QuadInstructionType.EQL, False),
-            self.NQL: (QuadInstructionType.NQL, False),
-            self.LSS: (QuadInstructionType.LSS, False),
-            self.GRT: (QuadInstructionType.GRT, False),
-            self.GRTEQ: (QuadInstructionType.LSS, True),
-            self.LSSEQ: (QuadInstructionType.GRT, True),
-        }[self]
+        return _QUAD_OPS[self]
 
     def isrelop(self) -> bool:
         """ Returns whether the operator is a relational operator. """
-        return self in {self.EQL, self.NQL, self.LSS, self.GRT, self.GRTEQ, self.LSSEQ}
+        return self in _RELOPS
 
 
 class QuadInstructionType(Enum):
@@ -179,4 +196,49 @@ _arg_map: Dict[QuadInstructionType, Dict[Dtype, QuadInstruction]] = {
     },
 }
 """This is map from instruction type to instruction,
-with the affective type of the arguments reference."""
\ No newline at end of file
+with the affective type of the arguments reference."""
+
+_QUAD_OPS: Dict[CplBinaryOp, Tuple[QuadInstructionType, bool]] = {
+    CplBinaryOp.ADD: (QuadInstructionType.ADD, False),
+    CplBinaryOp.SUB: (QuadInstructionType.SUB, False),
+    CplBinaryOp.MLT: (QuadInstructionType.MLT, False),
+    CplBinaryOp.DIV: (QuadInstructionType.DIV, False),
+    CplBinaryOp.EQL: (QuadInstructionType.EQL, False),
+    CplBinaryOp.NQL: (QuadInstructionType.NQL, False),
+    CplBinaryOp.LSS: (QuadInstructionType.LSS, False),
+    CplBinaryOp.GRT: (QuadInstructionType.GRT, False),
+    CplBinaryOp.GRTEQ: (QuadInstructionType.LSS, True),
+    CplBinaryOp.LSSEQ: (QuadInstructionType.GRT, True),
+}
+
+_RELOPS = frozenset({CplBinaryOp.EQL, CplBinaryOp.NQL, CplBinaryOp.LSS, CplBinaryOp.GRT,
+                     CplBinaryOp.GRTEQ, CplBinaryOp.LSSEQ})
+
+class Selection(NamedTuple):
+    """
+    The instruction selected for a binary operator over operands of given data types.
+    The operands are swapped first if flip is set; then each one whose casts entry is set is
+    cast to float (ITOR) before the opcode is emitted into a new temp of the result type.
+    For AND, OR - the opcode adds the operands, and the result is then compared (GRT) to the threshold.
+    """
+    opcode: QuadInstruction
+    flip: bool
+    casts: Tuple[bool, bool]
+    result: Dtype
+    threshold: Optional[int] = None
+
+def _select(op: CplBinaryOp, left: Dtype, right: Dtype) -> Selection:
+    if op in (CplBinaryOp.AND, CplBinaryOp.OR):
+        return _select(CplBinaryOp.ADD, left, right)._replace(threshold=1 if op == CplBinaryOp.AND else 0)
+    quad_op, flip = op.to_quad_op()
+    if flip:
+        left, right = right, left
+    dtype = left.affective_type(right)
+    # boolean expression result is always an integer!
+    return Selection(quad_op.get_bytype(dtype), flip, (left != dtype, right != dtype),
+                     Dtype.INT if op.isrelop() else dtype)
+
+SELECTION: Dict[Tuple[CplBinaryOp, Dtype, Dtype], Selection] = {
+    (op, left, right): _select(op, left, right) for op in CplBinaryOp for left in Dtype for right in Dtype
+}
+""" The instruction selection table, by the operator and the data types of its (unflipped) operands. """
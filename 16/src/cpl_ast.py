@@ -7,13 +7,42 @@ allowing an easy implementation of the code generation.
 from __future__ import annotations
 from dataclasses import dataclass, fields
 import logging
-from typing import Iterable, List, Union, Optional
+from typing import TYPE_CHECKING, Dict, Iterable, List, Union, Optional
 
-from consts import QuadInstruction, QuadInstructionType, Dtype, CplBinaryOp, SemanticError
-from quad_code import QuadCode
+from consts import QuadInstruction, QuadInstructionType, Dtype, CplBinaryOp, SELECTION, SemanticError
+from quad_code import INVALID, ArgumentType, QuadCode
+
+if TYPE_CHECKING:
+    from cpl_incremental import Fragment, FragmentCache
 
 RECOVER_FROM_ERROR = False
 
+semantic_errors: Optional[List[SemanticError]] = None
+""" Collects the semantic errors found while visiting, instead of logging them (if set). """
+
+fragments: Optional[FragmentCache] = None
+""" Replays the code of the statements visited before, instead of visiting them again (if set). """
+
+constructs: Optional[List[Optional[str]]] = None
+"""
+Collects the construct each instruction was emitted by - the class name of the innermost node being
+visited, or None outside of the statements - while visiting (if set). See quad_cost.
+"""
+
+_construct: Optional[str] = None
+""" The construct the instructions being emitted are attributed to. """
+
+def _attribute(construct: Optional[str]) -> Optional[str]:
+    """
+    Attributes the instructions emitted since the last call to the current construct,
+    and makes the given construct the current one. Returns the former one.
+    """
+    global _construct
+    assert constructs is not None
+    constructs.extend([_construct] * (len(code.code) - len(constructs)))
+    outer, _construct = _construct, construct
+    return outer
+
 @dataclass
 class AstNode:
     """ 
@@ -28,6 +57,7 @@ class AstNode:
         It is used here to initialize the bound methods to a property visitation order.
         """
         self._success = True
+        self.lineno: Optional[int] = None
         self._bounds = {}
         for field in fields(self):
             self._bounds[field.name] = ([], [])
@@ -42,6 +72,11 @@ class AstNode:
         
         self._logger = logging.getLogger(self.__class__.__name__)
     
+    def at(self, lineno: int) -> AstNode:
+        """ Sets the source line of the node. Returns the node itself, for use by the parser. """
+        self.lineno = lineno
+        return self
+
     @property
     def success(self) -> bool:
         """ 
@@ -59,7 +94,7 @@ class AstNode:
             try:
                 result &= val.visit()
             except SemanticError as e:
-                self.on_semantic_error(str(e))
+                self.on_semantic_error(e)
                 result = False
         elif isinstance(val, Iterable) and not isinstance(val, str):
             element: AstNode
@@ -67,12 +102,17 @@ class AstNode:
                 try:
                     result &= self._visit_child(element)
                 except SemanticError as e:
-                    self.on_semantic_error(str(e))
+                    self.on_semantic_error(e)
                     result = False
         return result
     
-    def on_semantic_error(self, msg: str):
-        self._logger.error(f"Semantic Error: {msg}")
+    def on_semantic_error(self, error: SemanticError):
+        if error.lineno is None:
+            error.lineno = self.lineno
+        if semantic_errors is not None:
+            semantic_errors.append(error)
+        else:
+            self._logger.error(f"Semantic Error: {error}")
         self._success = False
     
     def visit(self) -> bool:
@@ -81,17 +121,33 @@ class AstNode:
         applying the methods bound to visitation order.
         visit() method is called for each instance of an AstNode object.
         visit() will also be called for each instance of AstNode inside an Iterable.
+        The instructions emitted while visiting the node are attributed to its source line (and to it, see constructs).
         """
-        self.before()
-        for field in fields(self):
-            for func in self._bounds[field.name][0]:
-                func()
-
-            self._success = self._visit_child(getattr(self, field.name)) and self._success
-
-            for func in self._bounds[field.name][1]:
-                func()
-        self.after()
+        if self.lineno is not None:
+            outer_line = code.source_line
+            code.source_line = self.lineno
+            if constructs is not None:
+                outer_construct = _attribute(type(self).__name__)
+        try:
+            self.before()
+            for field in fields(self):
+                for func in self._bounds[field.name][0]:
+                    func()
+
+                self._success = self._visit_child(getattr(self, field.name)) and self._success
+
+                for func in self._bounds[field.name][1]:
+                    func()
+            self.after()
+        except SemanticError as e:
+            if e.lineno is None:
+                e.lineno = self.lineno
+            raise
+        finally:
+            if self.lineno is not None:
+                code.source_line = outer_line
+                if constructs is not None:
+                    _attribute(outer_construct)
         return self._success
 
     @staticmethod
@@ -126,7 +182,15 @@ it's the simplest way for this implementation.
 
 @dataclass
 class Stmt(AstNode):
-    pass
+    def __post_init__(self):
+        super().__post_init__()
+        self.fragment: Optional[Fragment] = None
+        """ The code emitted by the last visit of the statement, if recorded (see cpl_incremental). """
+
+    def visit(self) -> bool:
+        if fragments is None:
+            return super().visit()
+        return fragments.visit(self, super().visit)
 
 @dataclass
 class AssignStmt(Stmt):
@@ -219,7 +283,7 @@ class Case(AstNode):
         
         # Check if the case value is an integer
         if not isinstance(self.number, int):
-            self.on_semantic_error(f"Case value must be an integer, got {self.number}!")
+            self.on_semantic_error(SemanticError(f"Case value must be an integer, got {self.number}!"))
             
         code.emit(QuadInstruction.JMPZ, self._end_label, tmpname)
         # Enabled Fallthrough from previous case (if exists)
@@ -246,9 +310,14 @@ class SwitchStmt(Stmt):
     def before_cases(self):
         # Each case should know where to compare from!
         exp_target = expression_raw(self.expr)
-        if code.get_type(exp_target) != Dtype.INT:
-            self.on_semantic_error("Switch expression must be of type int," + 
-                                   f"got {code.get_type(exp_target)}.")
+        try:
+            if exp_target != INVALID and code.get_type(exp_target) != Dtype.INT:
+                self.on_semantic_error(SemanticError("Switch expression must be of type int, " +
+                                                     f"got {code.get_type(exp_target)}."))
+        except SemanticError as e:
+            # An undeclared variable - the cases are still checked.
+            self.on_semantic_error(e)
+            exp_target = INVALID
 
         last_label = None
 
@@ -263,7 +332,8 @@ class SwitchStmt(Stmt):
         # Last case fallsthrough to default case - no jump to label needed!
         # Default case has no comparison, so it will always continue to the end of the switch,
         # unless it has a break statement - which is handled by the label_scope anyway.
-        self.cases[-1].middle_next_label = None
+        if self.cases:
+            self.cases[-1].middle_next_label = None
 
     cases: List[Case]
 
@@ -286,7 +356,13 @@ class StmtList(AstNode):
     stmts: List[AstNode]
 
 @dataclass
-class BinaryOpExpression(AstNode):
+class TargetExpression(AstNode):
+    """ An expression whose code computes it into a target - INVALID if that failed (see quad_code.INVALID). """
+    def before(self):
+        self.target = INVALID
+
+@dataclass
+class BinaryOpExpression(TargetExpression):
     left: Expression
     right: Expression
     op: CplBinaryOp
@@ -294,29 +370,14 @@ class BinaryOpExpression(AstNode):
     target: Optional[Identifier] = None
     
     def after(self):
-        try:
-            # Basic supported ops - are just compiled right away
-            op, flip = self.op.to_quad_op()
-            l, r = (self.right, self.left) if flip else (self.left, self.right)
-            # boolean expression result is always an integer!
-            res = code.emit_to_temp(op, expression_raw(l), expression_raw(r), Dtype.INT if self.op.isrelop() else None)
-            self.target = res
-        except KeyError:
-            # AND, OR are special cases. They're actually like checking out the Addition result.
-            add_res = code.emit_to_temp(QuadInstructionType.ADD,
-                                        expression_raw(self.left),
-                                        expression_raw(self.right))
-            greater_thresh = 1 if self.op == CplBinaryOp.AND else 0
-            # should be automatically integers anyway, but doesn't matter.
-            res = code.emit_to_temp(QuadInstructionType.GRT, add_res, greater_thresh, Dtype.INT)
-            self.target = res
+        self.target = emit_binary_op(code, self.op, expression_raw(self.left), expression_raw(self.right))
 
 @dataclass
-class NotBoolExpr(AstNode):
+class NotBoolExpr(TargetExpression):
     source: Expression
     target: Optional[Identifier] = None
     def after(self):
-        self.target = code.emit_to_temp(QuadInstructionType.EQL, expression_raw(self.target), 0)
+        self.target = code.emit_to_temp(QuadInstructionType.EQL, expression_raw(self.source), 0)
 
 @dataclass
 class Declarations(AstNode):
@@ -327,32 +388,16 @@ class Declaration(AstNode):
     idlist: List[Identifier]
     _type: Dtype
     def after(self):
-        for id in self.idlist:
-            try:
-                code.add_symbol(id, self._type)
-            except ValueError:
-                raise SemanticError(f"Invalid re-definition of variable {id}.")
+        declare(code, self.idlist, self._type)
 
 @dataclass
-class CastExpression(AstNode):
+class CastExpression(TargetExpression):
     arg: Expression
     _to_type: Dtype
     
     target: Optional[Union[Identifier, Number]] = None
     def after(self):
-        # If type of expression is the same as requested, no need to cast.
-        # Set the result to the result of the input expression itself.
-        if code.get_type(expression_raw(self.arg)) == self._to_type:
-            self.target = expression_raw(self.arg)
-            return
-
-        # cast is actually changing the expression, add a new instruction to perform it.
-        tname = code.newtemp(self._to_type)
-        code.emit(QuadInstruction.ITOR if \
-                    self._to_type == Dtype.INT else \
-                    QuadInstruction.RTOI,
-                    tname, expression_raw(self.arg))
-        self.target = tname
+        self.target = emit_cast(code, expression_raw(self.arg), self._to_type)
 
 @dataclass
 class Program(AstNode):
@@ -369,11 +414,53 @@ class Program(AstNode):
         code.emit(QuadInstruction.HALT)
         self.code = code
 
+def declare(code: QuadCode, idlist: List[Identifier], dtype: Dtype) -> None:
+    """ Adds the declared variables to the symbol table. """
+    for id in idlist:
+        try:
+            code.add_symbol(id, dtype)
+        except ValueError:
+            raise SemanticError(f"Invalid re-definition of variable {id}.")
+
+def emit_binary_op(code: QuadCode, op: CplBinaryOp, left: ArgumentType, right: ArgumentType) -> str:
+    """ Emits a binary operation over two (raw) operands into a new temp. Returns the temp. """
+    if INVALID in (left, right):
+        return INVALID
+    selection = SELECTION[op, code.get_type(left), code.get_type(right)]
+    args = (right, left) if selection.flip else (left, right)
+    temp = code.newtemp(selection.result)
+    # Implicit casts int --> float (see QuadCode.auto_cast).
+    casts: Dict[ArgumentType, str] = {}
+    for arg, cast in zip(args, selection.casts):
+        if cast:
+            casts[arg] = code.newtemp(Dtype.FLOAT)
+            code.emit(QuadInstruction.ITOR, casts[arg], arg)
+    code.emit(selection.opcode, temp, *(casts.get(arg, arg) for arg in args))
+    if selection.threshold is None:
+        return temp
+    # AND, OR are special cases. They're actually like checking out the Addition result.
+    return emit_binary_op(code, CplBinaryOp.GRT, temp, selection.threshold)
+
+def emit_cast(code: QuadCode, arg: ArgumentType, to_type: Dtype) -> ArgumentType:
+    """ Emits a cast of a (raw) operand to a data type, if needed. Returns the cast result. """
+    # If type of expression is the same as requested, no need to cast.
+    # Set the result to the result of the input expression itself.
+    if arg == INVALID or code.get_type(arg) == to_type:
+        return arg
+
+    # cast is actually changing the expression, add a new instruction to perform it.
+    tname = code.newtemp(to_type)
+    code.emit(QuadInstruction.RTOI if \
+                to_type == Dtype.INT else \
+                QuadInstruction.ITOR,
+                tname, arg)
+    return tname
+
 def expression_raw(expression: Optional[Expression]) -> Union[Number, Identifier]:
     assert expression is not None, "Expression is None!"
     # If it's not a terminal expression (number or identifier), it must have a target,
     # and we're looking up for that target.
-    if isinstance(expression, (BinaryOpExpression, CastExpression, NotBoolExpr)):
+    if isinstance(expression, TargetExpression):
         target = expression.target
         assert target is not None, "Expression target is None!"
         return target
@@ -0,0 +1,241 @@
+"""
+This module exposes the CPL to Quad compiler as a library.
+compile_source() runs the whole pipeline (tokenize, parse, generate and optimize) over CPL source,
+and returns the resulting code along with the errors found, as Diagnostic objects (nothing is printed).
+compile_source_async() and compile_many() run it in an executor, for use from asyncio code.
+A thread pool (the default) keeps the event loop responsive, but code generation is serialized
+(the AST nodes emit into a global QuadCode); pass a ProcessPoolExecutor to compile in parallel.
+A Compiler in incremental mode recompiles each version of a source from the last one (see cpl_incremental).
+With explain set, the estimated cost of the generated code is reported by source line and construct (see quad_cost).
+"""
+from __future__ import annotations
+import asyncio
+import functools
+import threading
+from concurrent.futures import Executor
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import AsyncIterable, Iterable, List, Optional, Sequence, Union
+
+import sly
+import cpl_ast
+from consts import SemanticError
+from cpl_incremental import FragmentCache, IncrementalParser
+from cpl_lexer import CplLexer, ErrorHandler
+from cpl_parser import CplParser
+from cpl_translator import CplTranslator
+from quad_code import QuadCode
+from quad_cost import CostModel
+from quad_fusion import has_superinstructions, lower_superinstructions
+from quad_optimize import PassSpec, optimize
+from quad_profile import QuadProfile
+
+DEFAULT_CONCURRENCY = 4
+""" The default number of sources compile_many() has in flight at once. """
+
+class Stage(Enum):
+    """ This enum describes the compilation stages reporting diagnostics. """
+    LEXICAL = "Lexical"
+    SYNTAX = "Syntax"
+    SEMANTIC = "Semantic"
+
+@dataclass(frozen=True)
+class Diagnostic:
+    """ An error found while compiling CPL source. """
+    stage: Stage
+    message: str
+    lineno: Optional[int] = None
+
+    def __str__(self) -> str:
+        where = f"Line {self.lineno}: " if self.lineno is not None else ""
+        return f"{where}{self.stage.value} error: {self.message}"
+
+@dataclass
+class CompileResult:
+    """ The outcome of compiling CPL source: the resolved code if compilation succeeded, and the errors found. """
+    source: str
+    code: Optional[QuadCode] = None
+    diagnostics: List[Diagnostic] = field(default_factory=list)
+    explanation: Optional[str] = None
+    """ The cost report of the generated code (see CostModel.report), if asked for. """
+
+    @property
+    def success(self) -> bool:
+        return self.code is not None and not self.diagnostics
+
+    @property
+    def failed_stage(self) -> Optional[Stage]:
+        """ The earliest stage reporting errors, if compilation failed. """
+        return next((stage for stage in Stage if any(d.stage == stage for d in self.diagnostics)), None)
+
+    def text(self, epilogue: Optional[str] = None) -> str:
+        """ Returns the code in the text format, exactly as QuadCode.write() writes it. """
+        if self.code is None:
+            raise ValueError("Compilation failed, there is no code!")
+        return "".join(line + '\n' for line in self.code.text_lines()) + (epilogue or "")
+
+_codegen_lock = threading.Lock()
+""" Guards the global state of cpl_ast (the code being generated and the collected errors). """
+
+class Compiler:
+    """
+    Compiles CPL sources one at a time, reusing a single lexer and parser instance between them
+    (for repeated compilations, e.g. watching files). Instances are not thread-safe.
+    In single pass mode, the code is emitted while parsing (see cpl_translator), without building the AST.
+    In incremental mode, each source is taken as the next version of the last one compiled: only the
+    statements enclosing the edit are parsed and visited again, the code of the others is replayed.
+    """
+    def __init__(self, single_pass: bool = False, incremental: bool = False) -> None:
+        if single_pass and incremental:
+            raise ValueError("Incremental compilation requires the AST, which the single pass mode doesn't build!")
+        self._diagnostics: List[Diagnostic] = []
+        self.single_pass = single_pass
+        self.lexer = CplLexer(on_error=self._reporter(Stage.LEXICAL))
+        self.parser: Union[CplParser, CplTranslator] = \
+            CplTranslator(on_error=self._reporter(Stage.SYNTAX), on_semantic_error=self._report_semantic) \
+            if single_pass else CplParser(on_error=self._reporter(Stage.SYNTAX))
+        self.incremental = IncrementalParser(self.lexer, self._reporter(Stage.SYNTAX)) if incremental else None
+
+    def _reporter(self, stage: Stage) -> ErrorHandler:
+        return lambda lineno, message: self._diagnostics.append(Diagnostic(stage, message, lineno))
+
+    def _report_semantic(self, error: SemanticError) -> None:
+        self._diagnostics.append(Diagnostic(Stage.SEMANTIC, str(error), error.lineno))
+
+    def _generate(self, prog: cpl_ast.Program, fragments: Optional[FragmentCache] = None,
+                  constructs: Optional[List[Optional[str]]] = None) -> Optional[QuadCode]:
+        """
+        Generates the code of a program by visiting its AST (replaying the fragments recorded, if given).
+        The construct each instruction was emitted by is collected into constructs, if given.
+        """
+        errors: List[SemanticError] = []
+        with _codegen_lock:
+            cpl_ast.semantic_errors = errors
+            cpl_ast.fragments = fragments
+            cpl_ast.constructs = constructs
+            try:
+                success = prog.visit()
+            finally:
+                cpl_ast.semantic_errors = None
+                cpl_ast.fragments = None
+                cpl_ast.constructs = None
+        for error in errors:
+            self._report_semantic(error)
+        return prog.code if success else None
+
+    def compile(self, source: str, passes: Sequence[PassSpec] = (), profile: Optional[QuadProfile] = None,
+                extended: bool = False, explain: bool = False) -> CompileResult:
+        """
+        Compiles CPL source into resolved Quad code, running the given optimization passes over it.
+        Superinstructions are lowered back into standard Quad code, unless extended is set.
+        If explain is set, the estimated cost of the generated code is reported (see CompileResult.explanation).
+        The single pass mode doesn't build the AST, so its report can't tell the constructs.
+        """
+        result = CompileResult(source)
+        self._diagnostics = result.diagnostics
+        constructs: Optional[List[Optional[str]]] = [] if explain and not self.single_pass else None
+        try:
+            code = self._front_end(source, result, constructs)
+        except BaseException:
+            if self.incremental is not None:
+                self.incremental.reset()
+            raise
+        if code is None:
+            # Semantic errors are found again while visiting the statements in error (which aren't recorded),
+            # but the next version can't be parsed from this one if it failed parsing.
+            if self.incremental is not None and result.failed_stage != Stage.SEMANTIC:
+                self.incremental.reset()
+            return result
+
+        # The profile (if any) is taken from the generated code.
+        model = CostModel(code, profile) if explain else None
+        code = optimize(code, passes, profile)
+        if not extended and has_superinstructions(code):
+            code = lower_superinstructions(code)
+        result.code = code
+        if model is not None:
+            result.explanation = model.report(constructs, CostModel(code) if passes else None)
+        return result
+
+    def _front_end(self, source: str, result: CompileResult,
+                   constructs: Optional[List[Optional[str]]] = None) -> Optional[QuadCode]:
+        """ Parses CPL source and generates its code. Returns None (reporting the errors found) if failed. """
+        try:
+            parsed: Union[cpl_ast.Program, QuadCode, None] = self.incremental.parse(source) \
+                if self.incremental is not None else self.parser.parse(self.lexer.tokenize(source))
+        # Sly can only catch a single lexical error (already reported).
+        except sly.lex.LexError:
+            return None
+        except Exception as e:
+            result.diagnostics.append(Diagnostic(Stage.SYNTAX, f"Unexpected error {e} occurred while parsing"))
+            return None
+        if parsed is None or result.diagnostics:
+            if not result.diagnostics:
+                result.diagnostics.append(Diagnostic(Stage.SYNTAX, "Parsing failed"))
+            return None
+
+        if isinstance(parsed, QuadCode):
+            code: Optional[QuadCode] = parsed
+        else:
+            # The replayed statements aren't visited, so all of them are visited when collecting the constructs.
+            replay = self.incremental is not None and constructs is None
+            code = self._generate(parsed, FragmentCache(parsed) if replay else None, constructs)
+        if code is None or result.diagnostics:
+            if not result.diagnostics:
+                result.diagnostics.append(Diagnostic(Stage.SEMANTIC, "Code generation failed"))
+            return None
+        return code
+
+def compile_source(source: str, passes: Sequence[PassSpec] = (), profile: Optional[QuadProfile] = None,
+                   extended: bool = False, single_pass: bool = False) -> CompileResult:
+    """
+    Compiles CPL source into resolved Quad code (see Compiler.compile).
+    Thread-safe, and picklable for use with a ProcessPoolExecutor.
+    """
+    return Compiler(single_pass).compile(source, passes, profile, extended)
+
+async def compile_source_async(source: str, executor: Optional[Executor] = None,
+                               passes: Sequence[PassSpec] = (), profile: Optional[QuadProfile] = None,
+                               extended: bool = False, single_pass: bool = False) -> CompileResult:
+    """ Runs compile_source() in an executor (the event loop's default one, if not given). """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(
+        compile_source, source, passes, profile, extended, single_pass))
+
+async def _iterate(sources: Union[Iterable[str], AsyncIterable[str]]):
+    if isinstance(sources, AsyncIterable):
+        async for source in sources:
+            yield source
+    else:
+        for source in sources:
+            yield source
+
+async def compile_many(sources: Union[Iterable[str], AsyncIterable[str]], executor: Optional[Executor] = None,
+                       max_concurrency: int = DEFAULT_CONCURRENCY, passes: Sequence[PassSpec] = (),
+                       profile: Optional[QuadProfile] = None, extended: bool = False,
+                       single_pass: bool = False) -> List[CompileResult]:
+    """
+    Compiles many CPL sources in an executor, returning their results in order.
+    At most max_concurrency sources are in flight at once, and the next source is only taken
+    from the (possibly lazy or asynchronous) iterable once one of them is done.
+    """
+    if max_concurrency < 1:
+        raise ValueError("max_concurrency must be positive!")
+    slots = asyncio.Semaphore(max_concurrency)
+    tasks: List[asyncio.Future] = []
+
+    async def run(source: str) -> CompileResult:
+        try:
+            return await compile_source_async(source, executor, passes, profile, extended, single_pass)
+        finally:
+            slots.release()
+
+    try:
+        async for source in _iterate(sources):
+            await slots.acquire()
+            tasks.append(asyncio.ensure_future(run(source)))
+        return list(await asyncio.gather(*tasks))
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
@@ -0,0 +1,379 @@
+"""
+This module implements incremental compilation of CPL source, for recompiling the same source
+after each (small) edit, e.g. while it's being edited.
+IncrementalParser keeps the AST of the last version along with the source span of each node,
+and reparses only the smallest run of statements enclosing the edited text: some statements of a
+block, or a single statement of an if, while or switch. The statements parsed replace the old ones in the AST.
+FragmentCache keeps the code each statement emitted (see Stmt.visit), and replays it instead of visiting
+the statements left unchanged. The temps and labels a statement created are created again while replaying,
+and renamed if their numbers moved - so the code is exactly the code of a compilation from scratch.
+An edit outside the statements (e.g. of the declarations) is compiled from scratch.
+"""
+from __future__ import annotations
+import itertools
+import re
+from dataclasses import dataclass, fields
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+
+import sly
+import cpl_ast
+from consts import Dtype, QuadInstruction
+from cpl_ast import AstNode, IfStmt, Program, Stmt, SwitchStmt, WhileStmt
+from cpl_lexer import CplLexer, ErrorHandler
+from cpl_parser import CplParser
+from quad_code import QuadCode
+
+Item = Union[Stmt, list]
+""" An item of a block: a statement, or a nested block of items. """
+
+_WORD = re.compile(r'\w')
+
+@dataclass
+class _Span:
+    """ The source span of an AST node or a block, and the lines of its first and last tokens. """
+    item: Union[AstNode, list]
+    start: int
+    end: int
+    line: int
+    end_line: int
+
+@dataclass
+class _Run:
+    """
+    A run of items to reparse: owner[first:last] if the owner is a block,
+    or the single statement of the owner's slot (a field of an if or while).
+    """
+    owner: Union[AstNode, list]
+    slot: Optional[str]
+    first: int
+    last: int
+    start: int
+    end: int
+    """ The text to reparse (the items, and the blanks and comments around them). """
+    line: int
+    end_line: int
+    path: List[Union[AstNode, list]]
+    """ The nodes and blocks enclosing the run. """
+
+def _common_prefix(a: str, b: str) -> int:
+    """ Returns the length of the common prefix of two strings (comparing slices, rather than characters). """
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[low:middle] == b[low:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+def _common_suffix(a: str, b: str, limit: int) -> int:
+    """ Returns the length of the common suffix of two strings, up to limit. """
+    low, high = 0, limit
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[len(a) - middle:len(a) - low] == b[len(b) - middle:len(b) - low]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+def _walk(items: Iterable) -> Iterator[Union[AstNode, list]]:
+    """ Yields the AST nodes and blocks under the given items (the items included). """
+    stack = list(items)
+    while stack:
+        value = stack.pop()
+        if isinstance(value, list):
+            stack.extend(value)
+        elif isinstance(value, AstNode):
+            stack.extend(getattr(value, field.name) for field in fields(value))
+        else:
+            continue
+        yield value
+
+def _token(kind: str, index: int, lineno: int) -> sly.lex.Token:
+    token = sly.lex.Token()
+    token.type, token.value, token.lineno, token.index, token.end = kind, kind, lineno, index, index
+    return token
+
+class IncrementalParser:
+    """
+    Parses versions of the same CPL source, reparsing only the statements enclosing the edited text.
+    The AST returned is the AST of the last version, patched (don't keep it across parses).
+    Errors are reported through on_error, as CplParser does (an edit which doesn't reparse cleanly
+    by itself is parsed from scratch, so the errors reported are the errors of the whole source).
+    """
+    def __init__(self, lexer: CplLexer, on_error: Optional[ErrorHandler] = None) -> None:
+        self.lexer = lexer
+        self.on_error = on_error
+        self.source: Optional[str] = None
+        self.program: Optional[Program] = None
+        self._spans: Dict[int, _Span] = {}
+        self.reparsed: Optional[int] = None
+        """ The length of the text reparsed by the last parse (None if parsed from scratch). """
+
+    def reset(self) -> None:
+        """ Forgets the last version, so the next one is parsed from scratch (e.g. once parsing it failed). """
+        self.source = self.program = None
+        self._spans = {}
+
+    def parse(self, source: str) -> Optional[Program]:
+        if self.program is not None and self.source is not None:
+            if source == self.source:
+                self.reparsed = 0
+                return self.program
+            program = self._reparse(source)
+            if program is not None:
+                return program
+        return self._parse(source)
+
+    def _tokens(self, lexer: CplLexer, text: str, lineno: int, index: int,
+                end_lines: Dict[int, int]) -> Iterator[sly.lex.Token]:
+        """ Tokenizes text from index, collecting the line of the token ending at each index. """
+        for token in lexer.tokenize(text, lineno, index):
+            end_lines[token.end] = token.lineno
+            yield token
+
+    def _record(self, parser: CplParser, items: Iterable, end_lines: Dict[int, int]) -> None:
+        """ Keeps the spans of the nodes and blocks under the given items, as just parsed. """
+        for value in _walk(items):
+            start, end = parser.index_position(value)
+            # The blocks of a case or default aren't tracked (they start with an empty production),
+            # and a case ending with an empty block is only tracked by its start.
+            if start is not None:
+                line = parser.line_position(value)
+                self._spans[id(value)] = _Span(value, start, end, line, end_lines[end]) if end is not None \
+                    else _Span(value, start, start, line, line)
+
+    def _parse(self, source: str) -> Optional[Program]:
+        self.reset()
+        self.reparsed = None
+        end_lines: Dict[int, int] = {}
+        errors: List[str] = []
+
+        def on_error(lineno: Optional[int], message: str) -> None:
+            errors.append(message)
+            if self.on_error is not None:
+                self.on_error(lineno, message)
+
+        # A new parser, for the positions it tracks to cover this parse only.
+        parser = CplParser(on_error=on_error)
+        program = parser.parse(self._tokens(self.lexer, source, 1, 0, end_lines))
+        if not errors and isinstance(program, Program) and isinstance(program.stmts, list):
+            self.source, self.program = source, program
+            self._record(parser, [program.stmts], end_lines)
+        return program
+
+    def _reparse(self, source: str) -> Optional[Program]:
+        """ Reparses the run of statements enclosing the edit. Returns None if the source must be parsed from scratch. """
+        assert self.source is not None and self.program is not None
+        old = self.source
+        start = _common_prefix(old, source)
+        tail = _common_suffix(old, source, min(len(old), len(source)) - start)
+        delta = len(source) - len(old)
+        run = self._locate(start, len(old) - tail)
+        if run is None:
+            return None
+        end = run.end + delta
+        # The run must be made of whole tokens: the tokens around it may not join tokens of the new text.
+        if (run.start > 0 and _WORD.match(source, run.start - 1) and _WORD.match(source, run.start)) or \
+                (end < len(source) and _WORD.match(source, end - 1) and _WORD.match(source, end)):
+            return None
+
+        failed: List[str] = []
+        lexer = CplLexer(on_error=lambda lineno, message: failed.append(message))
+        parser = CplParser(on_error=lambda lineno, message: failed.append(message))
+        end_lines: Dict[int, int] = {}
+        # Parse the run as the block of a program with no declarations.
+        tokens = itertools.chain([_token('{', run.start, run.line)],
+                                 self._tokens(lexer, source[:end], run.line, run.start, end_lines),
+                                 [_token('}', end, run.end_line)])
+        try:
+            program = parser.parse(tokens)
+        except sly.lex.LexError:
+            return None
+        if failed or not isinstance(program, Program) or (run.slot is not None and len(program.stmts) != 1):
+            return None
+        items: List[Item] = program.stmts
+        lines = lexer.lineno - run.end_line
+
+        replaced = [getattr(run.owner, run.slot)] if run.slot is not None else run.owner[run.first:run.last]
+        for value in _walk(replaced):
+            self._spans.pop(id(value), None)
+        if run.slot is not None:
+            setattr(run.owner, run.slot, items[0])
+        else:
+            run.owner[run.first:run.last] = items
+
+        for span in self._spans.values():
+            if span.start >= run.end:
+                span.start += delta
+                span.end += delta
+                if lines:
+                    span.line += lines
+                    span.end_line += lines
+                    if isinstance(span.item, AstNode) and span.item.lineno is not None:
+                        span.item.lineno += lines
+        for enclosing in run.path:
+            span = self._spans[id(enclosing)]
+            span.end += delta
+            span.end_line += lines
+            # The code of the enclosing statements changes along with the run, and so may their errors.
+            if isinstance(enclosing, AstNode):
+                enclosing._success = True
+            if isinstance(enclosing, Stmt):
+                enclosing.fragment = None
+        self.program._success = True
+        self._record(parser, items, end_lines)
+        self.source = source
+        self.reparsed = end - run.start
+        return self.program
+
+    def _locate(self, start: int, end: int) -> Optional[_Run]:
+        """ Returns the smallest run of items enclosing the (old) text from start to end, if in the program's block. """
+        assert self.program is not None
+        block = self.program.stmts
+        span = self._spans[id(block)]
+        if not span.start < start or not end < span.end:
+            return None
+        return self._in_block(block, start, end, [block])
+
+    def _in_block(self, block: List[Item], start: int, end: int, path: List[Union[AstNode, list]]) -> _Run:
+        """ Returns the smallest run of items enclosing the text, which is in the block (inside its braces). """
+        spans = [self._spans[id(item)] for item in block]
+        overlapping = [i for i, span in enumerate(spans) if span.start < end and start < span.end]
+        if len(overlapping) == 1:
+            i = overlapping[0]
+            if spans[i].start < start and end < spans[i].end:
+                inner = self._in_item(block[i], start, end, path + [block[i]])
+                if inner is not None:
+                    return inner
+        if overlapping:
+            first, last = overlapping[0], overlapping[-1] + 1
+        else:
+            first = last = sum(1 for span in spans if span.end <= start)
+        block_span = self._spans[id(block)]
+        return _Run(block, None, first, last,
+                    spans[first - 1].end if first else block_span.start + 1,
+                    spans[last].start if last < len(spans) else block_span.end - 1,
+                    spans[first - 1].end_line if first else block_span.line,
+                    spans[last].line if last < len(spans) else block_span.end_line,
+                    path)
+
+    def _in_item(self, item: Item, start: int, end: int, path: List[Union[AstNode, list]]) -> Optional[_Run]:
+        """ Returns the smallest run of items enclosing the text, which is inside the item, if within its statements. """
+        if isinstance(item, list):
+            return self._in_block(item, start, end, path)
+        if isinstance(item, (IfStmt, WhileStmt)):
+            for slot in ('true_stmts', 'false_stmts') if isinstance(item, IfStmt) else ('stmts',):
+                value = getattr(item, slot)
+                span = self._spans.get(id(value))
+                if span is not None and span.start < start and end < span.end:
+                    return self._in_item(value, start, end, path + [value]) or \
+                        _Run(item, slot, 0, 1, span.start, span.end, span.line, span.end_line, path)
+        elif isinstance(item, SwitchStmt):
+            # The statements of the cases aren't enclosed in braces, so they're only reparsed one by one.
+            for case, stmts in [(case, case.stmts) for case in item.cases] + [(None, item.default)]:
+                enclosing = path + [case] if case is not None else path
+                for i, value in enumerate(stmts):
+                    span = self._spans[id(value)]
+                    if span.start < start and end < span.end:
+                        return self._in_item(value, start, end, enclosing + [value]) or \
+                            _Run(stmts, None, i, i + 1, span.start, span.end, span.line, span.end_line, enclosing)
+        return None
+
+@dataclass
+class Fragment:
+    """ The code a statement emitted, and the temps and labels it created (see FragmentCache). """
+    code: List[Tuple]
+    source_lines: List[Optional[int]]
+    lineno: Optional[int]
+    """ The source line of the statement, when emitted. """
+    temps: List[Tuple[str, Dtype]]
+    new_labels: List[str]
+    labels: Dict[str, int]
+    """ The labels emitted, by their line relative to the first instruction. """
+    temp_counters: Tuple[int, int]
+    label_counters: Tuple[int, int]
+    """ The counters of the QuadCode before and after the statement (the names of the temps and labels follow them). """
+    break_label: Optional[str]
+    """ The break label of the enclosing loop or switch, if the statement jumps to it. """
+
+def _break_label(code: QuadCode) -> Optional[str]:
+    try:
+        return code.label_scope.peek()
+    except IndexError:
+        return None
+
+class FragmentCache:
+    """
+    Replays the code of the statements visited before (see Stmt.visit), and records the code of the others,
+    while visiting a program. The fragments are kept on the statements themselves - so an AST node reused
+    by the next version of the source carries its code along, and a node replaced takes it away.
+    Only statements visited without semantic errors are recorded.
+    """
+    def __init__(self, program: Program) -> None:
+        self.declared: Set[str] = {name for declaration in program.declarations.declarations
+                                   for name in declaration.idlist}
+        """ The names the temps and labels skip (see QuadCode.newtemp). """
+        self.replayed = 0
+        self.visited = 0
+
+    def visit(self, stmt: Stmt, visit: Callable[[], bool]) -> bool:
+        """ Emits the code of a statement into the code being generated, replaying it if recorded. """
+        code = cpl_ast.code
+        if stmt.fragment is not None:
+            self._replay(code, stmt.fragment, stmt.lineno)
+            self.replayed += 1
+            return True
+        start, temp_counter, label_counter = len(code.code), code.temp_var_counter, code.label_counter
+        break_label = _break_label(code)
+        errors = len(cpl_ast.semantic_errors) if cpl_ast.semantic_errors is not None else 0
+        success = visit()
+        self.visited += 1
+        if success and (cpl_ast.semantic_errors is None or len(cpl_ast.semantic_errors) == errors):
+            instructions = code.code[start:]
+            new_labels = self._names(QuadCode.LABEL_PFX, label_counter, code.label_counter)
+            stmt.fragment = Fragment(
+                instructions, code.source_lines[start:], stmt.lineno,
+                [(name, code.symbols[name]) for name in
+                 self._names(QuadCode.TEMP_VAR_PFX, temp_counter, code.temp_var_counter)],
+                new_labels,
+                {name: code.labels[name] - start - 1 for name in new_labels if name in code.labels},
+                (temp_counter, code.temp_var_counter), (label_counter, code.label_counter),
+                break_label if any(instr[0] == QuadInstruction.JUMP and instr[1] == break_label
+                                   for instr in instructions) else None)
+        return success
+
+    def _names(self, prefix: str, first: int, last: int) -> List[str]:
+        """ Returns the names of the temps (or labels) created while the counter went from first to last. """
+        return [name for name in (f"{prefix}{i}" for i in range(first, last)) if name not in self.declared]
+
+    def _replay(self, code: QuadCode, fragment: Fragment, lineno: Optional[int]) -> None:
+        renames: Dict[str, str] = {}
+        if code.temp_var_counter == fragment.temp_counters[0]:
+            code.symbols.update(fragment.temps)
+            code.temp_var_counter = fragment.temp_counters[1]
+        else:
+            for name, dtype in fragment.temps:
+                renames[name] = code.newtemp(dtype)
+        if code.label_counter == fragment.label_counters[0]:
+            code.label_counter = fragment.label_counters[1]
+        else:
+            for name in fragment.new_labels:
+                renames[name] = code.newlabel()
+        if fragment.break_label is not None:
+            renames[fragment.break_label] = code.label_scope.peek()
+        renames = {name: new_name for name, new_name in renames.items() if name != new_name}
+
+        for name, line in fragment.labels.items():
+            code.labels[renames.get(name, name)] = code.code_lines + line
+        if renames:
+            code.code.extend(tuple(renames.get(arg, arg) for arg in instr) for instr in fragment.code)  # type: ignore
+        else:
+            code.code.extend(fragment.code)
+        shift = lineno - fragment.lineno if lineno is not None and fragment.lineno is not None else 0
+        if shift:
+            code.source_lines.extend(line + shift if line is not None else None for line in fragment.source_lines)
+        else:
+            code.source_lines.extend(fragment.source_lines)
+        code.code_lines += len(fragment.code)
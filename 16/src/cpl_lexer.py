@@ -5,14 +5,21 @@ The lexical values of the tokens are customized to support the AST generation us
 
 from __future__ import annotations
 
+from typing import Callable, Optional
+
 from consts import Dtype
 from consts import CplBinaryOp
 from sly import Lexer
 
+ErrorHandler = Callable[[Optional[int], str], None]
+""" Receives the source line (if known) and the message of each error found by the lexer or parser. """
+
 class CplLexer(Lexer):
-    def __init__(self):
+    def __init__(self, on_error: Optional[ErrorHandler] = None):
         super().__init__()
         self.lineno = 1
+        self.on_error = on_error
+        """ Reports lexical errors, instead of printing them (if set). """
 
     # type: ignore
     tokens = { NUM, IF, ELSE, WHILE, BREAK,
@@ -79,6 +86,10 @@ class CplLexer(Lexer):
     ID = r'[a-zA-Z_][a-zA-Z0-9_]*'
 
     def error(self, t):
-        print('Line %d: Bad character %r' % (self.lineno, t.value[0]))
+        message = 'Bad character %r' % t.value[0]
+        if self.on_error is not None:
+            self.on_error(self.lineno, message)
+        else:
+            print('Line %d: %s' % (self.lineno, message))
         self.index += 1
         super().error(t)
\ No newline at end of file
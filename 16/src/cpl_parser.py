@@ -4,14 +4,14 @@ which returns an Abstract Syntax Tree (AST) representation of the source code.
 """
 from __future__ import annotations
 
-from typing import List
+from typing import List, Optional
 
 from cpl_ast import Stmt
 
 from consts import CplBinaryOp
 
 from sly import Parser
-from cpl_lexer import CplLexer
+from cpl_lexer import CplLexer, ErrorHandler
 from consts import Dtype
 
 from cpl_ast import Program, BinaryOpExpression, BinaryOpExpression, Expression,\
@@ -22,6 +22,18 @@ class CplParser(Parser):
     tokens = CplLexer.tokens
     
     start = 'program'
+
+    def __init__(self, on_error: Optional[ErrorHandler] = None):
+        self.on_error = on_error
+        """ Reports syntax errors, instead of writing them to stderr (if set). """
+
+    def error(self, token):
+        if self.on_error is None:
+            return super().error(token)
+        if token:
+            self.on_error(getattr(token, 'lineno', None), f"Unexpected token {token.type}")
+        else:
+            self.on_error(None, "Unexpected end of input")
     
     @_('declarations stmt_block')
     def program(self, p):
@@ -36,7 +48,7 @@ class CplParser(Parser):
     
     @_('idlist ":" _type ";"')
     def declaration(self, p) -> Declaration:
-        return Declaration(p[0], p[2])
+        return Declaration(p[0], p[2]).at(p.lineno)
     
     @_('INT', 'FLOAT')
     def _type(self, p):
@@ -71,74 +83,78 @@ class CplParser(Parser):
     
     @_('ID "=" expression ";"')
     def assign_stmt(self, p) -> AssignStmt:
-        return AssignStmt(p[0], p[2])
+        return AssignStmt(p[0], p[2]).at(p.lineno)
     
     @_('INPUT "(" ID ")" ";"')
     def input_stmt(self, p) -> InputStmt:
-        return InputStmt(p[2])
+        return InputStmt(p[2]).at(p.lineno)
     
     @_('OUTPUT "(" expression ")" ";"')
     def output_stmt(self, p) -> OutputStmt:
-        return OutputStmt(p[2])
+        return OutputStmt(p[2]).at(p.lineno)
     
     @_('IF "(" boolexpr ")" stmt ELSE stmt')
     def if_stmt(self, p) -> IfStmt:
-        return IfStmt(p[2], p[4], p[6])
+        return IfStmt(p[2], p[4], p[6]).at(p.lineno)
 
     @_('WHILE "(" boolexpr ")" stmt')
     def while_stmt(self, p) -> WhileStmt:
-        return WhileStmt(p[2], p[4])
+        return WhileStmt(p[2], p[4]).at(p.lineno)
 
     @_('SWITCH "(" expression ")" "{" caselist DEFAULT ":" stmtlist "}"')
     def switch_stmt(self, p) -> SwitchStmt:
-        return SwitchStmt(p[2], p[5], p[8])
+        return SwitchStmt(p[2], p[5], p[8]).at(p.lineno)
     
-    @_('caselist CASE NUM ":" stmtlist', "")
+    @_('caselist case', "")
     def caselist(self, p) -> List[Case]:
         """ """
         if len(p) == 0:
             return []
-        return p[0] + [Case(p[2], p[4])]
+        return p[0] + [p[1]]
+
+    @_('CASE NUM ":" stmtlist')
+    def case(self, p) -> Case:
+        return Case(p[1], p[3]).at(p.lineno)
 
     @_('BREAK ";"')
     def break_stmt(self, p) -> BreakStmt:
         """ Break is a jump to the first label. Always. """
-        return BreakStmt()
+        return BreakStmt().at(p.lineno)
     
     @_("boolexpr OR boolterm", "boolterm")
     def boolexpr(self, p) -> Expression:
         if len(p) == 1:
             return p[0]
-        return BinaryOpExpression(p[0], p[2], CplBinaryOp.OR)
+        return BinaryOpExpression(p[0], p[2], CplBinaryOp.OR).at(p.lineno)
     
     @_('boolterm AND boolfactor', "boolfactor")
     def boolterm(self, p) -> Expression:
         if len(p) == 1:
             return p[0]
-        return BinaryOpExpression(p[0], p[2], CplBinaryOp.AND)
+        return BinaryOpExpression(p[0], p[2], CplBinaryOp.AND).at(p.lineno)
     
     @_('NOT "(" boolexpr ")"', "expression RELOP expression")
     def boolfactor(self, p) -> Expression:
         if len(p) == 4:
-            return NotBoolExpr(p[2])
-        return BinaryOpExpression(p[0], p[2], p[1])
+            return NotBoolExpr(p[2]).at(p.lineno)
+        return BinaryOpExpression(p[0], p[2], p[1]).at(p.lineno)
     
     @_('expression ADDOP term', 'term')
     def expression(self, p):
         if len(p) == 1:
             return p[0]
-        return BinaryOpExpression(p[0], p[2], p[1])
+        return BinaryOpExpression(p[0], p[2], p[1]).at(p.lineno)
     
     @_('term MULOP factor', 'factor')
     def term(self, p):
         if len(p) == 1:
             return p[0]
-        return BinaryOpExpression(p[0], p[2], p[1])
+        return BinaryOpExpression(p[0], p[2], p[1]).at(p.lineno)
     
     @_('"(" expression ")"', 'CAST "(" expression ")"', 'ID', 'NUM')
     def factor(self, p):
         if len(p) == 3:
             return p[1]
         if len(p) == 4:
-            return CastExpression(p[2], p[0])
+            return CastExpression(p[2], p[0]).at(p.lineno)
         return p[0] 
\ No newline at end of file
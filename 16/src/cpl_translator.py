@@ -0,0 +1,316 @@
+"""
+A Module containing a single-pass (syntax-directed) translator for the CPL language, using the SLY library.
+Unlike CplParser, no AST is built: the reduction actions emit the Quad code right away, and the
+parser returns the resulting QuadCode. The code emitted is identical to the code generated by
+visiting the AST (see cpl_ast), through the same helpers.
+Statements whose code is split around their children use marker non-terminals - prefixes of the
+statement, reduced right before the child is parsed - to emit the jumps and labels in between:
+    if_head     IF ( boolexpr )            JMPZ to the else branch
+    if_else     if_head stmt ELSE          JUMP past the else branch, else label
+    while_head  WHILE                      condition label
+    while_cond  while_head ( boolexpr )    JMPZ past the loop
+    switch_head SWITCH ( expression )      break label, switch expression type check
+    case_head   CASE NUM :                 the tail of the previous case, comparison to the case value
+    switch_default  switch_cases DEFAULT : the tail of the last case
+The tail of a case (a jump into the next case's statements, for fallthrough) depends on whether
+another case follows, so it is only emitted when the next case (or default) is reached.
+"""
+from __future__ import annotations
+
+import logging
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Tuple
+
+from sly import Parser
+
+from consts import CplBinaryOp, Dtype, QuadInstruction, QuadInstructionType, SemanticError
+from cpl_ast import declare, emit_binary_op, emit_cast
+from cpl_lexer import CplLexer, ErrorHandler
+from quad_code import INVALID, ArgumentType, QuadCode
+
+SemanticErrorHandler = Callable[[SemanticError], None]
+""" Receives each semantic error found by the translator. """
+
+@dataclass
+class _SwitchFrame:
+    """ The state of a switch statement being translated. """
+    source: ArgumentType
+    """ The switch expression, compared to each case value. """
+    case_end: Optional[str] = None
+    """ The label past the case being translated (if any), where the next comparison starts. """
+    case_line: Optional[int] = None
+
+class CplTranslator(Parser):
+    tokens = CplLexer.tokens
+
+    start = 'program'
+
+    def __init__(self, on_error: Optional[ErrorHandler] = None,
+                 on_semantic_error: Optional[SemanticErrorHandler] = None):
+        self.on_error = on_error
+        """ Reports syntax errors, instead of writing them to stderr (if set). """
+        self.on_semantic_error = on_semantic_error
+        """ Reports semantic errors, instead of logging them (if set). """
+        self.code = QuadCode()
+        self.success = True
+        """ Whether no semantic error was found by the last translation. """
+        self._switches: List[_SwitchFrame] = []
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+    def parse(self, tokens) -> Optional[QuadCode]:
+        """ Translates a CPL program. Returns its code, or None if parsing failed. """
+        self.code = QuadCode()
+        self.success = True
+        self._switches = []
+        return super().parse(tokens)
+
+    def error(self, token):
+        if self.on_error is None:
+            return super().error(token)
+        if token:
+            self.on_error(getattr(token, 'lineno', None), f"Unexpected token {token.type}")
+        else:
+            self.on_error(None, "Unexpected end of input")
+
+    def semantic_error(self, error: SemanticError, lineno: Optional[int]) -> None:
+        if error.lineno is None:
+            error.lineno = lineno
+        if self.on_semantic_error is not None:
+            self.on_semantic_error(error)
+        else:
+            self._logger.error(f"Semantic Error: {error}")
+        self.success = False
+
+    def at(self, lineno: Optional[int]) -> QuadCode:
+        """ Sets the source line of the instructions emitted next. Returns the code, for emitting them. """
+        self.code.source_line = lineno
+        return self.code
+
+    def emit_expression(self, lineno: int, emit: Callable[..., ArgumentType], *args) -> ArgumentType:
+        """
+        Emits the code of an expression by emit(code, *args), returning its result.
+        If that fails, reports the error - and the expression is INVALID (see quad_code.INVALID).
+        """
+        try:
+            return emit(self.at(lineno), *args)
+        except SemanticError as e:
+            self.semantic_error(e, lineno)
+            return INVALID
+
+    @_('declarations stmt_block')
+    def program(self, p):
+        self.at(None).emit(QuadInstruction.HALT)
+        return self.code
+
+    @_('declarations declaration', '')
+    def declarations(self, p):
+        pass
+
+    @_('idlist ":" _type ";"')
+    def declaration(self, p):
+        try:
+            declare(self.code, p[0], p[2])
+        except SemanticError as e:
+            self.semantic_error(e, p.lineno)
+
+    @_('INT', 'FLOAT')
+    def _type(self, p):
+        if p[0] == 'int':
+            return Dtype.INT
+        elif p[0] == 'float':
+            return Dtype.FLOAT
+        raise ValueError(f'Unknown type: {p[0]}')
+
+    @_('idlist "," ID')
+    def idlist(self, p) -> List[str]:
+        return p[0] + [p[2]]
+
+    @_('ID')
+    def idlist(self, p) -> List[str]:
+        return [p[0]]
+
+    @_('assign_stmt', 'input_stmt', 'output_stmt', 'if_stmt','while_stmt',
+       'switch_stmt', 'break_stmt', 'stmt_block')
+    def stmt(self, p):
+        pass
+
+    @_('"{" stmtlist "}"')
+    def stmt_block(self, p):
+        pass
+
+    @_('stmtlist stmt', '')
+    def stmtlist(self, p):
+        pass
+
+    @_('ID "=" expression ";"')
+    def assign_stmt(self, p):
+        try:
+            self.at(p.lineno).emit_op_dest(QuadInstructionType.ASN, p[0], p[2])
+        except SemanticError as e:
+            self.semantic_error(e, p.lineno)
+
+    @_('INPUT "(" ID ")" ";"')
+    def input_stmt(self, p):
+        try:
+            self.at(p.lineno).emit_op_dest(QuadInstructionType.INP, p[2])
+        except SemanticError as e:
+            self.semantic_error(e, p.lineno)
+
+    @_('OUTPUT "(" expression ")" ";"')
+    def output_stmt(self, p):
+        try:
+            self.at(p.lineno).emit_op_dest(QuadInstructionType.PRT, p[2])
+        except SemanticError as e:
+            self.semantic_error(e, p.lineno)
+
+    @_('IF "(" boolexpr ")"')
+    def if_head(self, p) -> Tuple[str, str, int]:
+        false_label = self.code.newlabel()
+        end_label = self.code.newlabel()
+        self.at(p.lineno).emit(QuadInstruction.JMPZ, false_label, p[2])
+        return false_label, end_label, p.lineno
+
+    @_('if_head stmt ELSE')
+    def if_else(self, p) -> Tuple[str, str, int]:
+        false_label, end_label, lineno = p[0]
+        self.at(lineno).emit(QuadInstruction.JUMP, end_label)
+        self.code.emitlabel(false_label)
+        return p[0]
+
+    @_('if_else stmt')
+    def if_stmt(self, p):
+        self.code.emitlabel(p[0][1])
+
+    @_('WHILE')
+    def while_head(self, p) -> Tuple[str, str, int]:
+        boolexp_label = self.code.newlabel()
+        exit_label = self.code.newlabel()
+        # For break.
+        self.code.label_scope.push(exit_label)
+        self.code.emitlabel(boolexp_label)
+        return boolexp_label, exit_label, p.lineno
+
+    @_('while_head "(" boolexpr ")"')
+    def while_cond(self, p) -> Tuple[str, str, int]:
+        _, exit_label, lineno = p[0]
+        self.at(lineno).emit(QuadInstruction.JMPZ, exit_label, p[2])
+        return p[0]
+
+    @_('while_cond stmt')
+    def while_stmt(self, p):
+        boolexp_label, exit_label, lineno = p[0]
+        self.at(lineno).emit(QuadInstruction.JUMP, boolexp_label)
+        self.code.emitlabel(exit_label)
+        self.code.label_scope.pop()
+
+    @_('SWITCH "(" expression ")"')
+    def switch_head(self, p):
+        # For break.
+        self.code.label_scope.push(self.code.newlabel())
+        source = p[2]
+        try:
+            if source != INVALID and self.code.get_type(source) != Dtype.INT:
+                self.semantic_error(SemanticError("Switch expression must be of type int, " +
+                                                  f"got {self.code.get_type(source)}."), p.lineno)
+        except SemanticError as e:
+            # An undeclared variable - the cases are still checked.
+            self.semantic_error(e, p.lineno)
+            source = INVALID
+        self._switches.append(_SwitchFrame(source))
+
+    @_('switch_head "{"', 'switch_cases case')
+    def switch_cases(self, p):
+        pass
+
+    @_('case_head stmtlist')
+    def case(self, p):
+        pass
+
+    def _end_case(self, fallthrough: bool) -> Optional[str]:
+        """
+        Emits the tail of the case being translated, if any: a jump into the statements of the next case
+        (if it falls through into one, and not into the default statements), and the label past the case.
+        Returns the label of the next case's statements.
+        """
+        frame = self._switches[-1]
+        if frame.case_end is None:
+            return None
+        next_label = None
+        if fallthrough:
+            next_label = self.code.newlabel()
+            self.at(frame.case_line).emit(QuadInstruction.JUMP, next_label)
+        self.code.emitlabel(frame.case_end)
+        return next_label
+
+    @_('CASE NUM ":"')
+    def case_head(self, p):
+        middle_label = self._end_case(fallthrough=True)
+        frame = self._switches[-1]
+        frame.case_end = self.code.newlabel()
+        frame.case_line = p.lineno
+        tmpname = self.at(p.lineno).emit_to_temp(QuadInstructionType.EQL, p[1], frame.source)
+
+        # Check if the case value is an integer
+        if not isinstance(p[1], int):
+            self.semantic_error(SemanticError(f"Case value must be an integer, got {p[1]}!"), p.lineno)
+
+        self.at(p.lineno).emit(QuadInstruction.JMPZ, frame.case_end, tmpname)
+        # Enabled Fallthrough from previous case (if exists)
+        if middle_label:
+            self.code.emitlabel(middle_label)
+
+    @_('switch_cases DEFAULT ":"')
+    def switch_default(self, p):
+        # Last case fallsthrough to default case - no jump to label needed!
+        self._end_case(fallthrough=False)
+        self._switches.pop()
+
+    @_('switch_default stmtlist "}"')
+    def switch_stmt(self, p):
+        self.code.emitlabel(self.code.label_scope.peek())
+        self.code.label_scope.pop()
+
+    @_('BREAK ";"')
+    def break_stmt(self, p):
+        try:
+            self.at(p.lineno).emit(QuadInstruction.JUMP, self.code.label_scope.peek())
+        except IndexError:
+            self.semantic_error(SemanticError("Break statement outside of loop or switch-case."), p.lineno)
+
+    @_("boolexpr OR boolterm", "boolterm")
+    def boolexpr(self, p) -> ArgumentType:
+        if len(p) == 1:
+            return p[0]
+        return self.emit_expression(p.lineno, emit_binary_op, CplBinaryOp.OR, p[0], p[2])
+
+    @_('boolterm AND boolfactor', "boolfactor")
+    def boolterm(self, p) -> ArgumentType:
+        if len(p) == 1:
+            return p[0]
+        return self.emit_expression(p.lineno, emit_binary_op, CplBinaryOp.AND, p[0], p[2])
+
+    @_('NOT "(" boolexpr ")"', "expression RELOP expression")
+    def boolfactor(self, p) -> ArgumentType:
+        if len(p) == 4:
+            return self.emit_expression(p.lineno, QuadCode.emit_to_temp, QuadInstructionType.EQL, p[2], 0)
+        return self.emit_expression(p.lineno, emit_binary_op, p[1], p[0], p[2])
+
+    @_('expression ADDOP term', 'term')
+    def expression(self, p) -> ArgumentType:
+        if len(p) == 1:
+            return p[0]
+        return self.emit_expression(p.lineno, emit_binary_op, p[1], p[0], p[2])
+
+    @_('term MULOP factor', 'factor')
+    def term(self, p) -> ArgumentType:
+        if len(p) == 1:
+            return p[0]
+        return self.emit_expression(p.lineno, emit_binary_op, p[1], p[0], p[2])
+
+    @_('"(" expression ")"', 'CAST "(" expression ")"', 'ID', 'NUM')
+    def factor(self, p) -> ArgumentType:
+        if len(p) == 3:
+            return p[1]
+        if len(p) == 4:
+            return self.emit_expression(p.lineno, emit_cast, p[2], p[0])
+        return p[0]
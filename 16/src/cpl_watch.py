@@ -0,0 +1,84 @@
+"""
+This module implements watching CPL source files for changes, by polling (no OS notification
+bindings are needed). A file is reported once its size and modification time stopped changing
+for the debounce period, and only if its content hash differs from the last one reported -
+so saving a file twice, or touching it, doesn't trigger a rebuild.
+"""
+from __future__ import annotations
+import hashlib
+import io
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+@dataclass
+class Change:
+    """ A changed source file, with its new content. """
+    path: Path
+    source: str
+    detected: float
+    """ When the change was first seen (time.monotonic()). """
+
+class SourceWatcher:
+    """ Polls a source file, or a directory tree of source files, for changes. """
+    def __init__(self, root: Path, pattern: str = '*.cpl', interval: float = 0.25, debounce: float = 0.1) -> None:
+        self.root = root
+        self.pattern = pattern
+        self.interval = interval
+        self.debounce = debounce
+        self._stats: Dict[Path, Tuple[int, int]] = {}
+        """ The size and modification time of each file, at the last poll. """
+        self._pending: Dict[Path, Tuple[float, float]] = {}
+        """ When each unsettled file was first and last seen changing. """
+        self._hashes: Dict[Path, bytes] = {}
+        """ The content hash of each file, when last reported. """
+
+    def _scan(self) -> Dict[Path, Tuple[int, int]]:
+        paths = [self.root] if self.root.is_file() else sorted(self.root.rglob(self.pattern))
+        stats = {}
+        for path in paths:
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            stats[path] = (stat.st_size, stat.st_mtime_ns)
+        return stats
+
+    def poll(self) -> List[Change]:
+        """ Returns the files changed since the last poll (all of them, on the first one) that settled down. """
+        now = time.monotonic()
+        stats = self._scan()
+        for path, stat in stats.items():
+            if self._stats.get(path) != stat:
+                self._pending[path] = (self._pending.get(path, (now, now))[0], now)
+        for path in self._stats.keys() - stats.keys():
+            self._pending.pop(path, None)
+            self._hashes.pop(path, None)
+        self._stats = stats
+
+        changes = []
+        for path, (first_seen, last_seen) in sorted(self._pending.items()):
+            if now - last_seen < self.debounce:
+                continue
+            del self._pending[path]
+            try:
+                data = path.read_bytes()
+            except OSError:
+                continue
+            digest = hashlib.blake2b(data, digest_size=16).digest()
+            if self._hashes.get(path) == digest:
+                continue
+            self._hashes[path] = digest
+            # Read like open(path, 'r') does, translating newlines.
+            source = io.StringIO(data.decode('utf-8', errors='replace'), newline=None).read()
+            changes.append(Change(path, source, first_seen))
+        return changes
+
+    def run(self, rebuild: Callable[[List[Change]], None]) -> None:
+        """ Polls forever (until interrupted), calling rebuild with each batch of changed files. """
+        while True:
+            changes = self.poll()
+            if changes:
+                rebuild(changes)
+            time.sleep(self.interval)
@@ -2,25 +2,145 @@
 Main entry point for the CPL to Quad compiler.
 """
 
+import functools
 import logging
+import sys
+import time
 from pathlib import Path
-from typing import Optional
+from typing import Dict, List, Optional
 
-import sly
-from cpl_parser import CplParser
-from cpl_lexer import CplLexer
-from cpl_ast import Program
-from argparse import ArgumentParser
+from cpl_compiler import Compiler, Stage
+from cpl_watch import Change, SourceWatcher
+from quad_binary import SUFFIX as BINARY_SUFFIX, write_binary
+from quad_optimize import PASSES
+from quad_profile import QuadProfile
+from quad_unroll import UNROLL_FACTOR, unroll_loops
+from argparse import ArgumentParser, Namespace
 
 STUDENT_NAME = "Aviv Naaman"
 
+logger = logging.getLogger()
+
+def build(compiler: Compiler, file_path: Path, source: str, args: Namespace,
+          profile: Optional[QuadProfile]) -> bool:
+    """ Compiles a source file and writes its output file next to it. Returns whether it succeeded. """
+    # Tokenize, parse and generate (optimized) code for the program.
+    passes = [functools.partial(unroll_loops, factor=args.unroll_factor) if name == 'unroll' else name
+              for name in args.opt]
+    try:
+        result = compiler.compile(source, passes, profile, extended=args.extended, explain=args.explain)
+    except Exception as e:
+        # A bug shouldn't take down --watch, which keeps building the other files (and this one's next versions).
+        logger.error("Compilation of %s failed due to an unexpected error: %r. Aborting." % (str(file_path), e))
+        return False
+    for diagnostic in result.diagnostics:
+        logger.error(str(diagnostic))
+    if result.failed_stage == Stage.LEXICAL:
+        logger.error("Lexical error found in source file. Aborting.")
+        return False
+    if result.failed_stage == Stage.SYNTAX:
+        logger.error("Parsing failed. Aborting. View output above for more information.")
+        return False
+    if not result.success or result.code is None:
+        logger.error("Compilation failed due to semantic error. Aborting. View output above for more information.")
+        return False
+
+    # Write final output file
+    try:
+        if args.binary:
+            write_binary(result.code, file_path.parent / (file_path.stem + BINARY_SUFFIX), STUDENT_NAME)
+        else:
+            result.code.write(file_path.parent / (file_path.stem + '.quad'), STUDENT_NAME)
+    except IOError:
+        logger.error("Compilation succeeded, but failed to write output file %s. Aborting." % str(file_path))
+        return False
+    if result.explanation:
+        print(result.explanation, file=sys.stderr)
+    return True
+
+def watch(root: Path, args: Namespace, profile: Optional[QuadProfile]) -> None:
+    """ Rebuilds the source files under root whenever their content changes, until interrupted. """
+    compiler = Compiler(single_pass=args.level == 0)
+    # An incremental compiler recompiles each file from its last version, so each file needs its own.
+    incremental: Dict[Path, Compiler] = {}
+
+    def compiler_for(path: Path) -> Compiler:
+        if not args.incremental:
+            return compiler
+        return incremental.setdefault(path, Compiler(incremental=True))
+
+    def rebuild(changes: List[Change]) -> None:
+        start = time.monotonic()
+        failed = [c.path.name for c in changes if not build(compiler_for(c.path), c.path, c.source, args, profile)]
+        end = time.monotonic()
+        logger.error("Rebuilt %d file(s)%s in %.1f ms (%.1f ms after the first change)" % (
+            len(changes), " (failed: %s)" % ", ".join(failed) if failed else "",
+            (end - start) * 1000, (end - min(c.detected for c in changes)) * 1000))
+
+    logger.error("Watching %s for changes. Press Ctrl+C to stop." % str(root))
+    try:
+        SourceWatcher(root, interval=args.interval, debounce=args.debounce).run(rebuild)
+    except KeyboardInterrupt:
+        pass
+
 if __name__ == '__main__':
-    logger = logging.getLogger()
-    
     arg_parser = ArgumentParser()
-    arg_parser.add_argument('file', metavar='f', help='Path to CPL source file to compile.')
+    arg_parser.add_argument('file', metavar='f',
+                            help='Path to CPL source file to compile (or directory to watch, see --watch).')
+    arg_parser.add_argument('-O', dest='level', type=int, choices=[0, 1], default=1,
+                            help='Front end: 0 emits the code while parsing, in a single pass without building ' +
+                            'the AST (faster, same output); 1 (default) builds the AST and visits it.')
+    arg_parser.add_argument('--opt', action='append', default=[], choices=list(PASSES),
+                            help='Optimization pass to run over the generated code (may be repeated).')
+    arg_parser.add_argument('--profile-data', metavar='PROFILE',
+                            help='Execution profile of the unoptimized code, to guide the optimizations ' +
+                            '(see quad_run.py --profile).')
+    arg_parser.add_argument('--unroll-factor', type=int, default=UNROLL_FACTOR,
+                            help='Number of copies of the body in loops unrolled by --opt unroll ' +
+                            '(default: %(default)s; 1 only unrolls the loops with a small constant trip count).')
+    arg_parser.add_argument('--extended', action='store_true',
+                            help='Keep the superinstructions in the output (see --opt fuse), ' +
+                            'instead of lowering them back into standard Quad code.')
+    arg_parser.add_argument('--binary', action='store_true',
+                            help='Write the binary Quad format (%s) instead of the text format.' % BINARY_SUFFIX)
+    arg_parser.add_argument('--verbose', action='store_true',
+                            help='Report what the optimization passes did (e.g. the simplification rule hits).')
+    arg_parser.add_argument('--watch', action='store_true',
+                            help='Keep running, and recompile the source file (or the source files under ' +
+                            'the directory) whenever its content changes.')
+    arg_parser.add_argument('--interval', type=float, default=0.25,
+                            help='Seconds between polls for changes, with --watch (default: %(default)s).')
+    arg_parser.add_argument('--debounce', type=float, default=0.1,
+                            help='Seconds a changed file must stay unchanged before it is recompiled, ' +
+                            'with --watch (default: %(default)s).')
+    arg_parser.add_argument('--incremental', action='store_true',
+                            help='With --watch, recompile only the statements enclosing the edits to a file ' +
+                            '(replaying the code generated for the others). Requires -O 1.')
+    arg_parser.add_argument('--explain', action='store_true',
+                            help='Report the estimated cost of the generated code: the source lines producing ' +
+                            'the most quads and casts, the costliest ones, and the cost of each construct.')
     args = arg_parser.parse_args()
+    if args.unroll_factor < 1:
+        arg_parser.error('the unroll factor must be positive')
+    if args.incremental and (not args.watch or args.level == 0):
+        arg_parser.error('--incremental requires --watch and -O 1')
     file_path = Path(args.file)
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    try:
+        profile = QuadProfile.load(args.profile_data) if args.opt and args.profile_data else None
+    except (IOError, ValueError, KeyError):
+        logger.error("Failed to load execution profile %s" % args.profile_data)
+        exit(1)
+
+    if args.watch:
+        if not file_path.exists():
+            logger.error("Failed to open source file or directory %s" % str(file_path))
+            exit(-1)
+        watch(file_path, args, profile)
+        exit(0)
+
     try:
         with open(file_path, 'r') as f:
             source = f.read()
@@ -29,39 +149,8 @@ if __name__ == '__main__':
         exit(-1)
     except Exception:
         raise
-    
-    # Tokenize + Parse
-    lexer = CplLexer()
-    parser = CplParser()
-    tokens = lexer.tokenize(source)
-    try:
-        prog: Optional[Program] = parser.parse(tokens)
-    # Sly can only catch a single lexical error.
-    except sly.lex.LexError as e:
-        logger.error("Lexical error found in source file. Aborting.")
-        exit(1)
-    except Exception as e:
-        logger.error(f"Unexpected error {e} occurred while parsing source file. Aborting.")
-        prog = None
-    
-    # Parse failed error - due to exception
-    if prog is None:
-        logger.error("Parsing failed. Aborting. View output above for more information.")
-        exit(1)
-
-    # To generate code for the program, visit the AST's nodes.
-    success = prog.visit()
-    
-    # Check if the program was successfully compiled.
-    if not success or prog.code is None:
-        logger.error("Compilation failed due to semantic error. Aborting. View output above for more information.")
-        exit(1)
 
-    # Write final output file
-    try:
-        prog.code.write(file_path.parent / (file_path.stem + '.quad'), STUDENT_NAME)
-    except IOError:
-        logger.error("Compilation succeeded, but failed to write output file %s. Aborting." % str(file_path))
+    if not build(Compiler(single_pass=args.level == 0), file_path, source, args, profile):
         exit(1)
 
     # Write student's name to stderr
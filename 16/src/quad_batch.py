@@ -0,0 +1,301 @@
+"""
+This module implements batch execution of resolved Quad code using NumPy:
+A single run executes the program over many input sets (lanes) at once.
+Each variable holds an array with a value per lane, and the lanes diverging on a JMPZ
+are tracked with masks - at each step, the lanes positioned at the lowest basic block
+execute it together, so lanes that took different branches reconverge at the labels
+where the branches meet.
+
+Each lane produces exactly the outputs of a scalar run (see quad_exec). The integers are 64 bit here,
+while the scalar backends use (unbounded) python integers: a lane reading an input, or computing an
+integer, which doesn't fit in 64 bits is stopped, and run again by the compiled scalar backend.
+"""
+from __future__ import annotations
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Set
+
+import numpy as np
+
+from consts import Dtype, QuadInstruction
+from quad_cfg import EXIT, ControlFlowGraph, Quad, defs
+from quad_code import ArgumentType, QuadCode
+from quad_exec import QuadRuntimeError, Value, compile_quad, sequence_input
+from quad_fusion import has_superinstructions, lower_superinstructions
+
+_UFUNCS = {
+    'EQL': np.equal,
+    'NQL': np.not_equal,
+    'LSS': np.less,
+    'GRT': np.greater,
+    'ADD': np.add,
+    'SUB': np.subtract,
+    'MLT': np.multiply,
+}
+
+_RELOPS = {'EQL', 'NQL', 'LSS', 'GRT'}
+
+_BINARY = {QuadInstruction[prefix + name] for prefix in 'IR' for name in list(_UFUNCS) + ['DIV']}
+
+_INT64 = np.iinfo(np.int64)
+
+_INT64_BOUND = 2.0 ** 63
+""" The magnitude of the floats too large to convert into a 64 bit integer. """
+
+def _fits(value: int) -> bool:
+    return _INT64.min <= value <= _INT64.max
+
+def _wrapped(name: str, a, b, result: np.ndarray) -> np.ndarray:
+    """ Returns where an integer operation wrapped around (or, for a multiplication, may have) in 64 bits. """
+    a, b = np.asarray(a, dtype=np.int64), np.asarray(b, dtype=np.int64)
+    if name == 'ADD':
+        return ((a ^ result) & (b ^ result)) < 0
+    if name == 'SUB':
+        return ((a ^ b) & (a ^ result)) < 0
+    if name == 'MLT':
+        # The product in floats is close enough to tell the ones which surely fit.
+        return np.abs(np.multiply(a, b, dtype=np.float64)) >= _INT64_BOUND / 2
+    # The division takes the absolute values, which wraps for the minimal integer.
+    return (a == _INT64.min) | (b == _INT64.min)
+
+@dataclass
+class BatchResult:
+    """ The result of a batch run: for each lane, its outputs, and its runtime error (if it failed). """
+    outputs: List[List[Value]]
+    errors: List[Optional[str]]
+
+class _BatchState:
+    """ The state of all the lanes of a batch run. """
+    def __init__(self, executor: BatchQuadExecutor, inputs: Sequence[Sequence[Value]]) -> None:
+        lanes = len(inputs)
+        self.variables: Dict[str, np.ndarray] = {
+            name: np.zeros(lanes, dtype=np.float64 if is_float else np.int64)
+            for name, is_float in executor.float_variables.items()
+        }
+        self.inputs = inputs
+        """ The input values of each lane, converted by the type of the input instruction reading them. """
+        self.input_lengths = np.array([len(values) for values in inputs], dtype=np.int64)
+        self.input_cursor = np.zeros(lanes, dtype=np.int64)
+        self.outputs: List[List[Value]] = [[] for _ in range(lanes)]
+        self.errors: List[Optional[str]] = [None] * lanes
+        self.block = np.zeros(lanes, dtype=np.int64)
+        self.scalar: Set[int] = set()
+        """ The lanes to run again by the scalar backend. """
+
+    def fail(self, lanes: np.ndarray, bad, message: str, done: int,
+             values: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Stops the lanes for which bad is set, with an error. Returns the remaining lanes.
+        If values are given, the message is formatted with each failing lane's value.
+        """
+        bad = np.broadcast_to(bad, lanes.shape)
+        if not bad.any():
+            return lanes
+        failed_values = values[bad].tolist() if values is not None else []
+        for i, lane in enumerate(lanes[bad].tolist()):
+            self.errors[lane] = message.format(failed_values[i]) if values is not None else message
+        self.block[lanes[bad]] = done
+        return lanes[~bad]
+
+    def fall_back(self, lanes: np.ndarray, bad, done: int) -> np.ndarray:
+        """ Stops the lanes for which bad is set, to be run again by the scalar backend. Returns the remaining lanes. """
+        bad = np.broadcast_to(bad, lanes.shape)
+        if not bad.any():
+            return lanes
+        self.scalar.update(lanes[bad].tolist())
+        self.block[lanes[bad]] = done
+        return lanes[~bad]
+
+class BatchQuadExecutor:
+    """ Executes resolved Quad code over many input sets (lanes) at once. """
+    def __init__(self, code: QuadCode) -> None:
+        # Superinstructions are not vectorized, so they are lowered back into standard Quad code.
+        if has_superinstructions(code):
+            code = lower_superinstructions(code)
+        self.code = code
+        self.graph = ControlFlowGraph.from_code(code)
+        self.blocks = self.graph.blocks
+        self._index = {b.id: i for i, b in enumerate(self.blocks)}
+        self._index[EXIT] = len(self.blocks)
+        self.float_variables = self._float_variables()
+        """ Whether each variable holds floats (rather than integers) in any lane. """
+        self.vectorized = all(_fits(arg) for b in self.blocks for instr in b.instructions
+                              for arg in instr[1:] if isinstance(arg, int))
+        """ Whether the literals fit in 64 bits - otherwise all the lanes are run by the scalar backend. """
+
+    def _is_float(self, arg: ArgumentType, float_variables: Dict[str, bool]) -> bool:
+        if isinstance(arg, str):
+            return float_variables.get(arg, False)
+        return isinstance(arg, float)
+
+    def _float_variables(self) -> Dict[str, bool]:
+        """
+        Infers which variables may hold a float at runtime. Like the scalar backends,
+        the type of a result follows its operands (not the declared type of the destination),
+        so a variable holding both integers and floats is stored as floats.
+        """
+        result = {name: dtype == Dtype.FLOAT for name, dtype in self.graph.code.symbols.items()}
+        changed = True
+        while changed:
+            changed = False
+            for block in self.blocks:
+                for instr in block.instructions:
+                    dest = defs(instr)
+                    if dest is None:
+                        continue
+                    op = instr[0]
+                    if op in (QuadInstruction.ITOR, QuadInstruction.RINP):
+                        is_float = True
+                    elif op in (QuadInstruction.RTOI, QuadInstruction.IINP) or op.name[1:] in _RELOPS:
+                        is_float = False
+                    else:
+                        is_float = any(self._is_float(a, result) for a in instr[2:] if a is not None)
+                    if is_float and not result.get(dest, False):
+                        changed = True
+                    result[dest] = result.get(dest, False) or is_float
+        for block in self.blocks:
+            for instr in block.instructions:
+                for arg in instr[1:]:
+                    if isinstance(arg, str):
+                        result.setdefault(arg, False)
+        return result
+
+    def _operand(self, state: _BatchState, arg: ArgumentType, lanes: np.ndarray):
+        return state.variables[arg][lanes] if isinstance(arg, str) else arg
+
+    def _execute(self, state: _BatchState, instr: Quad, lanes: np.ndarray) -> np.ndarray:
+        """ Executes a non-branch instruction over the given lanes. Returns the lanes still running. """
+        op, arg1, arg2, arg3 = instr
+        done = len(self.blocks)
+        if op in _BINARY:
+            a, b = self._operand(state, arg2, lanes), self._operand(state, arg3, lanes)  # type: ignore
+            name = op.name[1:]
+            if name == 'DIV':
+                kind = "Integer" if op == QuadInstruction.IDIV else "Real"
+                zero = np.broadcast_to(np.equal(b, 0), lanes.shape)
+                if zero.any():
+                    lanes = state.fail(lanes, zero, f"{kind} division by zero!", done)
+                    a = a[~zero] if np.ndim(a) else a
+                    b = b[~zero] if np.ndim(b) else b
+                    if lanes.size == 0:
+                        return lanes
+                if op == QuadInstruction.IDIV:
+                    quotient = np.floor_divide(np.abs(a), np.abs(b))
+                    result = np.where(np.not_equal(np.less(a, 0), np.less(b, 0)), -quotient, quotient)
+                else:
+                    result = np.true_divide(a, b)
+            elif name in _RELOPS:
+                result = _UFUNCS[name](a, b).astype(np.int64)
+            else:
+                with np.errstate(over='ignore'):
+                    result = _UFUNCS[name](a, b)
+            if name not in _RELOPS and np.asarray(result).dtype.kind == 'i':
+                wrapped = np.broadcast_to(_wrapped(name, a, b, result), lanes.shape)
+                if wrapped.any():
+                    lanes = state.fall_back(lanes, wrapped, done)
+                    result = np.broadcast_to(result, wrapped.shape)[~wrapped]
+            state.variables[arg1][lanes] = result  # type: ignore
+        elif op in (QuadInstruction.IASN, QuadInstruction.RASN):
+            state.variables[arg1][lanes] = self._operand(state, arg2, lanes)  # type: ignore
+        elif op == QuadInstruction.ITOR:
+            state.variables[arg1][lanes] = np.asarray(self._operand(state, arg2, lanes), dtype=np.float64)  # type: ignore
+        elif op == QuadInstruction.RTOI:
+            value = np.broadcast_to(np.asarray(self._operand(state, arg2, lanes), dtype=np.float64), lanes.shape)
+            invalid = ~np.isfinite(value)
+            if invalid.any():
+                lanes = state.fail(lanes, invalid, "Cannot convert {} to an integer!", done, value)
+                value = value[~invalid]
+            large = np.abs(value) >= _INT64_BOUND
+            if large.any():
+                lanes = state.fall_back(lanes, large, done)
+                value = value[~large]
+            state.variables[arg1][lanes] = np.trunc(value).astype(np.int64)  # type: ignore
+        elif op in (QuadInstruction.IINP, QuadInstruction.RINP):
+            lanes = state.fail(lanes, state.input_cursor[lanes] >= state.input_lengths[lanes], "Input exhausted!", done)
+            values, invalid = self._read(state, lanes, int if op == QuadInstruction.IINP else float)
+            lanes = state.fall_back(lanes, invalid, done)
+            state.variables[arg1][lanes] = values[~invalid]  # type: ignore
+            state.input_cursor[lanes] += 1
+        elif op in (QuadInstruction.IPRT, QuadInstruction.RPRT):
+            value = np.broadcast_to(self._operand(state, arg1, lanes), lanes.shape)  # type: ignore
+            if op == QuadInstruction.IPRT and value.dtype.kind == 'f':
+                fits = np.abs(value) < _INT64_BOUND
+                lanes = state.fall_back(lanes, ~fits, done)
+                value = value[fits]
+            value = value.astype(np.int64 if op == QuadInstruction.IPRT else np.float64)
+            for lane, v in zip(lanes.tolist(), value.tolist()):
+                state.outputs[lane].append(v)
+        else:
+            raise ValueError(f"Unsupported instruction {op.name} in batch execution!")
+        return lanes
+
+    @staticmethod
+    def _read(state: _BatchState, lanes: np.ndarray, convert: type):
+        """
+        Reads the next input value of each lane, converted to the type read. Returns the values,
+        and where they can't be converted (or don't fit in 64 bits) - which the scalar backend decides.
+        """
+        values = np.zeros(lanes.shape, dtype=np.int64 if convert is int else np.float64)
+        invalid = np.zeros(lanes.shape, dtype=bool)
+        for i, (lane, position) in enumerate(zip(lanes.tolist(), state.input_cursor[lanes].tolist())):
+            try:
+                value = convert(state.inputs[lane][position])
+            except (OverflowError, ValueError):
+                invalid[i] = True
+                continue
+            if convert is int and not _fits(value):
+                invalid[i] = True
+            else:
+                values[i] = value
+        return values, invalid
+
+    def run(self, inputs: Sequence[Sequence[Value]]) -> BatchResult:
+        """ Runs the code once per input set. Each input set is consumed in order by the input instructions. """
+        state = _BatchState(self, inputs)
+        if self.blocks and self.vectorized:
+            self._run(state)
+        elif self.blocks:
+            state.scalar.update(range(len(inputs)))
+        if state.scalar:
+            program = compile_quad(self.code)
+            for lane in sorted(state.scalar):
+                state.outputs[lane] = []
+                try:
+                    program.run(sequence_input(inputs[lane]), state.outputs[lane].append)
+                except QuadRuntimeError as e:
+                    state.errors[lane] = str(e)
+        return BatchResult(state.outputs, state.errors)
+
+    def _run(self, state: _BatchState) -> None:
+        """ Runs all the lanes together, until each of them halts, fails or falls back to the scalar backend. """
+        done = len(self.blocks)
+        while True:
+            running = state.block[state.block < done]
+            if running.size == 0:
+                break
+            current = int(running.min())
+            lanes = np.flatnonzero(state.block == current)
+            block = self.blocks[current]
+            body = block.instructions
+            terminator = body[-1][0] if body and body[-1][0] in (QuadInstruction.JUMP, QuadInstruction.JMPZ,
+                                                                 QuadInstruction.HALT) else None
+            for instr in (body[:-1] if terminator else body):
+                lanes = self._execute(state, instr, lanes)
+                if lanes.size == 0:
+                    break
+            if lanes.size == 0:
+                continue
+
+            fallthrough = self._index[block.fallthrough] if block.fallthrough is not None else done
+            if terminator == QuadInstruction.JMPZ:
+                condition = np.broadcast_to(self._operand(state, body[-1][2], lanes), lanes.shape)  # type: ignore
+                state.block[lanes] = np.where(condition == 0, self._index[body[-1][1]], fallthrough)  # type: ignore
+            elif terminator == QuadInstruction.JUMP:
+                state.block[lanes] = self._index[body[-1][1]]  # type: ignore
+            elif terminator == QuadInstruction.HALT:
+                state.block[lanes] = done
+            else:
+                state.block[lanes] = fallthrough
+
+def run_batch(code: QuadCode, inputs: Sequence[Sequence[Value]]) -> BatchResult:
+    """ Runs resolved Quad code over many input sets at once. """
+    return BatchQuadExecutor(code).run(inputs)
@@ -0,0 +1,249 @@
+"""
+This module implements a compact binary format of resolved Quad code, loaded without re-tokenizing.
+Layout (little endian):
+    header          magic, version, flags and the section sizes (see _HEADER)
+    name table      the data type of each name (0 if not in the symbol table), followed by the
+                    NUL separated UTF-8 names. The symbol table comes first, so unused symbols are kept.
+    constant pool   per constant: a kind byte and an 8 byte value (int64 or float64);
+                    integers too large for 64 bits index their decimal text in the name table.
+    instructions    per instruction: an opcode byte (its QuadInstruction or QuadSuperInstruction value)
+                    and 3 operand references (u16, or u32 if flagged). The top 2 bits of a reference
+                    tell whether the rest is a name index, a constant index or an immediate integer
+                    (small non-negative integers, such as jump targets, are not pooled);
+                    the all-ones reference stands for a missing operand.
+    source lines    runs of instructions sharing a source line (0 if unknown), as (line, count) pairs.
+    epilogue        the text written after the code (e.g. the student name), possibly empty.
+The loader unpacks the sections straight from a memoryview of the file, and the disassembler
+reproduces the exact text written by QuadCode.write().
+"""
+from __future__ import annotations
+import struct
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+from consts import Dtype, QuadInstruction, QuadSuperInstruction
+from quad_code import ArgumentType, QuadCode
+
+MAGIC = b"QUAD"
+VERSION = 1
+SUFFIX = ".qbin"
+""" File suffix of binary Quad code files. """
+
+_HEADER = struct.Struct("<4sBBIIIIII")
+""" magic, version, flags, #names, name table size, #constants, #instructions, #source line runs, epilogue size """
+
+_FLAG_WIDE = 1
+""" Operand references are 32 bit wide. """
+
+_REF_NAME, _REF_CONSTANT, _REF_IMMEDIATE = range(3)
+_IMMEDIATE_LIMIT = 1 << 14
+""" Integers in range(_IMMEDIATE_LIMIT) are stored in the operand reference itself. """
+
+_CONSTANT = struct.Struct("<Bq")
+_FLOAT_CONSTANT = struct.Struct("<Bd")
+_INSTRUCTIONS = {False: struct.Struct("<BHHH"), True: struct.Struct("<BIII")}
+_SOURCE_LINE_RUN = struct.Struct("<IH")
+
+_CONST_INT, _CONST_FLOAT, _CONST_BIGINT = range(3)
+_DTYPE_CODES = {None: 0, Dtype.INT: 1, Dtype.FLOAT: 2}
+_DTYPES = {code: dtype for dtype, code in _DTYPE_CODES.items()}
+_OPCODES = {op.value: op for op in (*QuadInstruction, *QuadSuperInstruction)}
+_INT64_RANGE = range(-2 ** 63, 2 ** 63)
+
+class _Pools:
+    """ Interns the names and constants of the code being serialized. """
+    def __init__(self, symbols: Dict[str, Dtype]) -> None:
+        self.names: Dict[str, int] = {}
+        self.constants: Dict[Tuple[type, ArgumentType], int] = {}
+        for name in symbols:
+            self.name(name)
+
+    def name(self, name: str) -> int:
+        return self.names.setdefault(name, len(self.names))
+
+    def constant(self, value: Union[int, float]) -> int:
+        # Keyed by type as well, since 1 == 1.0 (and they are written differently).
+        return self.constants.setdefault((type(value), value), len(self.constants))
+
+def dumps(code: QuadCode, epilogue: Optional[str] = None, source_lines: bool = True) -> bytes:
+    """ Serializes resolved Quad code (labels are applied first) into the binary format. """
+    code.apply_labels()
+    pools = _Pools(code.symbols)
+    references: List[Tuple[Optional[Tuple[int, int]], ...]] = []
+    for instr in code.code:
+        operands: List[Optional[Tuple[int, int]]] = []
+        for arg in instr[1:]:
+            if arg is None:
+                operands.append(None)
+            elif isinstance(arg, str):
+                operands.append((_REF_NAME, pools.name(arg)))
+            elif isinstance(arg, int) and 0 <= arg < _IMMEDIATE_LIMIT:
+                operands.append((_REF_IMMEDIATE, arg))
+            else:
+                operands.append((_REF_CONSTANT, pools.constant(arg)))
+        references.append(tuple(operands))
+
+    constant_records = []
+    for (kind, value) in pools.constants:
+        if kind is float:
+            constant_records.append(_FLOAT_CONSTANT.pack(_CONST_FLOAT, value))
+        elif value in _INT64_RANGE:
+            constant_records.append(_CONSTANT.pack(_CONST_INT, value))
+        else:
+            constant_records.append(_CONSTANT.pack(_CONST_BIGINT, pools.name(str(value))))
+
+    wide = max(len(pools.names), len(pools.constants)) >= _IMMEDIATE_LIMIT - 1
+    shift = 30 if wide else 14
+    missing = (1 << (shift + 2)) - 1
+    epilogue_bytes = (epilogue or "").encode('utf-8')
+    name_types = bytes(_DTYPE_CODES[code.symbols.get(name)] for name in pools.names)
+    name_table = "\0".join(pools.names).encode('utf-8')
+
+    runs: List[List[int]] = []
+    if source_lines:
+        for line in code.source_lines:
+            if runs and runs[-1][0] == (line or 0) and runs[-1][1] < 0xFFFF:
+                runs[-1][1] += 1
+            else:
+                runs.append([line or 0, 1])
+        if all(line == 0 for line, _ in runs):
+            runs = []
+
+    parts = [_HEADER.pack(MAGIC, VERSION, _FLAG_WIDE if wide else 0, len(pools.names), len(name_table),
+                          len(pools.constants), len(code.code), len(runs), len(epilogue_bytes)),
+             name_types, name_table]
+    parts += constant_records
+    record = _INSTRUCTIONS[wide]
+    for instr, operands in zip(code.code, references):
+        parts.append(record.pack(instr[0].value, *(
+            missing if ref is None else ref[0] << shift | ref[1] for ref in operands)))
+    parts += [_SOURCE_LINE_RUN.pack(line, count) for line, count in runs]
+    parts.append(epilogue_bytes)
+    return b"".join(parts)
+
+class _OperandLookup(dict):
+    """ Maps operand references to their values. Immediates are decoded (and cached) on first use. """
+    def __init__(self, shift: int) -> None:
+        super().__init__()
+        self.shift = shift
+        self[(1 << (shift + 2)) - 1] = None
+
+    def __missing__(self, ref: int) -> int:
+        if ref >> self.shift != _REF_IMMEDIATE:
+            raise KeyError(ref)
+        value = self[ref] = ref & ((1 << self.shift) - 1)
+        return value
+
+class BinaryQuadReader:
+    """ Reads the sections of binary Quad code from a buffer, without copying it. """
+    def __init__(self, data: Union[bytes, bytearray, memoryview]) -> None:
+        self.data = memoryview(data)
+        if len(self.data) < _HEADER.size:
+            raise ValueError("Truncated binary Quad code!")
+        magic, version, self.flags, self.name_count, self.name_table_size, self.constant_count, \
+            self.instruction_count, self.line_run_count, self.epilogue_size = _HEADER.unpack_from(self.data)
+        if magic != MAGIC:
+            raise ValueError("Not a binary Quad code file!")
+        if version != VERSION:
+            raise ValueError(f"Unsupported binary Quad code version {version}!")
+        self.wide = bool(self.flags & _FLAG_WIDE)
+        self.offset = _HEADER.size
+
+    def _take(self, size: int) -> memoryview:
+        """ Returns the next size bytes of the buffer. """
+        if self.offset + size > len(self.data):
+            raise ValueError("Truncated binary Quad code!")
+        view = self.data[self.offset:self.offset + size]
+        self.offset += size
+        return view
+
+    def names(self) -> Tuple[List[str], Dict[str, Dtype]]:
+        """ Reads the name table. Returns the names, and the symbol table. """
+        types = self._take(self.name_count)
+        table = str(self._take(self.name_table_size), 'utf-8')
+        names = table.split("\0") if self.name_count else []
+        if len(names) != self.name_count:
+            raise ValueError("Corrupt name table in binary Quad code!")
+        symbols = {name: _DTYPES[code] for name, code in zip(names, types) if _DTYPES.get(code) is not None}
+        return names, symbols
+
+    def constants(self, names: List[str]) -> List[Union[int, float]]:
+        """ Reads the constant pool. """
+        result: List[Union[int, float]] = []
+        section = self._take(_CONSTANT.size * self.constant_count)
+        for offset in range(0, len(section), _CONSTANT.size):
+            kind = section[offset]
+            if kind == _CONST_FLOAT:
+                result.append(_FLOAT_CONSTANT.unpack_from(section, offset)[1])
+            elif kind == _CONST_BIGINT:
+                result.append(int(names[_CONSTANT.unpack_from(section, offset)[1]]))
+            elif kind == _CONST_INT:
+                result.append(_CONSTANT.unpack_from(section, offset)[1])
+            else:
+                raise ValueError(f"Invalid constant kind {kind} in binary Quad code!")
+        return result
+
+    def instructions(self, operands: List[ArgumentType]) -> List[Tuple]:
+        """ Reads the instructions, given the values of the operand references (names, then constants). """
+        record = _INSTRUCTIONS[self.wide]
+        lookup = _OperandLookup(30 if self.wide else 14)
+        lookup.update(enumerate(operands[:self.name_count]))
+        lookup.update((_REF_CONSTANT << lookup.shift | i, value) for i, value in enumerate(operands[self.name_count:]))
+        try:
+            return [(_OPCODES[op], lookup[a], lookup[b], lookup[c])
+                    for op, a, b, c in record.iter_unpack(self._take(record.size * self.instruction_count))]
+        except KeyError as e:
+            raise ValueError(f"Invalid opcode or operand reference {e} in binary Quad code!")
+
+    def source_lines(self) -> List[Optional[int]]:
+        if not self.line_run_count:
+            return [None] * self.instruction_count
+        result: List[Optional[int]] = []
+        for line, count in _SOURCE_LINE_RUN.iter_unpack(self._take(_SOURCE_LINE_RUN.size * self.line_run_count)):
+            result += [line or None] * count
+        if len(result) != self.instruction_count:
+            raise ValueError("Corrupt source lines in binary Quad code!")
+        return result
+
+    def epilogue(self) -> Optional[str]:
+        return str(self._take(self.epilogue_size), 'utf-8') if self.epilogue_size else None
+
+    def read(self) -> Tuple[QuadCode, Optional[str]]:
+        """ Reads the whole buffer. Returns the code, and the epilogue (if any). """
+        names, symbols = self.names()
+        constants = self.constants(names)
+        code = QuadCode()
+        code.symbols = symbols
+        code.code = self.instructions(names + constants)  # type: ignore
+        code.code_lines = len(code.code) + 1
+        code.source_lines = self.source_lines()
+        return code, self.epilogue()
+
+def loads(data: Union[bytes, bytearray, memoryview]) -> QuadCode:
+    """ Deserializes binary Quad code into a resolved QuadCode. """
+    return BinaryQuadReader(data).read()[0]
+
+def disassemble(data: Union[bytes, bytearray, memoryview]) -> str:
+    """ Returns the text format of binary Quad code, exactly as QuadCode.write() writes it. """
+    code, epilogue = BinaryQuadReader(data).read()
+    return "".join(line + '\n' for line in code.text_lines()) + (epilogue or "")
+
+def write_binary(code: QuadCode, dest: Union[str, Path], epilogue: Optional[str] = None) -> None:
+    """ Writes resolved Quad code to a binary file. """
+    with open(dest, 'wb') as output_file:
+        output_file.write(dumps(code, epilogue))
+
+def read_binary(src: Union[str, Path]) -> QuadCode:
+    """ Reads a binary Quad code file, as written by write_binary(). """
+    with open(src, 'rb') as input_file:
+        return loads(input_file.read())
+
+if __name__ == '__main__':
+    import sys
+    from argparse import ArgumentParser
+
+    arg_parser = ArgumentParser(description='Disassemble a binary Quad code file into the text format.')
+    arg_parser.add_argument('file', metavar='f', help='Path to binary Quad code file.')
+    args = arg_parser.parse_args()
+    with open(args.file, 'rb') as f:
+        sys.stdout.write(disassemble(f.read()))
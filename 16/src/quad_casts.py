@@ -0,0 +1,100 @@
+"""
+This module implements the redundant conversion elimination pass over resolved Quad code.
+An ITOR is emitted into a new temp whenever an integer meets a float context (see QuadCode.auto_cast),
+so a variable used in several float expressions is converted again for each of them. Within each
+basic block, this pass reuses the result of an earlier ITOR of the same variable (until either of
+them is reassigned), and folds ITORs of integer literals into float constants.
+"""
+from typing import Dict, List, Optional, Tuple
+
+from consts import QuadInstruction
+from quad_cfg import BasicBlock, ControlFlowGraph, Quad, defs, rename_sources, uses
+from quad_code import ArgumentType, QuadCode
+from quad_profile import QuadProfile
+
+Position = Tuple[int, int]
+""" The id of a block, and the index of an instruction within it. """
+
+class ConversionElimination:
+    """ Performs the redundant conversion elimination pass over a single CFG. """
+    def __init__(self, graph: ControlFlowGraph) -> None:
+        self.graph = graph
+        self.reused = 0
+        self.folded = 0
+        self._definitions: Dict[str, int] = {}
+        self._uses: Dict[str, List[Position]] = {}
+        for block in graph:
+            for i, instr in enumerate(block.instructions):
+                dest = defs(instr)
+                if dest is not None:
+                    self._definitions[dest] = self._definitions.get(dest, 0) + 1
+                for name in uses(instr):
+                    self._uses.setdefault(name, []).append((block.id, i))
+
+    def _local_uses(self, temp: str, block_id: int, index: int) -> Optional[List[int]]:
+        """
+        Returns the indices of the uses of a temp defined (only) at the index'th instruction of a block,
+        if they are all later in the same block - so its value may be replaced at each of them.
+        """
+        if self._definitions.get(temp) != 1:
+            return None
+        positions = self._uses.get(temp, [])
+        if any(b != block_id or i <= index for b, i in positions):
+            return None
+        return [i for _, i in positions]
+
+    @staticmethod
+    def _literal(value: int) -> Optional[float]:
+        try:
+            return float(value)
+        except OverflowError:
+            return None
+
+    def run_block(self, block: BasicBlock) -> None:
+        # The temps holding the conversion of each variable, as long as both are unchanged.
+        available: Dict[str, str] = {}
+        replacements: Dict[str, ArgumentType] = {}
+        instructions = block.instructions
+        result: List[Quad] = []
+        lines: List[Optional[int]] = []
+        for i, (instr, line) in enumerate(zip(instructions, block.lines)):
+            instr = rename_sources(instr, replacements)
+            op, dest, source, _ = instr
+            if op == QuadInstruction.ITOR and isinstance(dest, str):
+                local_uses = self._local_uses(dest, block.id, i)
+                if isinstance(source, int):
+                    literal = self._literal(source)
+                    if literal is not None:
+                        if local_uses is not None:
+                            replacements[dest] = literal
+                            self.folded += 1
+                            continue
+                        instr = (QuadInstruction.RASN, dest, literal, None)
+                        self.folded += 1
+                elif isinstance(source, str) and source in available:
+                    previous = available[source]
+                    # The previous temp must keep its value up to the last use of this one.
+                    redefined = next((j for j in range(i + 1, len(instructions))
+                                      if defs(instructions[j]) == previous), len(instructions))
+                    if local_uses is not None and all(j <= redefined for j in local_uses):
+                        replacements[dest] = previous
+                        self.reused += 1
+                        continue
+
+            dest = defs(instr)
+            if dest is not None:
+                available = {s: t for s, t in available.items() if dest not in (s, t)}
+                if instr[0] == QuadInstruction.ITOR and isinstance(instr[2], str) and instr[2] != dest:
+                    available[instr[2]] = dest  # type: ignore
+            result.append(instr)
+            lines.append(line)
+        block.instructions, block.lines = result, lines
+
+    def run(self) -> ControlFlowGraph:
+        for block in self.graph:
+            self.run_block(block)
+        return self.graph
+
+def eliminate_conversions(code: QuadCode, profile: Optional[QuadProfile] = None) -> QuadCode:
+    """ Runs the redundant conversion elimination pass over resolved Quad code. The profile is unused. """
+    return ConversionElimination(ControlFlowGraph.from_code(code)).run().to_code()
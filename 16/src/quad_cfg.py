@@ -0,0 +1,238 @@
+"""
+This module implements a Control Flow Graph (CFG) representation of resolved Quad code.
+The code is split into basic blocks - straight-line sequences of instructions with a single
+entry (the first instruction) and a single exit (the last instruction). It is used by the
+execution backends and by the optimization passes, which may edit the blocks and then
+linearize the graph back into Quad code.
+"""
+from __future__ import annotations
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+from consts import QuadInstruction, QuadSuperInstruction
+from quad_code import ArgumentType, QuadCode
+
+Opcode = Union[QuadInstruction, QuadSuperInstruction]
+Quad = Tuple[Opcode, Optional[ArgumentType], Optional[ArgumentType], Optional[ArgumentType]]
+
+EXIT = -1
+""" Block id of the (virtual) block past the end of the code. Reaching it ends the program. """
+
+class OperandLayout(NamedTuple):
+    """ Describes the role of each argument slot (1-3) of an instruction. """
+    dest: Optional[int]
+    sources: Tuple[int, ...]
+    target: Optional[int] = None
+
+_DEST_LAYOUT = OperandLayout(1, (2, 3))
+
+_COMPARE_BRANCHES = {op for op in QuadSuperInstruction if op.name.startswith('JZ')}
+
+LAYOUTS: Dict[Opcode, OperandLayout] = {
+    QuadInstruction.IPRT: OperandLayout(None, (1,)),
+    QuadInstruction.RPRT: OperandLayout(None, (1,)),
+    QuadInstruction.IINP: OperandLayout(1, ()),
+    QuadInstruction.RINP: OperandLayout(1, ()),
+    QuadInstruction.JUMP: OperandLayout(None, (), 1),
+    QuadInstruction.JMPZ: OperandLayout(None, (2,), 1),
+    QuadInstruction.HALT: OperandLayout(None, ()),
+    **{op: OperandLayout(None, (2, 3), 1) for op in _COMPARE_BRANCHES},
+}
+""" Operand layouts of instructions; Any instruction not listed here is of the form OP dest src1 [src2]. """
+
+CONDITIONAL_BRANCHES = {QuadInstruction.JMPZ, *_COMPARE_BRANCHES}
+""" Branches either jumping to their target or falling through, depending on their sources. """
+
+BRANCHES = {QuadInstruction.JUMP, *CONDITIONAL_BRANCHES}
+""" Instructions transferring control to the line number (block id, in a CFG) in their target slot. """
+
+TERMINATORS = {QuadInstruction.JUMP, QuadInstruction.HALT}
+""" Instructions never falling through to the next line. """
+
+def layout(op: Opcode) -> OperandLayout:
+    """ Returns the operand layout of an instruction. """
+    return LAYOUTS.get(op, _DEST_LAYOUT)
+
+def defs(instr: Quad) -> Optional[str]:
+    """ Returns the variable assigned by an instruction, if any. """
+    dest = layout(instr[0]).dest
+    return instr[dest] if dest is not None else None  # type: ignore
+
+def uses(instr: Quad) -> List[str]:
+    """ Returns the variables read by an instruction, in argument order. """
+    return [instr[i] for i in layout(instr[0]).sources if isinstance(instr[i], str)]  # type: ignore
+
+def target(instr: Quad) -> Optional[int]:
+    """ Returns the jump target of a branch instruction, or None for other instructions. """
+    slot = layout(instr[0]).target
+    return instr[slot] if slot is not None else None  # type: ignore
+
+def retarget(instr: Quad, new_target: int) -> Quad:
+    """ Returns a copy of a branch instruction jumping to new_target. """
+    slot = layout(instr[0]).target
+    assert slot is not None, f"{instr[0].name} is not a branch!"
+    updated = list(instr)
+    updated[slot] = new_target
+    return tuple(updated)  # type: ignore
+
+def rename_sources(instr: Quad, mapping: Dict[str, ArgumentType]) -> Quad:
+    """ Returns a copy of an instruction with the variables it reads replaced according to mapping. """
+    updated = list(instr)
+    for i in layout(instr[0]).sources:
+        if isinstance(updated[i], str) and updated[i] in mapping:
+            updated[i] = mapping[updated[i]]
+    return tuple(updated)  # type: ignore
+
+@dataclass
+class BasicBlock:
+    """
+    A basic block of Quad instructions.
+    Within a CFG, the targets of branch instructions are block ids rather than line numbers.
+    """
+    id: int
+    instructions: List[Quad] = field(default_factory=list)
+    lines: List[Optional[int]] = field(default_factory=list)
+    """ The source line of each instruction (see QuadCode.source_lines). """
+    fallthrough: Optional[int] = None
+    """ The block executed after the last instruction, if it does not always jump away. """
+    start: Optional[int] = None
+    """ The line of the first instruction in the code the graph was built from (None for new blocks). """
+
+    def successors(self) -> List[int]:
+        """ Returns the ids of the blocks control may pass to after this block. """
+        result = [t for t in (target(i) for i in self.instructions[-1:]) if t is not None]
+        if self.fallthrough is not None and self.fallthrough not in result:
+            result.append(self.fallthrough)
+        return result
+
+class ControlFlowGraph:
+    """
+    A graph of basic blocks, stored in layout order (the order in which they are emitted).
+    The first block is always the entry block.
+    """
+    def __init__(self, code: QuadCode, blocks: List[BasicBlock]) -> None:
+        self.code = code
+        """ Holds the symbol table and temp/label counters of the code (used to allocate new temps). """
+        self.blocks = blocks
+        self._next_id = max((b.id for b in blocks), default=-1) + 1
+
+    @classmethod
+    def from_code(cls, code: QuadCode) -> ControlFlowGraph:
+        """ Builds the CFG of a QuadCode. Labels are resolved first, if they were not yet. """
+        code.apply_labels()
+        instructions: List[Quad] = code.code
+        count = len(instructions)
+
+        # Find the leaders - the first lines of each block.
+        leaders = {1}
+        for line, instr in enumerate(instructions, 1):
+            if instr[0] in BRANCHES or instr[0] in TERMINATORS:
+                leaders.add(line + 1)
+            jump_target = target(instr)
+            if jump_target is not None:
+                if not isinstance(jump_target, int) or not 1 <= jump_target <= count + 1:
+                    raise ValueError(f"Invalid jump target {jump_target} at line {line}!")
+                leaders.add(jump_target)
+        starts = sorted(l for l in leaders if l <= count)
+        block_of_line = {l: i for i, l in enumerate(starts)}
+        block_of_line[count + 1] = EXIT
+
+        blocks = []
+        for i, begin in enumerate(starts):
+            end = starts[i + 1] if i + 1 < len(starts) else count + 1
+            body = [retarget(instr, block_of_line[target(instr)]) if target(instr) is not None else instr  # type: ignore
+                    for instr in instructions[begin - 1:end - 1]]
+            fallthrough = None if body[-1][0] in TERMINATORS else block_of_line[end]
+            lines = list(code.source_lines[begin - 1:end - 1])
+            lines += [None] * (len(body) - len(lines))
+            blocks.append(BasicBlock(i, body, lines, fallthrough, begin))
+
+        graph_code = QuadCode()
+        graph_code.symbols = dict(code.symbols)
+        graph_code.temp_var_counter = code.temp_var_counter
+        graph_code.label_counter = code.label_counter
+        return cls(graph_code, blocks)
+
+    def __iter__(self) -> Iterator[BasicBlock]:
+        return iter(self.blocks)
+
+    def block_map(self) -> Dict[int, BasicBlock]:
+        """ Returns a mapping from block id to block. """
+        return {b.id: b for b in self.blocks}
+
+    def new_block(self, instructions: Optional[List[Quad]] = None,
+                  lines: Optional[List[Optional[int]]] = None,
+                  fallthrough: Optional[int] = None) -> BasicBlock:
+        """ Creates a new block with a fresh id. The block is not added to the layout. """
+        block_id = self._next_id
+        self._next_id += 1
+        instructions = instructions or []
+        return BasicBlock(block_id, instructions, lines or [None] * len(instructions), fallthrough)
+
+    def predecessors(self) -> Dict[int, List[int]]:
+        """ Returns a mapping from block id to the ids of its predecessors. """
+        result: Dict[int, List[int]] = {b.id: [] for b in self.blocks}
+        for b in self.blocks:
+            for s in b.successors():
+                if s != EXIT:
+                    result[s].append(b.id)
+        return result
+
+    def use_counts(self) -> Dict[str, int]:
+        """ Returns the number of instructions reading each variable (counting repeated reads). """
+        counts: Dict[str, int] = {}
+        for block in self.blocks:
+            for instr in block.instructions:
+                for name in uses(instr):
+                    counts[name] = counts.get(name, 0) + 1
+        return counts
+
+    def reachable(self) -> List[int]:
+        """ Returns the ids of all the blocks reachable from the entry block, in DFS pre-order. """
+        blocks = self.block_map()
+        seen: List[int] = []
+        visited = set()
+        stack = [self.blocks[0].id]
+        while stack:
+            block_id = stack.pop()
+            if block_id in visited or block_id == EXIT:
+                continue
+            visited.add(block_id)
+            seen.append(block_id)
+            stack.extend(reversed(blocks[block_id].successors()))
+        return seen
+
+    def to_code(self) -> QuadCode:
+        """
+        Linearizes the graph back into resolved Quad code, in layout order.
+        A JUMP is added wherever a block's fall-through successor is not laid out right after it.
+        """
+        emitted: List[List[Quad]] = []
+        source_lines: List[Optional[int]] = []
+        for i, block in enumerate(self.blocks):
+            body = list(block.instructions)
+            source_lines += block.lines[:len(body)] + [None] * (len(body) - len(block.lines))
+            next_id = self.blocks[i + 1].id if i + 1 < len(self.blocks) else EXIT
+            if block.fallthrough is not None and block.fallthrough != next_id:
+                body.append((QuadInstruction.HALT, None, None, None) if block.fallthrough == EXIT else
+                            (QuadInstruction.JUMP, block.fallthrough, None, None))
+                source_lines.append(block.lines[-1] if block.lines else None)
+            emitted.append(body)
+
+        starts: Dict[int, int] = {}
+        line = 1
+        for block, body in zip(self.blocks, emitted):
+            starts[block.id] = line
+            line += len(body)
+        starts[EXIT] = line
+
+        result = QuadCode()
+        result.symbols = dict(self.code.symbols)
+        result.temp_var_counter = self.code.temp_var_counter
+        result.label_counter = self.code.label_counter
+        for body in emitted:
+            for instr in body:
+                jump_target = target(instr)
+                result.emit(*(retarget(instr, starts[jump_target]) if jump_target is not None else instr))
+        result.source_lines = source_lines
+        return result
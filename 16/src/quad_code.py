@@ -2,12 +2,24 @@
 This module implements the final code generation from CPL to Quad,
 And is used by the AST nodes to generate the final code.
 """
+from __future__ import annotations
+import re
 from pathlib import Path
 from typing import Dict, List, Optional, Tuple, Union
 
-from consts import QuadInstruction, QuadInstructionType, Dtype, SemanticError
+from consts import QuadInstruction, QuadInstructionType, QuadSuperInstruction, Dtype, SemanticError
 
 ArgumentType = Union[str, int, float]
+
+INVALID = "<invalid>"
+"""
+Stands for the value of an expression whose semantic analysis failed (the error was already reported).
+Operations over it emit nothing and give INVALID themselves, so one error isn't reported again by each
+expression and statement using it.
+"""
+
+_NUMBER_TYPES: Dict[type, Dtype] = {int: Dtype.INT, float: Dtype.FLOAT}
+
 class BreakLabelScope:
     """ 
     This class helps managing the stack of break statement jump-outside labels.
@@ -43,6 +55,10 @@ class QuadCode:
     def __init__(self) -> None:
         self.code: List[Tuple] = []
         self.code_lines = 1
+        self.source_lines: List[Optional[int]] = []
+        """ The source line each instruction was emitted for (None if unknown). """
+        self.source_line: Optional[int] = None
+        """ The source line of the instructions being emitted. """
         self.labels: Dict[str, int] = {}
         self.symbols: Dict[str, Dtype] = {}
         self.temp_var_counter = 1
@@ -75,7 +91,7 @@ class QuadCode:
             raise Exception(f"Label {label} re-emitted!")
         self.labels[label] = self.code_lines
     
-    def emit(self, op: QuadInstruction,
+    def emit(self, op: Union[QuadInstruction, QuadSuperInstruction],
              arg1: Optional[ArgumentType] = None,
              arg2: Optional[ArgumentType] = None,
              arg3: Optional[ArgumentType] = None) -> None:
@@ -83,6 +99,7 @@ class QuadCode:
         This method adds a code line to the QUAD output code.
         """
         self.code.append((op, arg1, arg2, arg3))
+        self.source_lines.append(self.source_line)
         self.code_lines += 1
     
     LABEL_PFX = "Label"
@@ -136,16 +153,19 @@ class QuadCode:
     def get_type(self, arg: ArgumentType) -> Dtype:
         """ 
         Returns the data type of an emit method argument.
-        Raises a KeyError if the argument is a string (identifier) and is not in the symbol table,
+        Raises a SemanticError if the argument is a string (identifier) and is not in the symbol table,
         meaning it's a non-existing variable or temporary variable.
         """
         # If argument to cast is a string - it's an identifier,
         if isinstance(arg, str):
             # So it has to be in the symbol table
-            return self.symbols[arg]
+            try:
+                return self.symbols[arg]
+            except KeyError:
+                raise SemanticError(f"Undeclared variable {arg}.")
         # Determine data type of number: according to the presence of '.'
         # lexer parses numbers' pythonic data types as int or float
-        return Dtype.INT if isinstance(arg, int) else Dtype.FLOAT
+        return _NUMBER_TYPES.get(type(arg)) or (Dtype.INT if isinstance(arg, int) else Dtype.FLOAT)
     
     def emit_to_temp(self, op: QuadInstructionType,
                 arg1: ArgumentType,
@@ -156,6 +176,8 @@ class QuadCode:
         if force_temp_dtype is specified, the operation will be performed to a temp with the specified dtype,
         but operation's dtype will be determined by the arguments' dtypes.
         """
+        if INVALID in (arg1, arg2):
+            return INVALID
         # Checks the real dtype of the result, and create temp variable.
         affective_type = self.get_type(arg1).affective_type(self.get_type(arg2))
         temp = self.newtemp(affective_type if force_temp_dtype is None else force_temp_dtype)
@@ -173,6 +195,8 @@ class QuadCode:
         and the argument will be casted to that op_dtype.
         """
 
+        if INVALID in (dest_name, *args):
+            return
         dest_dtype = self.get_type(dest_name)
 
         # Apply implicit casts, and check for required explicit casts.
@@ -193,21 +217,97 @@ class QuadCode:
 
 
     @staticmethod
-    def _printable(val: Optional[Union[str, int, float, QuadInstruction]]) -> Optional[str]:
+    def _printable(val: Optional[Union[str, int, float, QuadInstruction, QuadSuperInstruction]]) -> Optional[str]:
         """ Returns a printable string representation of an argument to a final code generation. """
         if val is None:
             return None
         if isinstance(val, str):
             return val
-        if isinstance(val, QuadInstruction):
+        if isinstance(val, (QuadInstruction, QuadSuperInstruction)):
             return val.name
         return str(val)
     
+    def text_lines(self) -> List[str]:
+        """ Returns the text of each line of the final code (labels must already be applied). """
+        return [" ".join(filter(None, [self._printable(j) for j in line])) for line in self.code]
+
     def write(self, dest: Union[str, Path], epilogue: Optional[str] = None) -> None:
         """ Writes the final code to an output raw file. """
         self.apply_labels()
         with open(dest, 'w', encoding='utf-8') as output_file:
-            for line in self.code:
-                output_file.write(" ".join(filter(None, [self._printable(j) for j in line])) + '\n')
+            for line in self.text_lines():
+                output_file.write(line + '\n')
             if epilogue:
                 output_file.write(epilogue)
+
+    _INT_PATTERN = re.compile(r"[-+]?\d+")
+    _FLOAT_PATTERN = re.compile(r"[-+]?(\d+\.\d*|\.\d+|\d+)([eE][-+]?\d+)?")
+
+    @classmethod
+    def _parse_arg(cls, token: str) -> ArgumentType:
+        """ Parses a single argument of a written Quad instruction. """
+        if cls._INT_PATTERN.fullmatch(token):
+            return int(token)
+        if cls._FLOAT_PATTERN.fullmatch(token):
+            return float(token)
+        return token
+
+    @staticmethod
+    def _operand_dtypes(op: Union[QuadInstruction, QuadSuperInstruction]) -> Tuple[Optional[Dtype], ...]:
+        """ Returns the data types of the (up to 3) arguments of a Quad instruction. """
+        if isinstance(op, QuadSuperInstruction):
+            name = op.name[2:] if op.name.startswith('JZ') else op.name
+            dtype = Dtype.INT if name[0] == 'I' else Dtype.FLOAT
+            return (None, dtype, dtype) if op.name.startswith('JZ') else (Dtype.INT, dtype, dtype)
+        if op == QuadInstruction.ITOR:
+            return (Dtype.FLOAT, Dtype.INT)
+        if op == QuadInstruction.RTOI:
+            return (Dtype.INT, Dtype.FLOAT)
+        if op in (QuadInstruction.JUMP, QuadInstruction.HALT):
+            return ()
+        if op == QuadInstruction.JMPZ:
+            return (None, Dtype.INT)
+        dtype = Dtype.INT if op.name[0] == 'I' else Dtype.FLOAT
+        # Real comparisons still store an integer (boolean) result.
+        if op.name[1:] in ('EQL', 'NQL', 'LSS', 'GRT'):
+            return (Dtype.INT, dtype, dtype)
+        return (dtype, dtype, dtype)
+
+    @classmethod
+    def parse(cls, text: str) -> QuadCode:
+        """
+        Parses Quad code text, as produced by write(), back into a resolved QuadCode.
+        Comments (starting with '#') and blank lines are ignored, and parsing stops at the
+        first non-instruction line following a HALT (e.g. the epilogue).
+        Superinstructions (see QuadSuperInstruction) are accepted as well.
+        Since the text format carries no declarations, the symbol table is inferred
+        from the instructions each variable is used by.
+        """
+        code = cls()
+        halted = False
+        for lineno, line in enumerate(text.splitlines(), 1):
+            tokens = line.split('#', 1)[0].split()
+            if not tokens:
+                continue
+            try:
+                op = QuadInstruction[tokens[0]] if tokens[0] in QuadInstruction.__members__ \
+                    else QuadSuperInstruction[tokens[0]]
+            except KeyError:
+                if halted:
+                    break
+                raise ValueError(f"Unknown Quad instruction {tokens[0]} at line {lineno}!")
+            if len(tokens) > 4:
+                raise ValueError(f"Too many arguments for {op.name} at line {lineno}!")
+            args = [cls._parse_arg(t) for t in tokens[1:]]
+            for arg, dtype in zip(args, cls._operand_dtypes(op)):
+                if dtype is not None and isinstance(arg, str):
+                    code.symbols.setdefault(arg, dtype)
+            code.emit(op, *args)
+            halted |= op == QuadInstruction.HALT
+        return code
+
+    @classmethod
+    def read(cls, src: Union[str, Path]) -> QuadCode:
+        """ Reads a Quad code file, as written by write(). """
+        with open(src, 'r', encoding='utf-8') as input_file:
+            return cls.parse(input_file.read())
@@ -0,0 +1,139 @@
+"""
+This module implements the copy propagation and dead store elimination passes over resolved Quad code.
+Each assignment is compiled into a computation into a temp, followed by an IASN/RASN of the temp
+into the assigned variable. Copy propagation writes such results straight into the variable, and
+replaces the reads of copied variables by their sources (where the copy holds on every path).
+Dead store elimination then removes the assignments never read afterwards.
+Both are based on the global dataflow analyses of quad_dataflow, so they hold across any jumps.
+"""
+import math
+from typing import Dict, List, Optional, Set
+
+from consts import QuadInstruction
+from quad_cfg import ControlFlowGraph, Quad, defs, rename_sources, uses
+from quad_code import ArgumentType, QuadCode
+from quad_dataflow import COPIES, AvailableCopies, Liveness, ReachingDefinitions, copy_source
+from quad_profile import QuadProfile
+
+class CopyPropagation:
+    """ Performs the copy propagation pass over a single CFG. """
+    def __init__(self, graph: ControlFlowGraph) -> None:
+        self.graph = graph
+        self.forwarded = 0
+        self.propagated = 0
+
+    def forward_results(self) -> bool:
+        """
+        Replaces computations into a temp followed by a copy of the temp (OP t a b; ...; ASN x t)
+        by a computation straight into the copy's destination (OP x a b), where the copy is the only
+        read of the temp, and x is neither read nor assigned between them. Returns whether any were.
+        """
+        uses_of, defs_of = ReachingDefinitions(self.graph).solve().def_use_chains()
+        changed = False
+        for block in self.graph:
+            removed: Set[int] = set()
+            touched: Set[int] = set()
+            for q, instr in enumerate(block.instructions):
+                op, dest, temp, _ = instr
+                if op not in COPIES or not isinstance(temp, str) or temp == dest:
+                    continue
+                reaching = defs_of[((block.id, q), temp)]
+                if len(reaching) != 1:
+                    continue
+                (def_block, p), = reaching
+                if def_block != block.id or p >= q or uses_of.get((block.id, p)) != {(block.id, q)} \
+                        or p in touched or q in touched:
+                    continue
+                between = block.instructions[p + 1:q]
+                if any(dest == defs(i) or dest in uses(i) for i in between):
+                    continue
+                computation = block.instructions[p]
+                block.instructions[p] = (computation[0], dest, computation[2], computation[3])
+                removed.add(q)
+                touched.update((p, q))
+                self.forwarded += 1
+            if removed:
+                block.lines = [l for i, l in enumerate(block.lines) if i not in removed]
+                block.instructions = [instr for i, instr in enumerate(block.instructions) if i not in removed]
+                changed = True
+        return changed
+
+    def propagate(self) -> bool:
+        """ Replaces the reads of variables by the values they are copies of. Returns whether any were. """
+        analysis = AvailableCopies(self.graph).solve()
+        changed = False
+        for block in self.graph:
+            for i, instr, copies in analysis.states(block):
+                replacements: Dict[str, ArgumentType] = {}
+                for name in uses(instr):
+                    source: Optional[ArgumentType] = name
+                    # Follow chains of copies (x := y, z := x) to their first source.
+                    while isinstance(source, str) and copy_source(copies, source) is not None:
+                        source = copy_source(copies, source)
+                    if source != name:
+                        replacements[name] = source  # type: ignore
+                if replacements:
+                    block.instructions[i] = rename_sources(instr, replacements)
+                    self.propagated += len(replacements)
+                    changed = True
+        return changed
+
+    def run(self) -> ControlFlowGraph:
+        self.forward_results()
+        while self.propagate() and self.forward_results():
+            pass
+        return self.graph
+
+def _has_side_effects(instr: Quad) -> bool:
+    """ Returns whether an instruction does more than assigning its destination (reads input, or may fail). """
+    op, _, a, b = instr
+    if op in (QuadInstruction.IINP, QuadInstruction.RINP):
+        return True
+    if op in (QuadInstruction.IDIV, QuadInstruction.RDIV):
+        return isinstance(b, str) or b == 0
+    if op == QuadInstruction.RTOI:
+        return isinstance(a, str) or not math.isfinite(a)  # type: ignore
+    if op == QuadInstruction.ITOR:
+        return isinstance(a, str) or not _fits_real(a)  # type: ignore
+    return False
+
+def _fits_real(value: int) -> bool:
+    """ Returns whether an integer may be converted to a real (which fails beyond the range of a float). """
+    try:
+        float(value)
+    except OverflowError:
+        return False
+    return True
+
+class DeadStoreElimination:
+    """ Performs the dead store elimination pass over a single CFG. """
+    def __init__(self, graph: ControlFlowGraph) -> None:
+        self.graph = graph
+        self.removed = 0
+
+    def run(self) -> ControlFlowGraph:
+        # Removing a store may make the stores feeding it dead as well, so iterate until none is found.
+        changed = True
+        while changed:
+            changed = False
+            liveness = Liveness(self.graph).solve()
+            for block in self.graph:
+                dead: List[int] = []
+                for i, instr, live in liveness.states(block):
+                    dest = defs(instr)
+                    if dest is not None and dest not in live and not _has_side_effects(instr):
+                        dead.append(i)
+                if dead:
+                    block.lines = [l for i, l in enumerate(block.lines) if i not in dead]
+                    block.instructions = [instr for i, instr in enumerate(block.instructions) if i not in dead]
+                    self.removed += len(dead)
+                    changed = True
+        return self.graph
+
+def propagate_copies(code: QuadCode, profile: Optional[QuadProfile] = None) -> QuadCode:
+    """ Runs the copy propagation pass over resolved Quad code. The profile is unused. """
+    return CopyPropagation(ControlFlowGraph.from_code(code)).run().to_code()
+
+def eliminate_dead_stores(code: QuadCode, profile: Optional[QuadProfile] = None) -> QuadCode:
+    """ Runs the dead store elimination pass over resolved Quad code. The profile is unused. """
+    return DeadStoreElimination(ControlFlowGraph.from_code(code)).run().to_code()
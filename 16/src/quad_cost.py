@@ -0,0 +1,206 @@
+"""
+This module implements a static cost model of resolved Quad code, to predict its run time without running it.
+Each opcode is given a weight: its rough cost on the execution backends (see quad_exec), relative to
+an assignment. I/O is the most expensive, then division (which checks its divisor), multiplication,
+and the other arithmetic, comparisons, conversions and branches.
+Each instruction is expected to run as many times as its block:
+    statically, LOOP_TRIPS times for each loop containing it - the natural loops of the back edges of
+    the CFG (whose target dominates their source, see quad_ssa) - so code nested in two loops weighs 100;
+    or as many times as counted by an execution profile of the same code, if given (see quad_profile).
+The cost of the code is the total weight of the instructions, each multiplied by its expected count.
+The static counts don't know the trip counts, so they can't tell e.g. that an unrolled loop (see quad_unroll)
+runs fewer iterations than the original one - the profiled ones only hold for the code profiled.
+The costs are attributed to source lines (see QuadCode.source_lines), and to the AST constructs which
+emitted the instructions, if those were collected (see cpl_ast.constructs). report() shows both.
+"""
+from __future__ import annotations
+import logging
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Set
+
+from consts import QuadInstruction, QuadSuperInstruction
+from quad_cfg import EXIT, ControlFlowGraph, Opcode
+from quad_code import QuadCode
+from quad_profile import QuadProfile, fingerprint
+from quad_ssa import dominators
+
+logger = logging.getLogger("CostModel")
+
+LOOP_TRIPS = 10
+""" The number of iterations a loop is expected to run, when there is no profile. """
+
+_WEIGHTS = {'ASN': 1, 'ADD': 2, 'SUB': 2, 'MLT': 3, 'DIV': 5, 'EQL': 2, 'NQL': 2, 'LSS': 2, 'GRT': 2,
+            'INP': 20, 'PRT': 20}
+
+WEIGHTS: Dict[Opcode, int] = {
+    **{op: _WEIGHTS[op.name[1:]] for op in QuadInstruction if op.name[1:] in _WEIGHTS},
+    QuadInstruction.ITOR: 2,
+    QuadInstruction.RTOI: 2,
+    QuadInstruction.JUMP: 1,
+    QuadInstruction.JMPZ: 2,
+    QuadInstruction.HALT: 0,
+}
+""" The weight of each opcode. """
+
+def _superinstruction_weight(op: QuadSuperInstruction) -> int:
+    """ A superinstruction weighs as much as the instructions it stands for (see quad_fusion), less the dispatches. """
+    branch = op.name.startswith('JZ')
+    name = op.name[2:] if branch else op.name
+    parts = [name[0] + 'ADD', name[0] + 'GRT'] if name[1:] in ('AND', 'OR') else [name]
+    weights = [WEIGHTS[QuadInstruction[part]] for part in parts] + ([WEIGHTS[QuadInstruction.JMPZ]] if branch else [])
+    return sum(weights) - (len(weights) - 1)
+
+WEIGHTS.update({op: _superinstruction_weight(op) for op in QuadSuperInstruction})
+
+CASTS = {QuadInstruction.ITOR, QuadInstruction.RTOI}
+
+IMPLICIT_CAST = "implicit cast"
+""" The construct conversions are attributed to, unless emitted by a CastExpression (see QuadCode.auto_cast). """
+
+_PARTS = {'Case': 'SwitchStmt'}
+""" The constructs attributed to the construct they are a part of. """
+
+def loop_depths(graph: ControlFlowGraph) -> Dict[int, int]:
+    """ Returns the number of natural loops containing each block reachable from the entry block. """
+    idom = dominators(graph)
+    predecessors = graph.predecessors()
+
+    def dominates(a: int, b: int) -> bool:
+        while b != a:
+            if idom[b] == b:
+                return False
+            b = idom[b]
+        return True
+
+    # The loops of back edges to the same header are merged.
+    loops: Dict[int, Set[int]] = {}
+    for block in graph:
+        if block.id not in idom:
+            continue
+        for header in block.successors():
+            if header == EXIT or not dominates(header, block.id):
+                continue
+            body = loops.setdefault(header, {header})
+            stack = [block.id]
+            while stack:
+                block_id = stack.pop()
+                if block_id not in body:
+                    body.add(block_id)
+                    stack.extend(p for p in predecessors[block_id] if p in idom)
+    depths = {block_id: 0 for block_id in idom}
+    for body in loops.values():
+        for block_id in body:
+            depths[block_id] += 1
+    return depths
+
+@dataclass
+class Cost:
+    """ The instructions attributed to a source line or a construct, and their estimated cost. """
+    quads: int = 0
+    casts: int = 0
+    cost: int = 0
+
+class CostModel:
+    """ Estimates the cost of each instruction of resolved Quad code. """
+    def __init__(self, code: QuadCode, profile: Optional[QuadProfile] = None, loop_trips: int = LOOP_TRIPS) -> None:
+        graph = ControlFlowGraph.from_code(code)
+        if profile is not None and profile.fingerprint != fingerprint(code):
+            logger.warning("The execution profile does not match the code, ignoring it.")
+            profile = None
+        self.code = code
+        self.profile = profile
+        self.loop_trips = loop_trips
+        self.counts: List[int] = list(profile.instructions) if profile is not None else [0] * len(code.code)
+        """ The expected execution count of each instruction (unreachable ones never run). """
+        if profile is None:
+            depths = loop_depths(graph)
+            for block in graph:
+                assert block.start is not None
+                count = loop_trips ** depths[block.id] if block.id in depths else 0
+                self.counts[block.start - 1:block.start - 1 + len(block.instructions)] = \
+                    [count] * len(block.instructions)
+        self.costs = [WEIGHTS[instr[0]] * count for instr, count in zip(code.code, self.counts)]
+
+    @property
+    def total(self) -> int:
+        return sum(self.costs)
+
+    def _attribute(self, keys: Sequence[Optional[object]]) -> Dict[Optional[object], Cost]:
+        result: Dict[Optional[object], Cost] = defaultdict(Cost)
+        for instr, cost, key in zip(self.code.code, self.costs, keys):
+            entry = result[key]
+            entry.quads += 1
+            entry.casts += instr[0] in CASTS
+            entry.cost += cost
+        return dict(result)
+
+    def by_line(self) -> Dict[Optional[int], Cost]:
+        """ Returns the cost of the instructions emitted for each source line (None for unknown). """
+        return self._attribute(self.code.source_lines)  # type: ignore
+
+    def by_construct(self, constructs: Sequence[Optional[str]]) -> Dict[Optional[str], Cost]:
+        """
+        Returns the cost of the instructions emitted by each kind of construct (the innermost AST node
+        emitting them, given for each instruction). Conversions not emitted by a CastExpression are
+        attributed to IMPLICIT_CAST, and the cases of a switch to the SwitchStmt.
+        """
+        return self._attribute(_constructs(self.code, constructs))  # type: ignore
+
+    def report(self, constructs: Optional[Sequence[Optional[str]]] = None, optimized: Optional[CostModel] = None,
+               top: int = 10) -> str:
+        """
+        Returns a human readable report of the estimated cost: the source lines producing the most
+        quads and casts, the costliest ones, and the cost of each construct (if the constructs are given).
+        """
+        lines_cost = {line: c for line, c in self.by_line().items() if line is not None}
+        total = self.total or 1
+        on_line: Dict[int, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        if constructs is not None:
+            for line, construct in zip(self.code.source_lines, _constructs(self.code, constructs)):
+                if line is not None and construct is not None:
+                    on_line[line][construct] += 1
+
+        def names(line: int) -> str:
+            return ", ".join(sorted(on_line[line], key=lambda c: on_line[line][c], reverse=True))
+
+        casts = sum(c.casts for c in lines_cost.values())
+        basis = "profiled counts" if self.profile is not None else f"loops assumed to run {self.loop_trips} times"
+        lines = [f"{len(self.code.code)} quads, {casts} casts.",
+                 f"Estimated cost: {self.total} ({basis})."]
+        if optimized is not None:
+            # The optimized code wasn't profiled, so it's compared with the static estimate.
+            static = self.total if self.profile is None else CostModel(self.code, loop_trips=self.loop_trips).total
+            lines.append(f"Estimated cost after optimization: {optimized.total} ({len(optimized.code.code)} quads), "
+                         f"x{static / (optimized.total or 1):.2f} statically.")
+        header = f"{'line':>6} {'quads':>6} {'casts':>6} {'cost':>10} {'share':>7}" + \
+            ("  constructs" if constructs is not None else "")
+
+        def row(line: int, c: Cost) -> str:
+            return f"{line:>6} {c.quads:>6} {c.casts:>6} {c.cost:>10} {c.cost / total:>7.1%}  {names(line)}".rstrip()
+
+        lines += ["", "Source lines producing the most quads:", header]
+        for line, c in sorted(lines_cost.items(), key=lambda l: (l[1].quads, l[1].casts), reverse=True)[:top]:
+            lines.append(row(line, c))
+        lines += ["", "Costliest source lines:", header]
+        for line, c in sorted(lines_cost.items(), key=lambda l: l[1].cost, reverse=True)[:top]:
+            lines.append(row(line, c))
+        if constructs is not None:
+            lines += ["", "Constructs:", f"{'construct':>20} {'quads':>6} {'casts':>6} {'cost':>10} {'share':>7}"]
+            for construct, c in sorted(self.by_construct(constructs).items(), key=lambda c: c[1].cost, reverse=True):
+                lines.append(f"{construct or '-':>20} {c.quads:>6} {c.casts:>6} {c.cost:>10} {c.cost / total:>7.1%}")
+        return "\n".join(lines)
+
+def _constructs(code: QuadCode, constructs: Sequence[Optional[str]]) -> List[Optional[str]]:
+    """ Returns the construct each instruction is attributed to (see CostModel.by_construct). """
+    result: List[Optional[str]] = []
+    for i, instr in enumerate(code.code):
+        construct = constructs[i] if i < len(constructs) else None
+        if instr[0] in CASTS and construct != 'CastExpression':
+            construct = IMPLICIT_CAST
+        result.append(_PARTS.get(construct, construct) if construct is not None else None)
+    return result
+
+def estimate_cost(code: QuadCode, profile: Optional[QuadProfile] = None) -> int:
+    """ Returns the estimated cost of resolved Quad code (see CostModel). """
+    return CostModel(code, profile).total
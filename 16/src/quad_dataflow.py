@@ -0,0 +1,207 @@
+"""
+This module implements iterative dataflow analysis over the CFG of resolved Quad code.
+An analysis defines the direction of the flow, the meet of the values flowing into a block
+and the transfer function of a single instruction; the framework solves the equations over
+all the blocks (every path, through any jump, is taken into account), and gives the value
+before/after each instruction. The analyses used by the optimization passes are:
+    ReachingDefinitions - the definitions (positions) that may reach each point.
+    Liveness            - the variables that may be read after each point.
+    AvailableCopies     - the copies (x := y) that hold at each point, on every path to it.
+"""
+from __future__ import annotations
+from typing import Dict, FrozenSet, Generic, Iterator, List, Optional, Set, Tuple, TypeVar
+
+from consts import QuadInstruction
+from quad_cfg import EXIT, BasicBlock, ControlFlowGraph, Quad, defs, uses
+from quad_code import ArgumentType
+
+T = TypeVar('T')
+
+Position = Tuple[int, int]
+""" The id of a block, and the index of an instruction within it. """
+
+COPIES = {QuadInstruction.IASN, QuadInstruction.RASN}
+
+INITIAL = -2
+""" Block id of the initial definitions: the zero value of each variable, at the entry of the program. """
+
+class DataflowAnalysis(Generic[T]):
+    """
+    Base class of the dataflow analyses, whose values are sets of T.
+    Subclasses define the direction, the meet (union or intersection) and the transfer function.
+    """
+    forward = True
+    """ Whether values flow from each block to its successors (or to its predecessors). """
+    intersect = False
+    """ Whether the meet of values is their intersection (a must analysis), rather than their union. """
+
+    def __init__(self, graph: ControlFlowGraph) -> None:
+        self.graph = graph
+        self.blocks = graph.block_map()
+        self.block_in: Dict[int, FrozenSet[T]] = {}
+        """ The value at the start of each block. """
+        self.block_out: Dict[int, FrozenSet[T]] = {}
+        """ The value at the end of each block. """
+
+    def boundary(self) -> FrozenSet[T]:
+        """ The value at the entry of the program (forward), or past its end (backward). """
+        return frozenset()
+
+    def universe(self) -> FrozenSet[T]:
+        """ All the possible values; Required by intersecting analyses, to start the iteration from. """
+        raise NotImplementedError()
+
+    def transfer(self, instr: Quad, position: Position, value: FrozenSet[T]) -> FrozenSet[T]:
+        """ Returns the value after an instruction (before it, for a backward analysis). """
+        raise NotImplementedError()
+
+    def _transfer_block(self, block: BasicBlock, value: FrozenSet[T]) -> FrozenSet[T]:
+        indices = range(len(block.instructions))
+        for i in (indices if self.forward else reversed(indices)):
+            value = self.transfer(block.instructions[i], (block.id, i), value)
+        return value
+
+    def _meet(self, values: List[FrozenSet[T]]) -> FrozenSet[T]:
+        if not values:
+            return frozenset()
+        if self.intersect:
+            return frozenset.intersection(*values)
+        return frozenset().union(*values)
+
+    def solve(self) -> DataflowAnalysis[T]:
+        """ Solves the dataflow equations by iterating to a fixed point. Returns self. """
+        entry = self.graph.blocks[0].id if self.graph.blocks else None
+        predecessors = self.graph.predecessors()
+        successors = {b.id: b.successors() for b in self.graph}
+        sources = predecessors if self.forward else successors
+        targets = successors if self.forward else predecessors
+        start = self.universe() if self.intersect else frozenset()
+        # Values flow into a block from these edges - the "out" side of its sources.
+        inflow, outflow = (self.block_in, self.block_out) if self.forward else (self.block_out, self.block_in)
+        for block in self.graph:
+            inflow[block.id] = start
+            outflow[block.id] = start
+
+        order = [b.id for b in self.graph] if self.forward else [b.id for b in reversed(self.graph.blocks)]
+        pending = list(reversed(order))
+        queued = set(pending)
+        visited: Set[int] = set()
+        while pending:
+            block_id = pending.pop()
+            queued.discard(block_id)
+            incoming = [self.boundary() if s == EXIT else outflow[s] for s in sources[block_id]]
+            if self.forward and block_id == entry:
+                incoming.append(self.boundary())
+            value = self._meet(incoming)
+            inflow[block_id] = value
+            result = self._transfer_block(self.blocks[block_id], value)
+            if result != outflow[block_id] or block_id not in visited:
+                visited.add(block_id)
+                outflow[block_id] = result
+                for t in targets[block_id]:
+                    if t != EXIT and t not in queued:
+                        queued.add(t)
+                        pending.append(t)
+        return self
+
+    def states(self, block: BasicBlock) -> Iterator[Tuple[int, Quad, FrozenSet[T]]]:
+        """
+        Yields each instruction of a block with its index, and the value right before it
+        (forward) or right after it (backward). Instructions are yielded in the flow direction.
+        """
+        if self.forward:
+            value = self.block_in[block.id]
+            for i, instr in enumerate(block.instructions):
+                yield i, instr, value
+                value = self.transfer(instr, (block.id, i), value)
+        else:
+            value = self.block_out[block.id]
+            for i in reversed(range(len(block.instructions))):
+                instr = block.instructions[i]
+                yield i, instr, value
+                value = self.transfer(instr, (block.id, i), value)
+
+class ReachingDefinitions(DataflowAnalysis[Position]):
+    """ The definitions (positions of instructions assigning a variable) that may reach each point. """
+    def __init__(self, graph: ControlFlowGraph) -> None:
+        super().__init__(graph)
+        self.definitions: Dict[str, Set[Position]] = {}
+        """ The positions of the definitions of each variable, including its initial one (in block INITIAL). """
+        for block in graph:
+            for instr in block.instructions:
+                for name in [defs(instr), *uses(instr)]:
+                    if name is not None and name not in self.definitions:
+                        self.definitions[name] = {(INITIAL, len(self.definitions))}
+        for block in graph:
+            for i, instr in enumerate(block.instructions):
+                dest = defs(instr)
+                if dest is not None:
+                    self.definitions[dest].add((block.id, i))
+
+    def boundary(self) -> FrozenSet[Position]:
+        return frozenset(p for positions in self.definitions.values() for p in positions if p[0] == INITIAL)
+
+    def transfer(self, instr: Quad, position: Position, value: FrozenSet[Position]) -> FrozenSet[Position]:
+        dest = defs(instr)
+        if dest is None:
+            return value
+        return (value - self.definitions[dest]) | {position}
+
+    def def_use_chains(self) -> Tuple[Dict[Position, Set[Position]], Dict[Tuple[Position, str], Set[Position]]]:
+        """
+        Returns the uses reached by each definition, and the definitions reaching each use
+        (by the position of the using instruction and the variable read).
+        """
+        uses_of: Dict[Position, Set[Position]] = {}
+        defs_of: Dict[Tuple[Position, str], Set[Position]] = {}
+        for block in self.graph:
+            for i, instr, reaching in self.states(block):
+                for name in uses(instr):
+                    found = reaching & self.definitions[name]
+                    defs_of[((block.id, i), name)] = set(found)
+                    for definition in found:
+                        uses_of.setdefault(definition, set()).add((block.id, i))
+        return uses_of, defs_of
+
+class Liveness(DataflowAnalysis[str]):
+    """ The variables that may be read before being assigned, after each point. """
+    forward = False
+
+    def transfer(self, instr: Quad, position: Position, value: FrozenSet[str]) -> FrozenSet[str]:
+        dest = defs(instr)
+        if dest is not None:
+            value = value - {dest}
+        return value | frozenset(uses(instr))
+
+Copy = Tuple[str, ArgumentType]
+
+class AvailableCopies(DataflowAnalysis[Copy]):
+    """ The copies (IASN/RASN x y, by (x, y)) that hold at each point, whichever path reached it. """
+    intersect = True
+
+    def __init__(self, graph: ControlFlowGraph) -> None:
+        super().__init__(graph)
+        self.copies: Set[Copy] = set()
+        for block in graph:
+            for instr in block.instructions:
+                if instr[0] in COPIES and instr[1] != instr[2]:
+                    self.copies.add((instr[1], instr[2]))  # type: ignore
+
+    def universe(self) -> FrozenSet[Copy]:
+        return frozenset(self.copies)
+
+    def transfer(self, instr: Quad, position: Position, value: FrozenSet[Copy]) -> FrozenSet[Copy]:
+        dest = defs(instr)
+        if dest is None:
+            return value
+        value = frozenset(c for c in value if dest not in c)
+        if instr[0] in COPIES and instr[1] != instr[2]:
+            value |= {(instr[1], instr[2])}  # type: ignore
+        return value
+
+def copy_source(copies: FrozenSet[Copy], name: str) -> Optional[ArgumentType]:
+    """ Returns the value a variable is a copy of, among the available copies, if any. """
+    for dest, source in copies:
+        if dest == name:
+            return source
+    return None
@@ -0,0 +1,330 @@
+"""
+This module implements the execution backends for resolved Quad code:
+A straightforward interpreter, executing the instructions one at a time,
+and a compiler translating the code into Python source, which runs much faster.
+Both backends share the same semantics, defined by the helpers below.
+"""
+from __future__ import annotations
+import math
+import sys
+from typing import Callable, Dict, List, Sequence
+
+from consts import Dtype, QuadInstruction, QuadSuperInstruction
+from quad_cfg import CONDITIONAL_BRANCHES, EXIT, ControlFlowGraph, Opcode, Quad
+from quad_code import ArgumentType, QuadCode
+
+Value = ArgumentType
+InputFunction = Callable[[Dtype], Value]
+OutputFunction = Callable[[Value], None]
+
+class QuadRuntimeError(Exception):
+    """ This exception is raised when the executed Quad code fails (e.g. division by zero). """
+    pass
+
+def int_div(a: int, b: int) -> int:
+    """ Integer division truncating towards zero (rather than flooring, like python's //). """
+    if b == 0:
+        raise QuadRuntimeError("Integer division by zero!")
+    quotient = abs(a) // abs(b)
+    return -quotient if (a < 0) != (b < 0) else quotient
+
+def real_div(a: float, b: float) -> float:
+    if b == 0:
+        raise QuadRuntimeError("Real division by zero!")
+    return a / b
+
+def int_to_real(a: int) -> float:
+    """ Converts an integer to a real. """
+    try:
+        return float(a)
+    except OverflowError:
+        # Not formatting the integer, which may have too many digits to convert to a string.
+        raise QuadRuntimeError("Cannot convert an integer this large to a real!")
+
+def real_to_int(a: float) -> int:
+    """ Converts a real to an integer, truncating towards zero. """
+    try:
+        return int(a)
+    except (OverflowError, ValueError):
+        raise QuadRuntimeError(f"Cannot convert {a} to an integer!")
+
+BINARY_OPS: Dict[Opcode, Callable[[Value, Value], Value]] = {
+    QuadInstruction.IEQL: lambda a, b: 1 if a == b else 0,
+    QuadInstruction.INQL: lambda a, b: 1 if a != b else 0,
+    QuadInstruction.ILSS: lambda a, b: 1 if a < b else 0,
+    QuadInstruction.IGRT: lambda a, b: 1 if a > b else 0,
+    QuadInstruction.IADD: lambda a, b: a + b,
+    QuadInstruction.ISUB: lambda a, b: a - b,
+    QuadInstruction.IMLT: lambda a, b: a * b,
+    QuadInstruction.IDIV: int_div,
+    QuadInstruction.REQL: lambda a, b: 1 if a == b else 0,
+    QuadInstruction.RNQL: lambda a, b: 1 if a != b else 0,
+    QuadInstruction.RLSS: lambda a, b: 1 if a < b else 0,
+    QuadInstruction.RGRT: lambda a, b: 1 if a > b else 0,
+    QuadInstruction.RADD: lambda a, b: a + b,
+    QuadInstruction.RSUB: lambda a, b: a - b,
+    QuadInstruction.RMLT: lambda a, b: a * b,
+    QuadInstruction.RDIV: real_div,
+    QuadSuperInstruction.IAND: lambda a, b: 1 if a + b > 1 else 0,
+    QuadSuperInstruction.IOR: lambda a, b: 1 if a + b > 0 else 0,
+    QuadSuperInstruction.RAND: lambda a, b: 1 if a + b > 1 else 0,
+    QuadSuperInstruction.ROR: lambda a, b: 1 if a + b > 0 else 0,
+}
+""" The semantics of the instructions of the form OP dest a b. """
+
+COMPARE_BRANCHES: Dict[Opcode, Opcode] = {
+    op: QuadInstruction[op.name[2:]] if op.name[2:] in QuadInstruction.__members__ else QuadSuperInstruction[op.name[2:]]
+    for op in QuadSuperInstruction if op in CONDITIONAL_BRANCHES
+}
+""" The compare-and-branch superinstructions (JZ<op> target a b), and the binary operation each of them tests. """
+
+UNARY_OPS: Dict[QuadInstruction, Callable[[Value], Value]] = {
+    QuadInstruction.IASN: lambda a: a,
+    QuadInstruction.RASN: lambda a: a,
+    QuadInstruction.ITOR: int_to_real,
+    QuadInstruction.RTOI: real_to_int,
+}
+""" The semantics of the instructions of the form OP dest a. """
+
+def default_input(dtype: Dtype) -> Value:
+    """ Reads a single value of the given type from the standard input. """
+    line = sys.stdin.readline()
+    try:
+        return int(line) if dtype == Dtype.INT else float(line)
+    except ValueError:
+        raise QuadRuntimeError(f"Invalid {dtype.value} input {line.strip()!r}!")
+
+def default_output(value: Value) -> None:
+    print(value)
+
+def sequence_input(values: Sequence[Value]) -> InputFunction:
+    """ Returns an input function reading the given values, in order, converted to the requested type. """
+    remaining = iter(values)
+    def read(dtype: Dtype) -> Value:
+        try:
+            value = next(remaining)
+        except StopIteration:
+            raise QuadRuntimeError("Input exhausted!")
+        return int(value) if dtype == Dtype.INT else float(value)
+    return read
+
+def initial_values(code: QuadCode) -> Dict[str, Value]:
+    """ Returns the initial (zero) value of each variable, according to its type. """
+    return {name: 0.0 if dtype == Dtype.FLOAT else 0 for name, dtype in code.symbols.items()}
+
+class QuadInterpreter:
+    """ Executes resolved Quad code, one instruction at a time. """
+    def __init__(self, code: QuadCode,
+                 input_fn: InputFunction = default_input,
+                 output_fn: OutputFunction = default_output) -> None:
+        code.apply_labels()
+        self.code = code
+        self.input_fn = input_fn
+        self.output_fn = output_fn
+        self.variables: Dict[str, Value] = {}
+
+    def value(self, arg: ArgumentType) -> Value:
+        """ Returns the value of an instruction argument - a variable or a number. """
+        return self.variables.get(arg, 0) if isinstance(arg, str) else arg
+
+    def step(self, pc: int, instr: Quad) -> int:
+        """ Executes a single instruction, at line pc, and returns the line to execute next. """
+        op, arg1, arg2, arg3 = instr
+        if op in BINARY_OPS:
+            self.variables[arg1] = BINARY_OPS[op](self.value(arg2), self.value(arg3))  # type: ignore
+        elif op in UNARY_OPS:
+            self.variables[arg1] = UNARY_OPS[op](self.value(arg2))  # type: ignore
+        elif op == QuadInstruction.JUMP:
+            return arg1  # type: ignore
+        elif op == QuadInstruction.JMPZ:
+            return arg1 if self.value(arg2) == 0 else pc + 1  # type: ignore
+        elif op in COMPARE_BRANCHES:
+            taken = BINARY_OPS[COMPARE_BRANCHES[op]](self.value(arg2), self.value(arg3)) == 0  # type: ignore
+            return arg1 if taken else pc + 1  # type: ignore
+        elif op in (QuadInstruction.IINP, QuadInstruction.RINP):
+            self.variables[arg1] = self.input_fn(Dtype.INT if op == QuadInstruction.IINP else Dtype.FLOAT)  # type: ignore
+        elif op == QuadInstruction.IPRT:
+            self.output_fn(real_to_int(self.value(arg1)))  # type: ignore
+        elif op == QuadInstruction.RPRT:
+            self.output_fn(float(self.value(arg1)))
+        elif op == QuadInstruction.HALT:
+            return 0
+        else:
+            raise QuadRuntimeError(f"Unsupported instruction {op.name} at line {pc}!")
+        return pc + 1
+
+    def run(self) -> None:
+        """ Runs the code until HALT, or until running past its last line. """
+        self.variables = initial_values(self.code)
+        instructions = self.code.code
+        pc = 1
+        while 0 < pc <= len(instructions):
+            try:
+                pc = self.step(pc, instructions[pc - 1])
+            except (ZeroDivisionError, OverflowError) as e:
+                raise QuadRuntimeError(f"{e} at line {pc}!")
+
+class QuadCompiler:
+    """
+    Translates resolved Quad code into the source of a single python function.
+    Each basic block becomes straight-line python code, and jumps between blocks are
+    performed by a dispatch loop over the block index (a binary search over if statements).
+    The source is compiled once, and the resulting function may be run any number of times.
+    When profiling, the function also counts the executions of each block and the taken conditional branches.
+    """
+    _BINARY_EXPRESSIONS = {
+        'EQL': "1 if {0} == {1} else 0",
+        'NQL': "1 if {0} != {1} else 0",
+        'LSS': "1 if {0} < {1} else 0",
+        'GRT': "1 if {0} > {1} else 0",
+        'ADD': "{0} + {1}",
+        'SUB': "{0} - {1}",
+        'MLT': "{0} * {1}",
+        'AND': "1 if {0} + {1} > 1 else 0",
+        'OR': "1 if {0} + {1} > 0 else 0",
+    }
+
+    _BRANCH_CONDITIONS = {
+        'EQL': "{0} != {1}",
+        'NQL': "{0} == {1}",
+        'LSS': "not {0} < {1}",
+        'GRT': "not {0} > {1}",
+        'AND': "not {0} + {1} > 1",
+        'OR': "not {0} + {1} > 0",
+    }
+    """ The conditions under which each compare-and-branch superinstruction jumps, by the tested operation. """
+
+    def __init__(self, code: QuadCode, profile: bool = False) -> None:
+        self.graph = ControlFlowGraph.from_code(code)
+        self.profile = profile
+        self.code = self.graph.code
+        self._names: Dict[str, str] = {}
+        for name in self.code.symbols:
+            self._name(name)
+
+    def _name(self, variable: str) -> str:
+        """ Returns the python name of a Quad variable. """
+        if variable not in self._names:
+            self._names[variable] = f"v{len(self._names)}"
+        return self._names[variable]
+
+    def _arg(self, arg: ArgumentType) -> str:
+        """ Returns the python expression of an instruction argument. """
+        if isinstance(arg, str):
+            return self._name(arg)
+        if isinstance(arg, float) and not math.isfinite(arg):
+            return f"float({str(arg)!r})"
+        return repr(arg)
+
+    def _jump(self, block_id: int, index: Dict[int, int]) -> str:
+        return "return" if block_id == EXIT else f"_block = {index[block_id]}; continue"
+
+    def instruction(self, instr: Quad, index: Dict[int, int], block_index: int) -> List[str]:
+        """ Returns the python statements executing a single instruction of the block_index'th block. """
+        op, arg1, arg2, arg3 = instr
+        if op in (QuadInstruction.IDIV, QuadInstruction.RDIV):
+            func = "_idiv" if op == QuadInstruction.IDIV else "_rdiv"
+            return [f"{self._arg(arg1)} = {func}({self._arg(arg2)}, {self._arg(arg3)})"]  # type: ignore
+        if op in BINARY_OPS:
+            expression = self._BINARY_EXPRESSIONS[op.name[1:]].format(self._arg(arg2), self._arg(arg3))  # type: ignore
+            return [f"{self._arg(arg1)} = {expression}"]  # type: ignore
+        if op in (QuadInstruction.IASN, QuadInstruction.RASN):
+            return [f"{self._arg(arg1)} = {self._arg(arg2)}"]  # type: ignore
+        if op == QuadInstruction.ITOR:
+            return [f"{self._arg(arg1)} = _itor({self._arg(arg2)})"]  # type: ignore
+        if op == QuadInstruction.RTOI:
+            return [f"{self._arg(arg1)} = _rtoi({self._arg(arg2)})"]  # type: ignore
+        if op in (QuadInstruction.IINP, QuadInstruction.RINP):
+            dtype = "_INT" if op == QuadInstruction.IINP else "_FLOAT"
+            return [f"{self._arg(arg1)} = _input({dtype})"]  # type: ignore
+        if op in (QuadInstruction.IPRT, QuadInstruction.RPRT):
+            conversion = "_rtoi" if op == QuadInstruction.IPRT else "float"
+            return [f"_output({conversion}({self._arg(arg1)}))"]  # type: ignore
+        if op == QuadInstruction.JUMP:
+            return [self._jump(arg1, index)]  # type: ignore
+        if op == QuadInstruction.JMPZ:
+            count = f"_branch_taken[{block_index}] += 1; " if self.profile else ""
+            return [f"if {self._arg(arg2)} == 0: {count}{self._jump(arg1, index)}"]  # type: ignore
+        if op in COMPARE_BRANCHES:
+            count = f"_branch_taken[{block_index}] += 1; " if self.profile else ""
+            condition = self._BRANCH_CONDITIONS[COMPARE_BRANCHES[op].name[1:]].format(self._arg(arg2), self._arg(arg3))  # type: ignore
+            return [f"if {condition}: {count}{self._jump(arg1, index)}"]  # type: ignore
+        if op == QuadInstruction.HALT:
+            return ["return"]
+        raise QuadRuntimeError(f"Unsupported instruction {op.name}!")
+
+    def _dispatch(self, bodies: List[List[str]], low: int, high: int, indent: str) -> List[str]:
+        """ Emits a binary search over the block index, in the range [low, high). """
+        if high - low == 1:
+            return [indent + line for line in bodies[low]]
+        middle = (low + high) // 2
+        return [f"{indent}if _block < {middle}:",
+                *self._dispatch(bodies, low, middle, indent + "    "),
+                f"{indent}else:",
+                *self._dispatch(bodies, middle, high, indent + "    ")]
+
+    def source(self) -> str:
+        """ Returns the python source of the function executing the code. """
+        blocks = self.graph.blocks
+        index = {b.id: i for i, b in enumerate(blocks)}
+        bodies = []
+        for i, block in enumerate(blocks):
+            body = [f"_block_counts[{i}] += 1"] if self.profile else []
+            for instr in block.instructions:
+                body.extend(self.instruction(instr, index, i))
+            if block.fallthrough is not None:
+                body.append(self._jump(block.fallthrough, index))
+            bodies.append(body)
+
+        lines = ["def _quad_program(_input, _output):"]
+        for name, dtype in self.code.symbols.items():
+            lines.append(f"    {self._name(name)} = {0.0 if dtype == Dtype.FLOAT else 0}")
+        # Variables never declared (possible in hand-written code) start as integer zero.
+        for name in list(self._names):
+            if name not in self.code.symbols:
+                lines.append(f"    {self._name(name)} = 0")
+        if bodies:
+            lines.append("    _block = 0")
+            lines.append("    while True:")
+            lines.extend(self._dispatch(bodies, 0, len(bodies), " " * 8))
+        return "\n".join(lines) + "\n"
+
+    def compile(self) -> CompiledQuadProgram:
+        """ Compiles the code into a runnable program. """
+        source = self.source()
+        namespace = {
+            "_block_counts": [0] * len(self.graph.blocks),
+            "_branch_taken": [0] * len(self.graph.blocks),
+            "_idiv": int_div,
+            "_rdiv": real_div,
+            "_itor": int_to_real,
+            "_rtoi": real_to_int,
+            "_INT": Dtype.INT,
+            "_FLOAT": Dtype.FLOAT,
+        }
+        exec(compile(source, "<quad>", "exec"), namespace)
+        return CompiledQuadProgram(namespace["_quad_program"], source, self.graph,
+                                   namespace["_block_counts"], namespace["_branch_taken"])
+
+class CompiledQuadProgram:
+    """ A Quad program compiled into a python function, by QuadCompiler. """
+    def __init__(self, function: Callable[[InputFunction, OutputFunction], None], source: str,
+                 graph: ControlFlowGraph, block_counts: List[int], branch_taken: List[int]) -> None:
+        self.function = function
+        self.source = source
+        self.graph = graph
+        self.block_counts = block_counts
+        """ When profiling, the number of executions of each block of the graph (in layout order), over all runs. """
+        self.branch_taken = branch_taken
+        """ When profiling, the number of taken conditional branches ending each block of the graph, over all runs. """
+
+    def run(self, input_fn: InputFunction = default_input,
+            output_fn: OutputFunction = default_output) -> None:
+        try:
+            self.function(input_fn, output_fn)
+        except (ZeroDivisionError, OverflowError) as e:
+            raise QuadRuntimeError(str(e))
+
+def compile_quad(code: QuadCode, profile: bool = False) -> CompiledQuadProgram:
+    """ Compiles resolved Quad code into a python function. """
+    return QuadCompiler(code, profile).compile()
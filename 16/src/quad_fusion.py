@@ -0,0 +1,106 @@
+"""
+This module implements superinstruction fusion over resolved Quad code.
+Every condition is compiled into a comparison into a temp, followed by a JMPZ on that temp -
+and && / || into an addition of both booleans, compared against 1 / 0. When the temp is used
+by the following instruction only, such pairs are fused into a single superinstruction
+(see QuadSuperInstruction), saving a dispatch and a temp write in the execution backends:
+    IADD t a b; IGRT c t 1      -->  IAND c a b
+    IEQL c a b; JMPZ L c        -->  JZIEQL L a b
+The extended code may be lowered back into standard Quad code at any time.
+"""
+from typing import Dict, List, Optional, Tuple
+
+from consts import Dtype, QuadInstruction, QuadSuperInstruction
+from quad_cfg import ControlFlowGraph, Opcode, Quad, defs, uses
+from quad_code import QuadCode
+from quad_profile import QuadProfile
+
+_LOGICAL: Dict[Tuple[QuadInstruction, int], QuadSuperInstruction] = {
+    (QuadInstruction.IADD, 1): QuadSuperInstruction.IAND,
+    (QuadInstruction.IADD, 0): QuadSuperInstruction.IOR,
+    (QuadInstruction.RADD, 1): QuadSuperInstruction.RAND,
+    (QuadInstruction.RADD, 0): QuadSuperInstruction.ROR,
+}
+""" The logical superinstruction replacing an addition followed by a GRT against the threshold. """
+
+_LOGICAL_LOWERING = {logical: (add, threshold) for (add, threshold), logical in _LOGICAL.items()}
+
+_GREATER = {QuadInstruction.IADD: QuadInstruction.IGRT, QuadInstruction.RADD: QuadInstruction.RGRT}
+
+_COMPARE_BRANCH: Dict[Opcode, QuadSuperInstruction] = {
+    QuadInstruction[op.name[2:]] if op.name[2:] in QuadInstruction.__members__
+    else QuadSuperInstruction[op.name[2:]]: op
+    for op in QuadSuperInstruction if op.name.startswith('JZ')
+}
+""" The compare-and-branch superinstruction replacing a comparison (or logical superinstruction) followed by a JMPZ. """
+
+_COMPARE_LOWERING = {branch: compare for compare, branch in _COMPARE_BRANCH.items()}
+
+def _fuse_pair(first: Quad, second: Quad, use_counts: Dict[str, int]) -> Optional[Quad]:
+    """ Returns the superinstruction replacing two consecutive instructions, if they may be fused. """
+    temp = defs(first)
+    if temp is None or use_counts.get(temp) != 1 or temp not in uses(second):
+        return None
+    op, _, a, b = first
+    if op in _GREATER and second[0] == _GREATER[op] and second[2] == temp \
+            and not isinstance(second[3], str) and second[3] in (0, 1):
+        return (_LOGICAL[(op, int(second[3]))], second[1], a, b)  # type: ignore
+    if op in _COMPARE_BRANCH and second[0] == QuadInstruction.JMPZ:
+        return (_COMPARE_BRANCH[op], second[1], a, b)
+    return None
+
+class SuperinstructionFusion:
+    """ Fuses instruction pairs into superinstructions, within each basic block of a CFG. """
+    def __init__(self, graph: ControlFlowGraph) -> None:
+        self.graph = graph
+        self.fused = 0
+
+    def run(self) -> ControlFlowGraph:
+        use_counts = self.graph.use_counts()
+        for block in self.graph:
+            instructions: List[Quad] = []
+            lines: List[Optional[int]] = []
+            for instr, line in zip(block.instructions, block.lines):
+                # Fusing the logical superinstructions first lets them be fused into their JMPZ as well.
+                fused = _fuse_pair(instructions[-1], instr, use_counts) if instructions else None
+                if fused is None:
+                    instructions.append(instr)
+                    lines.append(line)
+                else:
+                    instructions[-1] = fused
+                    self.fused += 1
+            block.instructions, block.lines = instructions, lines
+        return self.graph
+
+def fuse_superinstructions(code: QuadCode, profile: Optional[QuadProfile] = None) -> QuadCode:
+    """ Runs the superinstruction fusion pass over resolved Quad code. The profile is unused. """
+    return SuperinstructionFusion(ControlFlowGraph.from_code(code)).run().to_code()
+
+def has_superinstructions(code: QuadCode) -> bool:
+    return any(isinstance(instr[0], QuadSuperInstruction) for instr in code.code)
+
+def _lower(instr: Quad, code: QuadCode) -> List[Quad]:
+    """ Returns the standard Quad instructions performing a single (super)instruction. """
+    op, arg1, arg2, arg3 = instr
+    if op in _COMPARE_LOWERING:
+        condition = code.newtemp(Dtype.INT)
+        return _lower((_COMPARE_LOWERING[op], condition, arg2, arg3), code) + \
+            [(QuadInstruction.JMPZ, arg1, condition, None)]
+    if op in _LOGICAL_LOWERING:
+        add, threshold = _LOGICAL_LOWERING[op]  # type: ignore
+        total = code.newtemp(Dtype.INT if add == QuadInstruction.IADD else Dtype.FLOAT)
+        return [(add, total, arg2, arg3), (_GREATER[add], arg1, total, threshold)]
+    return [instr]
+
+def lower_superinstructions(code: QuadCode) -> QuadCode:
+    """ Replaces the superinstructions in resolved Quad code by the standard instructions they stand for. """
+    graph = ControlFlowGraph.from_code(code)
+    for block in graph:
+        instructions: List[Quad] = []
+        lines: List[Optional[int]] = []
+        for instr, line in zip(block.instructions, block.lines):
+            lowered = _lower(instr, graph.code)
+            instructions += lowered
+            lines += [line] * len(lowered)
+        block.instructions, block.lines = instructions, lines
+    return graph.to_code()
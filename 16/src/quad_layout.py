@@ -0,0 +1,276 @@
+"""
+This module implements the basic block layout pass.
+The code generated for IfStmt and WhileStmt follows the source order, regardless of the
+branches taken at runtime. This pass rotates while loops, so that each iteration ends with a
+single conditional jump back to the loop's body (instead of a JUMP back to the condition followed
+by a JMPZ out of the loop), and - given an execution profile - reorders the blocks so that the
+hottest successor of each block is laid out right after it (becoming a fall-through).
+"""
+from __future__ import annotations
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from consts import Dtype, QuadInstruction
+from quad_cfg import CONDITIONAL_BRANCHES, EXIT, BasicBlock, ControlFlowGraph, Quad, defs, rename_sources, target, uses
+from quad_code import QuadCode
+from quad_profile import QuadProfile, fingerprint
+
+logger = logging.getLogger("BlockLayout")
+
+Edge = Tuple[int, int]
+
+_NEGATED = {
+    QuadInstruction.IEQL: QuadInstruction.INQL,
+    QuadInstruction.INQL: QuadInstruction.IEQL,
+    QuadInstruction.REQL: QuadInstruction.RNQL,
+    QuadInstruction.RNQL: QuadInstruction.REQL,
+}
+
+def invert_condition(instr: Quad) -> Optional[Quad]:
+    """
+    Returns a single comparison computing the negation of a comparison instruction, if one exists.
+    Equality tests are always invertible, and integer order tests are when one side is a constant:
+    not (a < c) <==> a > c - 1, and so on. Real order tests are never inverted (because of NaNs).
+    """
+    op, dest, a, b = instr
+    if op in _NEGATED:
+        return (_NEGATED[op], dest, a, b)
+    if op == QuadInstruction.ILSS:
+        if isinstance(b, int):
+            return (QuadInstruction.IGRT, dest, a, b - 1)
+        if isinstance(a, int):
+            return (QuadInstruction.ILSS, dest, b, a + 1)
+    if op == QuadInstruction.IGRT:
+        if isinstance(b, int):
+            return (QuadInstruction.ILSS, dest, a, b + 1)
+        if isinstance(a, int):
+            return (QuadInstruction.IGRT, dest, b, a - 1)
+    return None
+
+def _invertible_definition(block: BasicBlock, use_counts: Dict[str, int]) -> Optional[int]:
+    """
+    Returns the index (in the block) of the comparison defining the condition of the JMPZ ending
+    the block, if it may be inverted in place - that is, the condition is used by the JMPZ only.
+    """
+    condition = block.instructions[-1][2]
+    if not isinstance(condition, str) or use_counts.get(condition) != 1:
+        return None
+    for i in range(len(block.instructions) - 2, -1, -1):
+        instr = block.instructions[i]
+        if defs(instr) == condition:
+            return i if invert_condition(instr) is not None else None
+        if condition in uses(instr):
+            return None
+    return None
+
+class BlockLayout:
+    """ Performs the block layout pass over a single CFG. """
+    def __init__(self, graph: ControlFlowGraph, weights: Optional[Dict[Edge, int]] = None) -> None:
+        self.graph = graph
+        self.weights = weights
+        """ Execution counts of the CFG edges, if a profile is available. """
+        self.rotated = 0
+        self.inverted = 0
+
+    def _loop_latch(self, header: BasicBlock, position: Dict[int, int],
+                    predecessors: Dict[int, List[int]]) -> Optional[BasicBlock]:
+        """ Returns the single block jumping back to a while loop header, if the header is one. """
+        blocks = self.graph.block_map()
+        back = [blocks[p] for p in predecessors[header.id] if position[p] >= position[header.id]]
+        if len(back) != 1:
+            return None
+        latch = back[0]
+        last = latch.instructions[-1] if latch.instructions else None
+        if last is None or last[0] != QuadInstruction.JUMP or target(last) != header.id or latch is header:
+            return None
+        return latch
+
+    def rotate_loops(self) -> None:
+        """
+        Rotates each while loop: the header (the condition and a JMPZ to the loop exit) stays as a
+        guard before the first iteration, and the JUMP back to it from the end of the body is replaced
+        by a copy of the condition, negated, followed by a JMPZ back to the first block of the body.
+        """
+        position = {b.id: i for i, b in enumerate(self.graph.blocks)}
+        predecessors = self.graph.predecessors()
+        use_counts = self.graph.use_counts()
+        for header in list(self.graph.blocks):
+            if not header.instructions or header.instructions[-1][0] != QuadInstruction.JMPZ:
+                continue
+            exit_id, body_id = target(header.instructions[-1]), header.fallthrough
+            if body_id is None or body_id == EXIT or body_id == exit_id:
+                continue
+            if any(i[0] in (QuadInstruction.IINP, QuadInstruction.RINP, QuadInstruction.IPRT, QuadInstruction.RPRT)
+                   for i in header.instructions):
+                continue
+            latch = self._loop_latch(header, position, predecessors)
+            if latch is None:
+                continue
+
+            # Copy the condition, renaming the temps used only by it.
+            mapping: Dict[str, str] = {}
+            copy: List[Quad] = []
+            inner = {defs(i) for i in header.instructions} - {None}
+            local = {name for name in inner if use_counts.get(name, 0) == sum(
+                uses(i).count(name) for i in header.instructions)}
+            for instr in header.instructions[:-1]:
+                instr = rename_sources(instr, mapping)  # type: ignore
+                dest = defs(instr)
+                if dest in local:
+                    mapping[dest] = self.graph.code.newtemp(self.graph.code.symbols[dest])  # type: ignore
+                    instr = (instr[0], mapping[dest], instr[2], instr[3])
+                copy.append(instr)
+            condition = mapping.get(header.instructions[-1][2], header.instructions[-1][2])  # type: ignore
+            lines = list(header.lines[:-1])
+
+            if copy and defs(copy[-1]) == condition and header.instructions[-1][2] in mapping \
+                    and invert_condition(copy[-1]):
+                copy[-1] = invert_condition(copy[-1])  # type: ignore
+            else:
+                negated = self.graph.code.newtemp(Dtype.INT)
+                copy.append((QuadInstruction.IEQL, negated, condition, 0))
+                lines.append(header.lines[-1])
+                condition = negated
+            latch.instructions[-1:] = copy + [(QuadInstruction.JMPZ, body_id, condition, None)]
+            latch.lines[-1:] = lines + [header.lines[-1]]
+            latch.fallthrough = exit_id
+            self.rotated += 1
+            predecessors = self.graph.predecessors()
+            use_counts = self.graph.use_counts()
+
+            if self.weights is not None:
+                # Each entry is assumed to run at least one iteration, if the loop iterated at all.
+                iterations = self.weights.get((header.id, body_id), 0)  # type: ignore
+                entries = sum(w for (src, dst), w in self.weights.items() if dst == header.id and src != latch.id)
+                entered = min(entries, iterations)
+                self.weights.pop((latch.id, header.id), None)
+                self.weights[(header.id, body_id)] = entered  # type: ignore
+                self.weights[(header.id, exit_id)] = entries - entered  # type: ignore
+                self.weights[(latch.id, body_id)] = iterations - entered  # type: ignore
+                self.weights[(latch.id, exit_id)] = entered  # type: ignore
+
+    def _link_benefits(self) -> Dict[Edge, int]:
+        """
+        Returns, for each edge that may become a fall-through, the number of JUMPs saved by laying
+        its destination right after its source. A block ending with an invertible JMPZ needs a JUMP
+        only if neither of its successors follows it (to the colder one, as the other is jumped to
+        by the JMPZ), so linking either of them saves the same count.
+        """
+        assert self.weights is not None
+        use_counts = self.graph.use_counts()
+        benefits: Dict[Edge, int] = {}
+        for block in self.graph:
+            if block.fallthrough is None:
+                continue
+            fallthrough_weight = self.weights.get((block.id, block.fallthrough), 0)
+            last = block.instructions[-1] if block.instructions else None
+            if last is not None and last[0] == QuadInstruction.JMPZ:
+                jump_target = target(last)
+                if _invertible_definition(block, use_counts) is not None:
+                    saved = min(fallthrough_weight, self.weights.get((block.id, jump_target), 0))  # type: ignore
+                    benefits[(block.id, jump_target)] = saved  # type: ignore
+                    benefits[(block.id, block.fallthrough)] = saved
+                    continue
+            benefits[(block.id, block.fallthrough)] = fallthrough_weight
+        return benefits
+
+    def reorder(self) -> None:
+        """
+        Reorders the blocks by the edge weights: chains of blocks are formed greedily from the
+        edges saving the most JUMPs, and laid out in their original order (the entry block's chain first).
+        """
+        position = {b.id: i for i, b in enumerate(self.graph.blocks)}
+        entry = self.graph.blocks[0].id
+        chain_of = {b.id: [b.id] for b in self.graph.blocks}
+
+        # On ties, prefer keeping blocks that are already adjacent.
+        edges = sorted(((saved, src, dst) for (src, dst), saved in self._link_benefits().items()
+                        if dst != EXIT and dst != entry and src != dst),
+                       key=lambda e: (-e[0], position[e[2]] != position[e[1]] + 1, position[e[1]]))
+        for _, src, dst in edges:
+            first, second = chain_of[src], chain_of[dst]
+            if first is second or first[-1] != src or second[0] != dst:
+                continue
+            first.extend(second)
+            for block_id in second:
+                chain_of[block_id] = first
+
+        chains = []
+        for block in self.graph.blocks:
+            chain = chain_of[block.id]
+            if chain[0] == block.id:
+                chains.append(chain)
+        blocks = self.graph.block_map()
+        self.graph.blocks = [blocks[block_id] for chain in chains for block_id in chain]
+
+    def fix_branches(self) -> None:
+        """
+        Inverts the JMPZs whose target is laid out right after them, making it their fall-through.
+        When neither successor follows a JMPZ, it is inverted if that makes the added JUMP colder.
+        """
+        use_counts = self.graph.use_counts()
+        for i, block in enumerate(self.graph.blocks):
+            if not block.instructions or block.instructions[-1][0] != QuadInstruction.JMPZ:
+                continue
+            next_id = self.graph.blocks[i + 1].id if i + 1 < len(self.graph.blocks) else EXIT
+            jump_target = target(block.instructions[-1])
+            if block.fallthrough == next_id or block.fallthrough is None:
+                continue
+            if jump_target != next_id:
+                if self.weights is None or self.weights.get((block.id, block.fallthrough), 0) <= \
+                        self.weights.get((block.id, jump_target), 0):  # type: ignore
+                    continue
+            index = _invertible_definition(block, use_counts)
+            if index is None:
+                continue
+            block.instructions[index] = invert_condition(block.instructions[index])  # type: ignore
+            _, _, condition, _ = block.instructions[-1]
+            block.instructions[-1] = (QuadInstruction.JMPZ, block.fallthrough, condition, None)
+            block.fallthrough = jump_target
+            self.inverted += 1
+
+    def unlink_jumps(self) -> None:
+        """ Replaces the JUMPs ending blocks with fall-through edges, which are re-added only if needed. """
+        for block in self.graph:
+            if block.instructions and block.instructions[-1][0] == QuadInstruction.JUMP:
+                block.fallthrough = target(block.instructions.pop())
+                block.lines.pop()
+
+    def run(self) -> ControlFlowGraph:
+        self.rotate_loops()
+        self.unlink_jumps()
+        if self.weights is not None:
+            self.reorder()
+            self.fix_branches()
+        return self.graph
+
+def edge_weights(graph: ControlFlowGraph, profile: QuadProfile) -> Dict[Edge, int]:
+    """ Returns the execution count of each edge of a CFG, built from the code the profile was taken from. """
+    weights: Dict[Edge, int] = {}
+    for block in graph:
+        assert block.start is not None
+        count = profile.block_count(block.start)
+        last = block.instructions[-1]
+        end = block.start + len(block.instructions) - 1
+        if last[0] in CONDITIONAL_BRANCHES:
+            branch = profile.branches[end]
+            weights[(block.id, target(last))] = branch.taken  # type: ignore
+            if block.fallthrough is not None:
+                weights[(block.id, block.fallthrough)] = branch.not_taken
+        else:
+            for successor in block.successors():
+                weights[(block.id, successor)] = count
+    return weights
+
+def layout_blocks(code: QuadCode, profile: Optional[QuadProfile] = None) -> QuadCode:
+    """
+    Runs the block layout pass over resolved Quad code. The profile, if given, must be taken from
+    the same code - otherwise it is ignored, and only the static heuristics (loop rotation) apply.
+    """
+    code.apply_labels()
+    if profile is not None and profile.fingerprint != fingerprint(code):
+        logger.warning("The execution profile does not match the code, ignoring it.")
+        profile = None
+    graph = ControlFlowGraph.from_code(code)
+    weights = edge_weights(graph, profile) if profile is not None else None
+    return BlockLayout(graph, weights).run().to_code()
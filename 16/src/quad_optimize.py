@@ -0,0 +1,49 @@
+"""
+This module chains the optimization passes over resolved Quad code.
+Each pass gets the code (and an optional execution profile) and returns the optimized code.
+When info logging is enabled, the estimated cost of the code after each pass is logged (see quad_cost).
+"""
+import logging
+from typing import Callable, Dict, Optional, Sequence, Union
+
+from quad_casts import eliminate_conversions
+from quad_code import QuadCode
+from quad_cost import estimate_cost
+from quad_copies import eliminate_dead_stores, propagate_copies
+from quad_fusion import fuse_superinstructions
+from quad_layout import layout_blocks
+from quad_profile import QuadProfile
+from quad_sccp import propagate_constants
+from quad_simplify import simplify
+from quad_unroll import unroll_loops
+
+logger = logging.getLogger("Optimizer")
+
+QuadPass = Callable[[QuadCode, Optional[QuadProfile]], QuadCode]
+
+PASSES: Dict[str, QuadPass] = {
+    'layout': layout_blocks,
+    'fuse': fuse_superinstructions,
+    'casts': eliminate_conversions,
+    'copies': propagate_copies,
+    'deadstores': eliminate_dead_stores,
+    'simplify': simplify,
+    'unroll': unroll_loops,
+    'sccp': propagate_constants,
+}
+""" The available passes, by name. """
+
+PassSpec = Union[str, QuadPass]
+""" A pass to run: its name, or the pass itself (e.g. with its parameters bound, by functools.partial). """
+
+def optimize(code: QuadCode, passes: Sequence[PassSpec], profile: Optional[QuadProfile] = None) -> QuadCode:
+    """ Runs the given passes over the code, in order. """
+    code.apply_labels()
+    if passes and logger.isEnabledFor(logging.INFO):
+        logger.info(f"Generated: {len(code.code)} quads, estimated cost {estimate_cost(code)}")
+    for spec in passes:
+        code = (PASSES[spec] if isinstance(spec, str) else spec)(code, profile)
+        if logger.isEnabledFor(logging.INFO):
+            name = spec if isinstance(spec, str) else getattr(getattr(spec, 'func', spec), '__name__', repr(spec))
+            logger.info(f"After {name}: {len(code.code)} quads, estimated cost {estimate_cost(code)}")
+    return code
@@ -0,0 +1,143 @@
+"""
+This module implements execution profiling of resolved Quad code.
+The code is run by the compiled backend (see quad_exec) with counters at each basic block
+and conditional branch, from which the execution counts of each instruction and source line are derived.
+Profiles are saved as JSON, so that later compilations (e.g. the block layout pass) may use them.
+"""
+from __future__ import annotations
+import hashlib
+import json
+from collections import defaultdict
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+from quad_cfg import CONDITIONAL_BRANCHES
+from quad_code import QuadCode
+from quad_exec import CompiledQuadProgram, InputFunction, OutputFunction, compile_quad, \
+    default_input, default_output
+
+def fingerprint(code: QuadCode) -> str:
+    """ Returns a hash identifying resolved Quad code, to match profiles with the code they were taken from. """
+    code.apply_labels()
+    return hashlib.sha1("\n".join(code.text_lines()).encode('utf-8')).hexdigest()
+
+@dataclass
+class BlockProfile:
+    """ The execution count of a basic block, spanning the lines start-end (inclusive). """
+    start: int
+    end: int
+    count: int
+
+@dataclass
+class BranchProfile:
+    """ The number of times a conditional branch jumped (taken) or fell through (not taken). """
+    taken: int
+    not_taken: int
+
+class QuadProfile:
+    """ The execution counts of a Quad program, by instruction (line), block and branch. """
+    def __init__(self, fingerprint: str, instructions: List[int], blocks: List[BlockProfile],
+                 branches: Dict[int, BranchProfile], source_lines: List[Optional[int]]) -> None:
+        self.fingerprint = fingerprint
+        self.instructions = instructions
+        """ The execution count of each line of the code (the count of line l is at index l - 1). """
+        self.blocks = blocks
+        self.branches = branches
+        """ The branch counts of each conditional branch, by its line. """
+        self.source_lines = source_lines
+        """ The source line of each line of the code (None if unknown). """
+
+    @classmethod
+    def from_program(cls, program: CompiledQuadProgram, code: QuadCode) -> QuadProfile:
+        """ Collects the profile of a program compiled with profiling from code. """
+        instructions = [0] * len(code.code)
+        blocks = []
+        branches = {}
+        for i, block in enumerate(program.graph.blocks):
+            assert block.start is not None
+            count = program.block_counts[i]
+            end = block.start + len(block.instructions) - 1
+            blocks.append(BlockProfile(block.start, end, count))
+            instructions[block.start - 1:end] = [count] * len(block.instructions)
+            if block.instructions[-1][0] in CONDITIONAL_BRANCHES:
+                taken = program.branch_taken[i]
+                branches[end] = BranchProfile(taken, count - taken)
+        return cls(fingerprint(code), instructions, blocks, branches, list(code.source_lines))
+
+    def source_counts(self) -> Dict[int, int]:
+        """ Returns the number of instructions executed for each source line. """
+        result: Dict[int, int] = defaultdict(int)
+        for line, count in zip(self.source_lines, self.instructions):
+            if line is not None:
+                result[line] += count
+        return dict(result)
+
+    def block_count(self, line: int) -> int:
+        """ Returns the execution count of the line'th instruction (and of the block containing it). """
+        return self.instructions[line - 1]
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "fingerprint": self.fingerprint,
+            "instructions": self.instructions,
+            "blocks": [asdict(b) for b in self.blocks],
+            "branches": {str(line): asdict(b) for line, b in self.branches.items()},
+            "source_lines": self.source_lines,
+            "source_counts": {str(line): count for line, count in sorted(self.source_counts().items())},
+        })
+
+    @classmethod
+    def from_json(cls, text: str) -> QuadProfile:
+        data = json.loads(text)
+        return cls(data["fingerprint"], data["instructions"],
+                   [BlockProfile(**b) for b in data["blocks"]],
+                   {int(line): BranchProfile(**b) for line, b in data["branches"].items()},
+                   data["source_lines"])
+
+    def save(self, dest: Union[str, Path]) -> None:
+        with open(dest, 'w', encoding='utf-8') as f:
+            f.write(self.to_json())
+
+    @classmethod
+    def load(cls, src: Union[str, Path]) -> QuadProfile:
+        with open(src, 'r', encoding='utf-8') as f:
+            return cls.from_json(f.read())
+
+    def report(self, code: QuadCode, top: int = 10) -> str:
+        """ Returns a human readable report of the hottest blocks, source lines and branches. """
+        text = code.text_lines()
+        total = sum(self.instructions) or 1
+        def source(line: int) -> str:
+            src = self.source_lines[line - 1] if line <= len(self.source_lines) else None
+            return "-" if src is None else str(src)
+
+        lines = [f"Executed {sum(self.instructions)} instructions.", "",
+                 "Hot blocks:", f"{'count':>12} {'quads':>9} {'source':>6}  first instruction"]
+        for block in sorted(self.blocks, key=lambda b: b.count * (b.end - b.start + 1), reverse=True)[:top]:
+            lines.append(f"{block.count:>12} {f'{block.start}-{block.end}':>9} {source(block.start):>6}  "
+                         f"{text[block.start - 1]}")
+
+        lines += ["", "Hot source lines:", f"{'line':>6} {'executed':>12} {'share':>7}"]
+        for line, count in sorted(self.source_counts().items(), key=lambda c: c[1], reverse=True)[:top]:
+            lines.append(f"{line:>6} {count:>12} {count / total:>7.1%}")
+
+        lines += ["", "Branches:", f"{'quad':>6} {'source':>6} {'taken':>12} {'not taken':>12}"]
+        for line, branch in sorted(self.branches.items(), key=lambda b: b[1].taken + b[1].not_taken,
+                                   reverse=True)[:top]:
+            lines.append(f"{line:>6} {source(line):>6} {branch.taken:>12} {branch.not_taken:>12}")
+        return "\n".join(lines)
+
+class QuadProfiler:
+    """ Runs resolved Quad code (any number of times), collecting a single profile over all the runs. """
+    def __init__(self, code: QuadCode) -> None:
+        code.apply_labels()
+        self.code = code
+        self.program = compile_quad(code, profile=True)
+
+    def run(self, input_fn: InputFunction = default_input,
+            output_fn: OutputFunction = default_output) -> None:
+        self.program.run(input_fn, output_fn)
+
+    def profile(self) -> QuadProfile:
+        return QuadProfile.from_program(self.program, self.code)
@@ -0,0 +1,126 @@
+"""
+Entry point for running resolved Quad code files.
+CPL source files may be run directly as well, which keeps their source line information for profiling.
+"""
+
+import logging
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import List, Optional
+
+import sly
+from cpl_lexer import CplLexer
+from cpl_parser import CplParser
+from quad_binary import SUFFIX as BINARY_SUFFIX, read_binary
+from quad_cfg import ControlFlowGraph
+from quad_code import QuadCode
+from quad_exec import QuadInterpreter, QuadRuntimeError, Value, compile_quad
+from quad_profile import QuadProfiler
+
+logger = logging.getLogger()
+
+def load_code(file_path: Path) -> Optional[QuadCode]:
+    """
+    Reads a Quad code file (text or binary), or compiles a CPL source file. Returns None if compilation fails.
+    Raises a ValueError if a Quad code file is malformed, including jump targets out of the code.
+    """
+    if file_path.suffix != '.cpl':
+        code = read_binary(file_path) if file_path.suffix == BINARY_SUFFIX else QuadCode.read(file_path)
+        # The backends only check the jump targets once they run (or not at all), so check them here.
+        ControlFlowGraph.from_code(code)
+        return code
+    with open(file_path, 'r') as f:
+        source = f.read()
+    try:
+        prog = CplParser().parse(CplLexer().tokenize(source))
+    except sly.lex.LexError:
+        return None
+    if prog is None or not prog.visit() or prog.code is None:
+        return None
+    prog.code.apply_labels()
+    return prog.code
+
+def read_batch_inputs(inputs_path: Path) -> List[List[Value]]:
+    """
+    Reads the inputs of a batch run - a line of values per run (blank lines are skipped), each an integer
+    or else a real, like default_input reads them. Raises a ValueError if a value is neither.
+    """
+    inputs = []
+    with open(inputs_path, 'r') as f:
+        for lineno, line in enumerate(f, 1):
+            if line.strip():
+                inputs.append([_parse_input(v, lineno) for v in line.split()])
+    return inputs
+
+def _parse_input(value: str, lineno: int) -> Value:
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value)
+    except ValueError:
+        raise ValueError(f"Invalid input {value!r} in line {lineno}")
+
+def run_batch_file(code: QuadCode, inputs: List[List[Value]]) -> None:
+    """ Runs the code once per inputs line (see read_batch_inputs), printing each run's outputs in a line. """
+    from quad_batch import run_batch
+
+    result = run_batch(code, inputs)
+    for lane, (outputs, error) in enumerate(zip(result.outputs, result.errors)):
+        print(" ".join(str(v) for v in outputs))
+        if error:
+            logger.error(f"Runtime error in run {lane + 1}: {error}")
+
+if __name__ == '__main__':
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument('file', metavar='f', help='Path to Quad code file (text or binary), or CPL source file to run.')
+    arg_parser.add_argument('--backend', choices=['interpret', 'compile'], default='compile',
+                            help='Execute the instructions one by one, or compile them to python first.')
+    arg_parser.add_argument('--batch', metavar='INPUTS',
+                            help='Run once per line of the INPUTS file (vectorized, requires numpy).')
+    arg_parser.add_argument('--profile', metavar='OUT',
+                            help='Profile the run: print a hot-spot report, and save the profile to OUT (JSON).')
+    args = arg_parser.parse_args()
+    file_path = Path(args.file)
+    try:
+        code = load_code(file_path)
+    except IOError:
+        logger.error("Failed to open file %s" % str(file_path))
+        exit(-1)
+    except ValueError as e:
+        logger.error(f"Invalid Quad file {file_path}: {e}")
+        exit(1)
+    if code is None:
+        logger.error("Compilation failed. Aborting. View output above for more information.")
+        exit(1)
+
+    if args.batch:
+        try:
+            inputs = read_batch_inputs(Path(args.batch))
+        except IOError:
+            logger.error("Failed to open file %s" % args.batch)
+            exit(-1)
+        except ValueError as e:
+            logger.error(f"Invalid batch inputs file {args.batch}: {e}")
+            exit(1)
+        run_batch_file(code, inputs)
+        exit(0)
+
+    profiler = QuadProfiler(code) if args.profile else None
+    try:
+        if profiler:
+            profiler.run()
+        elif args.backend == 'interpret':
+            QuadInterpreter(code).run()
+        else:
+            compile_quad(code).run()
+    except QuadRuntimeError as e:
+        logger.error(f"Runtime error: {e}")
+        exit(1)
+    finally:
+        if profiler:
+            profile = profiler.profile()
+            profile.save(args.profile)
+            print(profile.report(code), file=sys.stderr)
@@ -0,0 +1,228 @@
+"""
+This module implements sparse conditional constant propagation (Wegman and Zadeck) over the SSA
+form of resolved Quad code (see quad_ssa). Each version is either not known yet, a constant, or
+overdefined; and only the CFG edges found executable are followed - so a branch on a constant
+takes a single edge, and the values flowing in from the edges never taken don't spoil the phis.
+When a version's value changes, only its uses are evaluated again (that's what makes it sparse).
+The initial values of variables are their zero values, and values are computed by the same
+semantics as the execution backends (see quad_exec), so an instruction which may fail at run
+time is never folded. Then:
+    the instructions assigning constants are removed, and their uses read the constants instead;
+    branches on constants are removed (falling through to the edge taken), and so are the blocks never executed.
+"""
+import logging
+import math
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+from consts import Dtype, QuadInstruction
+from quad_cfg import BRANCHES, CONDITIONAL_BRANCHES, EXIT, BasicBlock, ControlFlowGraph, Quad, defs, \
+    rename_sources, target, uses
+from quad_code import ArgumentType, QuadCode
+from quad_exec import BINARY_OPS, COMPARE_BRANCHES, UNARY_OPS, QuadRuntimeError
+from quad_profile import QuadProfile
+from quad_ssa import Edge, Phi, SSAForm
+
+logger = logging.getLogger("ConstantPropagation")
+
+class _Overdefined:
+    """ The lattice value of a version which may hold different values. """
+    def __repr__(self) -> str:
+        return "OVERDEFINED"
+
+OVERDEFINED = _Overdefined()
+
+LatticeValue = Union[ArgumentType, _Overdefined, None]
+""" A constant, OVERDEFINED, or None - not known yet (no definition reaching it was executed). """
+
+def _same(a: ArgumentType, b: ArgumentType) -> bool:
+    """ Returns whether two constants are the same value (telling 1 from 1.0, and 0.0 from -0.0). """
+    return type(a) is type(b) and str(a) == str(b)
+
+def _meet(a: LatticeValue, b: LatticeValue) -> LatticeValue:
+    if a is None:
+        return b
+    if b is None:
+        return a
+    if a is OVERDEFINED or b is OVERDEFINED or not _same(a, b):  # type: ignore
+        return OVERDEFINED
+    return a
+
+_UseSite = Tuple[int, Union[int, Phi]]
+""" A block, and the index of an instruction in it (or a phi of it). """
+
+class ConstantPropagation:
+    """ Performs sparse conditional constant propagation over the SSA form of a CFG. """
+    def __init__(self, ssa: SSAForm) -> None:
+        self.ssa = ssa
+        self.blocks = ssa.graph.block_map()
+        self.values: Dict[str, LatticeValue] = {}
+        self.executable: Set[Edge] = set()
+        self.visited: Set[int] = set()
+        """ The blocks found executable (whose instructions were evaluated). """
+        self.propagated = 0
+        self.folded_branches = 0
+        self.removed_blocks = 0
+        self._uses: Dict[str, List[_UseSite]] = {}
+        for block in ssa.graph:
+            for phi in ssa.phis[block.id]:
+                for source in phi.sources.values():
+                    if isinstance(source, str):
+                        self._uses.setdefault(source, []).append((block.id, phi))
+            for i, instr in enumerate(block.instructions):
+                for name in uses(instr):
+                    self._uses.setdefault(name, []).append((block.id, i))
+
+    def value(self, arg: Optional[ArgumentType]) -> LatticeValue:
+        """ Returns the lattice value of an operand. """
+        if not isinstance(arg, str):
+            return arg
+        if arg not in self.ssa.variables:
+            # The initial value of a variable.
+            return 0.0 if self.ssa.graph.code.symbols.get(arg) == Dtype.FLOAT else 0
+        return self.values.get(arg)
+
+    def _evaluate(self, instr: Quad) -> LatticeValue:
+        """ Returns the value an instruction assigns, given the values of its operands. """
+        op, _, a, b = instr
+        if op in BINARY_OPS:
+            operands = [self.value(a), self.value(b)]
+        elif op in UNARY_OPS:
+            operands = [self.value(a)]
+        else:
+            return OVERDEFINED
+        if any(v is OVERDEFINED for v in operands):
+            return OVERDEFINED
+        if any(v is None for v in operands):
+            return None
+        try:
+            result = BINARY_OPS[op](*operands) if op in BINARY_OPS else UNARY_OPS[op](*operands)  # type: ignore
+        except QuadRuntimeError:
+            return OVERDEFINED
+        # Only values which may be written as literals.
+        return result if isinstance(result, int) or math.isfinite(result) else OVERDEFINED  # type: ignore
+
+    def _taken(self, block: BasicBlock) -> List[int]:
+        """ Returns the successors of a block control may pass to, given the values known so far. """
+        last = block.instructions[-1] if block.instructions else None
+        if last is None or last[0] not in CONDITIONAL_BRANCHES:
+            return block.successors()
+        if last[0] == QuadInstruction.JMPZ:
+            condition = self.value(last[2])
+        else:
+            condition = self._evaluate((COMPARE_BRANCHES[last[0]], None, last[2], last[3]))
+        if condition is None:
+            return []
+        if condition is OVERDEFINED:
+            return block.successors()
+        return [target(last)] if condition == 0 else [block.fallthrough]  # type: ignore
+
+    def _set(self, name: str, value: LatticeValue, pending: List[str]) -> None:
+        old = self.values.get(name)
+        if old is not None and value is not OVERDEFINED and not _same(old, value):  # type: ignore
+            value = OVERDEFINED
+        if value is not None and (old is None or (value is OVERDEFINED) != (old is OVERDEFINED)):
+            self.values[name] = value
+            pending.append(name)
+
+    def _visit_phi(self, block_id: int, phi: Phi, pending: List[str]) -> None:
+        value: LatticeValue = None
+        for p, source in phi.sources.items():
+            if (p, block_id) in self.executable:
+                value = _meet(value, self.value(source))
+        self._set(phi.dest, value, pending)
+
+    def _visit(self, block: BasicBlock, i: int, pending: List[str], edges: List[Edge]) -> None:
+        instr = block.instructions[i]
+        dest = defs(instr)
+        if dest is not None:
+            self._set(dest, self._evaluate(instr), pending)
+        if i == len(block.instructions) - 1:
+            edges.extend((block.id, s) for s in self._taken(block))
+
+    def solve(self) -> 'ConstantPropagation':
+        """ Finds the values of the versions and the executable edges. Returns self. """
+        # A virtual edge into the entry block starts the propagation.
+        edges: List[Edge] = [(EXIT, self.ssa.graph.blocks[0].id)]
+        pending: List[str] = []
+        while edges or pending:
+            if edges:
+                edge = edges.pop()
+                _, block_id = edge
+                if edge in self.executable:
+                    continue
+                self.executable.add(edge)
+                if block_id == EXIT:
+                    continue
+                block = self.blocks[block_id]
+                for phi in self.ssa.phis[block_id]:
+                    self._visit_phi(block_id, phi, pending)
+                if block_id not in self.visited:
+                    self.visited.add(block_id)
+                    for i in range(len(block.instructions)):
+                        self._visit(block, i, pending, edges)
+                    if not block.instructions:
+                        edges.extend((block_id, s) for s in block.successors())
+            else:
+                for block_id, site in self._uses.get(pending.pop(), []):
+                    if block_id not in self.visited:
+                        continue
+                    if isinstance(site, Phi):
+                        self._visit_phi(block_id, site, pending)
+                    else:
+                        self._visit(self.blocks[block_id], site, pending, edges)
+        return self
+
+    def rewrite(self) -> SSAForm:
+        """ Rewrites the graph by the solution: propagates the constants, and removes the code never executed. """
+        graph = self.ssa.graph
+        constants = {name: value for name, value in self.values.items() if value is not OVERDEFINED}
+        self.removed_blocks = len(graph.blocks) - len(self.visited)
+        graph.blocks = [b for b in graph.blocks if b.id in self.visited]
+        for block in graph:
+            self.ssa.phis[block.id] = [phi for phi in self.ssa.phis[block.id] if phi.dest not in constants]
+            for phi in self.ssa.phis[block.id]:
+                phi.sources = {p: constants.get(source, source) if isinstance(source, str) else source  # type: ignore
+                               for p, source in phi.sources.items() if (p, block.id) in self.executable}
+            kept: List[Quad] = []
+            lines: List[Optional[int]] = []
+            for instr, line in zip(block.instructions, block.lines):
+                if defs(instr) in constants:
+                    continue
+                replacements = {name: constants[name] for name in uses(instr) if name in constants}
+                self.propagated += len(replacements)
+                kept.append(rename_sources(instr, replacements))  # type: ignore
+                lines.append(line)
+            block.instructions, block.lines = kept, lines
+            self._fold_branch(block)
+        self.ssa.phis = {block_id: phis for block_id, phis in self.ssa.phis.items() if block_id in self.visited}
+        return self.ssa
+
+    def _fold_branch(self, block: BasicBlock) -> None:
+        """
+        Removes a conditional branch of which a single edge is executable, making the block fall through
+        to that edge. JUMPs become fall-throughs as well (to_code() adds back the ones the layout needs).
+        """
+        last = block.instructions[-1] if block.instructions else None
+        if last is None or last[0] not in BRANCHES or target(last) == block.fallthrough:
+            return
+        jump_target, fallthrough = target(last), block.fallthrough
+        if last[0] == QuadInstruction.JUMP or (block.id, fallthrough) not in self.executable:
+            block.fallthrough = jump_target
+        elif (block.id, jump_target) in self.executable:
+            return
+        block.instructions.pop()
+        block.lines = block.lines[:len(block.instructions)]
+        if last[0] != QuadInstruction.JUMP:
+            self.folded_branches += 1
+
+    def run(self) -> SSAForm:
+        return self.solve().rewrite()
+
+def propagate_constants(code: QuadCode, profile: Optional[QuadProfile] = None) -> QuadCode:
+    """ Runs sparse conditional constant propagation over resolved Quad code. The profile is unused. """
+    propagation = ConstantPropagation(SSAForm(ControlFlowGraph.from_code(code)))
+    graph = propagation.run().to_graph()
+    if propagation.propagated or propagation.folded_branches:
+        logger.info(f"Propagated {propagation.propagated} constant(s), folded {propagation.folded_branches} " +
+                    f"branch(es), removed {propagation.removed_blocks} unreachable block(s)")
+    return graph.to_code()
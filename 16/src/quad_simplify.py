@@ -0,0 +1,290 @@
+"""
+This module implements the algebraic simplification pass over resolved Quad code.
+The pass is driven by a table of rules (see RULES), each rewriting a single instruction of the
+opcodes it applies to - so rules are chosen per data type: identities holding for integers only
+(x + 0, x * 0, x - x) are not applied to floats, where they don't hold for -0.0, NaN or infinity,
+and float operations are never reassociated. The rules are:
+    fold            OP d a b with constant operands       -->  ASN d result (finite results only)
+    mul-one         MLT d x 1                             -->  ASN d x
+    div-one         DIV d x 1                             -->  ASN d x
+    sub-zero        SUB d x 0                             -->  ASN d x
+    add-zero        IADD d x 0                            -->  IASN d x
+    mul-zero        IMLT d x 0                            -->  IASN d 0
+    sub-self        ISUB d x x                            -->  IASN d 0
+    mul-two         MLT d x 2                             -->  ADD d x x (strength reduction)
+    bool-test       IGRT d b 0 (b boolean)                -->  IASN d b
+    not-compare     EQL t x y; IEQL d t 0                 -->  NQL d x y (and NQL into EQL)
+    logic-const     IADD t b k; IGRT d t 1 (&& / ||)      -->  IASN d b, or IASN d 0/1
+The value of an operand is known when it's a literal, or a variable whose only reaching definition
+assigns a literal to it. Booleans are the results of comparisons (and of && / ||).
+Rewritten instructions keep their destination, so the pass never removes code: the assignments
+left behind are for copy propagation and dead store elimination to clean up.
+"""
+import logging
+import math
+from dataclasses import dataclass
+from typing import Callable, Dict, FrozenSet, Iterable, List, Optional, Set
+
+from consts import Dtype, QuadInstruction, QuadInstructionType, QuadSuperInstruction
+from quad_cfg import ControlFlowGraph, Opcode, Quad, defs
+from quad_code import ArgumentType, QuadCode
+from quad_dataflow import COPIES, INITIAL, Position, ReachingDefinitions
+from quad_exec import BINARY_OPS, QuadRuntimeError
+from quad_profile import QuadProfile
+
+logger = logging.getLogger("Simplification")
+
+Number = ArgumentType
+
+def _ops(op_type: QuadInstructionType, *dtypes: Dtype) -> FrozenSet[Opcode]:
+    """ Returns the instructions performing an operation type, on the given data types. """
+    return frozenset(op_type.get_bytype(dtype) for dtype in dtypes)
+
+_BOTH = (Dtype.INT, Dtype.FLOAT)
+
+_DTYPES: Dict[Opcode, Dtype] = {
+    op_type.get_bytype(dtype): dtype
+    for op_type in (QuadInstructionType.ADD, QuadInstructionType.SUB, QuadInstructionType.MLT, QuadInstructionType.DIV)
+    for dtype in _BOTH
+}
+""" The data type of the result of each arithmetic instruction (comparisons always result in an integer). """
+
+COMPARISONS = frozenset().union(*(_ops(op_type, *_BOTH) for op_type in (
+    QuadInstructionType.EQL, QuadInstructionType.NQL, QuadInstructionType.LSS, QuadInstructionType.GRT)))
+
+BOOLEANS = COMPARISONS | {QuadSuperInstruction.IAND, QuadSuperInstruction.IOR,
+                          QuadSuperInstruction.RAND, QuadSuperInstruction.ROR}
+""" The instructions whose result is always 0 or 1. """
+
+_NEGATIONS = {
+    QuadInstruction.IEQL: QuadInstruction.INQL, QuadInstruction.INQL: QuadInstruction.IEQL,
+    QuadInstruction.REQL: QuadInstruction.RNQL, QuadInstruction.RNQL: QuadInstruction.REQL,
+}
+""" The comparisons whose negation is a single comparison (which holds for NaN as well). """
+
+_LOGICAL_THRESHOLDS = {QuadSuperInstruction.IAND: 1, QuadSuperInstruction.IOR: 0}
+
+def _assign(dtype: Dtype, dest: ArgumentType, value: ArgumentType) -> Quad:
+    return (QuadInstructionType.ASN.get_bytype(dtype), dest, value, None)
+
+class _Site:
+    """ What is known about the operands of the instruction at a position. """
+    def __init__(self, simplifier: 'Simplification', position: Position) -> None:
+        self.simplifier = simplifier
+        self.position = position
+
+    def value(self, arg: Optional[ArgumentType]) -> Optional[Number]:
+        """ Returns the value of an operand, if it's known to be constant. """
+        return self.simplifier.value_at(self.position, arg, set())
+
+    def is_boolean(self, arg: Optional[ArgumentType]) -> bool:
+        """ Returns whether an operand is known to be 0 or 1. """
+        return self.simplifier.boolean_at(self.position, arg, set())
+
+    def definition(self, name: Optional[ArgumentType]) -> Optional[Quad]:
+        """
+        Returns the instruction computing a variable, if it's the variable's only reaching definition,
+        earlier in the same block, and none of its operands was reassigned since.
+        """
+        position = self.simplifier.definition_position(self.position, name)
+        if position is None:
+            return None
+        block_id, index = self.position
+        def_block, def_index = position
+        if def_block != block_id:
+            return None
+        instructions = self.simplifier.blocks[block_id].instructions
+        definition = instructions[def_index]
+        operands = {arg for arg in definition[2:] if isinstance(arg, str)}
+        if any(defs(instr) in operands for instr in instructions[def_index:index]):
+            return None
+        return definition
+
+Rewrite = Callable[[_Site, Quad], Optional[Quad]]
+
+@dataclass(frozen=True)
+class Rule:
+    """ A simplification rule, rewriting instructions of the given opcodes (returns None if it doesn't apply). """
+    name: str
+    ops: FrozenSet[Opcode]
+    rewrite: Rewrite
+
+def _fold(site: _Site, instr: Quad) -> Optional[Quad]:
+    op, dest, a, b = instr
+    x, y = site.value(a), site.value(b)
+    if x is None or y is None:
+        return None
+    try:
+        result = BINARY_OPS[op](x, y)
+    except QuadRuntimeError:
+        # Leave the error to be raised at runtime.
+        return None
+    if isinstance(result, float) and not math.isfinite(result):
+        return None
+    return _assign(_DTYPES.get(op, Dtype.INT), dest, result)
+
+def _right_identity(identity: Number, commutative: bool) -> Rewrite:
+    """ A rule replacing an operation with an identity operand by a copy of the other operand. """
+    def rewrite(site: _Site, instr: Quad) -> Optional[Quad]:
+        op, dest, a, b = instr
+        value = site.value(b)
+        # The identity must be exact: x - (-0.0) is not x, for x = -0.0.
+        if value == identity and math.copysign(1, value) == math.copysign(1, identity):  # type: ignore
+            return _assign(_DTYPES[op], dest, a)  # type: ignore
+        value = site.value(a)
+        if commutative and value == identity and math.copysign(1, value) == math.copysign(1, identity):  # type: ignore
+            return _assign(_DTYPES[op], dest, b)  # type: ignore
+        return None
+    return rewrite
+
+def _mul_zero(site: _Site, instr: Quad) -> Optional[Quad]:
+    op, dest, a, b = instr
+    if site.value(a) == 0 or site.value(b) == 0:
+        return _assign(Dtype.INT, dest, 0)
+    return None
+
+def _sub_self(site: _Site, instr: Quad) -> Optional[Quad]:
+    op, dest, a, b = instr
+    return _assign(Dtype.INT, dest, 0) if isinstance(a, str) and a == b else None
+
+def _mul_two(site: _Site, instr: Quad) -> Optional[Quad]:
+    op, dest, a, b = instr
+    add = QuadInstructionType.ADD.get_bytype(_DTYPES[op])
+    if site.value(b) == 2:
+        return (add, dest, a, a)
+    if site.value(a) == 2:
+        return (add, dest, b, b)
+    return None
+
+def _bool_test(site: _Site, instr: Quad) -> Optional[Quad]:
+    """ b > 0, b != 0 and b == 1 are b itself, for a boolean b (and so are 0 < b, 0 != b and 1 == b). """
+    op, dest, a, b = instr
+    tests = {QuadInstruction.IGRT: (None, 0), QuadInstruction.ILSS: (0, None),
+             QuadInstruction.INQL: (0, 0), QuadInstruction.IEQL: (1, 1)}
+    left, right = tests[op]  # type: ignore
+    if right is not None and site.value(b) == right and site.is_boolean(a):
+        return _assign(Dtype.INT, dest, a)
+    if left is not None and site.value(a) == left and site.is_boolean(b):
+        return _assign(Dtype.INT, dest, b)
+    return None
+
+def _not_compare(site: _Site, instr: Quad) -> Optional[Quad]:
+    """ !(x == y) is x != y, and !(x != y) is x == y. """
+    op, dest, a, b = instr
+    tested = a if site.value(b) == 0 else b if site.value(a) == 0 else None
+    definition = site.definition(tested)
+    if definition is None or definition[0] not in _NEGATIONS:
+        return None
+    return (_NEGATIONS[definition[0]], dest, definition[2], definition[3])  # type: ignore
+
+def _logic_const(site: _Site, instr: Quad) -> Optional[Quad]:
+    """
+    b + k > t (the lowering of && and || when t is 1 and 0) depends on the boolean b alone,
+    when k is constant: it's either constant as well, or b itself.
+    """
+    op, dest, a, b = instr
+    if op in _LOGICAL_THRESHOLDS:
+        threshold: Optional[Number] = _LOGICAL_THRESHOLDS[op]  # type: ignore
+        operands, operand_site = (a, b), site
+    else:
+        threshold = site.value(b)
+        definition = site.definition(a)
+        if threshold is None or definition is None or definition[0] != QuadInstruction.IADD:
+            return None
+        operands = (definition[2], definition[3])
+        operand_site = _Site(site.simplifier, site.simplifier.definition_position(site.position, a))  # type: ignore
+    for boolean, other in (operands, operands[::-1]):
+        constant = operand_site.value(other)
+        if constant is None or not operand_site.is_boolean(boolean):
+            continue
+        when_false, when_true = int(constant > threshold), int(1 + constant > threshold)  # type: ignore
+        if when_false == when_true:
+            return _assign(Dtype.INT, dest, when_false)
+        return _assign(Dtype.INT, dest, boolean)
+    return None
+
+RULES = [
+    Rule('fold', frozenset(BINARY_OPS), _fold),
+    Rule('mul-one', _ops(QuadInstructionType.MLT, *_BOTH), _right_identity(1, commutative=True)),
+    Rule('div-one', _ops(QuadInstructionType.DIV, *_BOTH), _right_identity(1, commutative=False)),
+    Rule('sub-zero', _ops(QuadInstructionType.SUB, *_BOTH), _right_identity(0, commutative=False)),
+    Rule('add-zero', _ops(QuadInstructionType.ADD, Dtype.INT), _right_identity(0, commutative=True)),
+    Rule('mul-zero', _ops(QuadInstructionType.MLT, Dtype.INT), _mul_zero),
+    Rule('sub-self', _ops(QuadInstructionType.SUB, Dtype.INT), _sub_self),
+    Rule('mul-two', _ops(QuadInstructionType.MLT, *_BOTH), _mul_two),
+    Rule('bool-test', frozenset({QuadInstruction.IGRT, QuadInstruction.ILSS,
+                                 QuadInstruction.INQL, QuadInstruction.IEQL}), _bool_test),
+    Rule('not-compare', _ops(QuadInstructionType.EQL, Dtype.INT), _not_compare),
+    Rule('logic-const', frozenset({QuadInstruction.IGRT, *_LOGICAL_THRESHOLDS}), _logic_const),
+]
+""" The simplification rules, tried in order on each instruction. """
+
+class Simplification:
+    """ Performs the algebraic simplification pass over a single CFG. """
+    def __init__(self, graph: ControlFlowGraph, rules: Iterable[Rule] = RULES) -> None:
+        self.graph = graph
+        self.blocks = graph.block_map()
+        self.rules: Dict[Opcode, List[Rule]] = {}
+        for rule in rules:
+            for op in rule.ops:
+                self.rules.setdefault(op, []).append(rule)
+        self.hits: Dict[str, int] = {}
+        """ The number of instructions rewritten by each rule. """
+        # Rewritten instructions keep assigning the same variable, so the definitions never move.
+        _, self._defs_of = ReachingDefinitions(graph).solve().def_use_chains()
+
+    def definition_position(self, position: Position, name: Optional[ArgumentType]) -> Optional[Position]:
+        """ Returns the position of the only definition of a variable reaching its use at a position, if any. """
+        if not isinstance(name, str):
+            return None
+        reaching = self._defs_of.get((position, name), set())
+        if len(reaching) != 1:
+            return None
+        definition, = reaching
+        return None if definition[0] == INITIAL else definition
+
+    def value_at(self, position: Position, arg: Optional[ArgumentType], seen: Set[Position]) -> Optional[Number]:
+        if arg is None or not isinstance(arg, str):
+            return arg
+        definition = self.definition_position(position, arg)
+        if definition is None or definition in seen:
+            return None
+        seen.add(definition)
+        instr = self.blocks[definition[0]].instructions[definition[1]]
+        return self.value_at(definition, instr[2], seen) if instr[0] in COPIES else None
+
+    def boolean_at(self, position: Position, arg: Optional[ArgumentType], seen: Set[Position]) -> bool:
+        if not isinstance(arg, str):
+            return arg in (0, 1)
+        definition = self.definition_position(position, arg)
+        if definition is None or definition in seen:
+            return False
+        seen.add(definition)
+        instr = self.blocks[definition[0]].instructions[definition[1]]
+        if instr[0] in COPIES:
+            return self.boolean_at(definition, instr[2], seen)
+        return instr[0] in BOOLEANS
+
+    def run(self) -> ControlFlowGraph:
+        changed = True
+        while changed:
+            changed = False
+            for block in self.graph:
+                for i, instr in enumerate(block.instructions):
+                    site = _Site(self, (block.id, i))
+                    for rule in self.rules.get(instr[0], []):
+                        rewritten = rule.rewrite(site, instr)
+                        if rewritten is not None and rewritten != instr:
+                            block.instructions[i] = rewritten
+                            self.hits[rule.name] = self.hits.get(rule.name, 0) + 1
+                            changed = True
+                            break
+        return self.graph
+
+def simplify(code: QuadCode, profile: Optional[QuadProfile] = None) -> QuadCode:
+    """ Runs the algebraic simplification pass over resolved Quad code. The profile is unused. """
+    simplification = Simplification(ControlFlowGraph.from_code(code))
+    graph = simplification.run()
+    if simplification.hits:
+        logger.info("Rule hits: " + ", ".join(f"{name} {count}" for name, count in simplification.hits.items()))
+    return graph.to_code()
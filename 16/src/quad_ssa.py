@@ -0,0 +1,332 @@
+"""
+This module implements the Static Single Assignment (SSA) form of a CFG of resolved Quad code.
+In SSA form every variable is assigned exactly once: each assignment defines a new version of
+the variable (named variable.N), and where versions flowing from different predecessors meet, a
+phi function picks the version of the edge control came from. The uses of a version are found
+right away (no dataflow is needed), so passes over the SSA form are sparse (see quad_sccp).
+    Construction (Cytron et al.): phis are placed at the iterated dominance frontiers of the
+    blocks assigning each variable (where the variable is live), and the versions are then named
+    by a walk over the dominator tree. The initial (zero) value of a variable keeps its name.
+    Destruction: versions of a variable are named back after it, unless they are live at the same
+    time (then they are given new temps), and each phi becomes copies on its incoming edges -
+    on a new block, for an edge leaving a conditional branch.
+"""
+from __future__ import annotations
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set, Tuple
+
+from consts import QuadInstructionType
+from quad_cfg import CONDITIONAL_BRANCHES, EXIT, BasicBlock, ControlFlowGraph, Quad, defs, layout, \
+    rename_sources, retarget, target, uses
+from quad_code import ArgumentType
+from quad_dataflow import Liveness
+
+Edge = Tuple[int, int]
+
+def reverse_postorder(graph: ControlFlowGraph) -> List[int]:
+    """ Returns the ids of the blocks reachable from the entry block, in reverse postorder. """
+    blocks = graph.block_map()
+    order: List[int] = []
+    visited = {graph.blocks[0].id}
+    stack = [(graph.blocks[0].id, iter(graph.blocks[0].successors()))]
+    while stack:
+        block_id, successors = stack[-1]
+        for s in successors:
+            if s != EXIT and s not in visited:
+                visited.add(s)
+                stack.append((s, iter(blocks[s].successors())))
+                break
+        else:
+            stack.pop()
+            order.append(block_id)
+    return order[::-1]
+
+def dominators(graph: ControlFlowGraph) -> Dict[int, int]:
+    """
+    Returns the immediate dominator of each block reachable from the entry block (the entry block is
+    its own), using the iterative algorithm of Cooper, Harvey and Kennedy.
+    """
+    order = reverse_postorder(graph)
+    position = {block_id: i for i, block_id in enumerate(order)}
+    predecessors = graph.predecessors()
+    entry = order[0]
+    idom = {entry: entry}
+
+    def intersect(a: int, b: int) -> int:
+        while a != b:
+            while position[a] > position[b]:
+                a = idom[a]
+            while position[b] > position[a]:
+                b = idom[b]
+        return a
+
+    changed = True
+    while changed:
+        changed = False
+        for block_id in order[1:]:
+            processed = [p for p in predecessors[block_id] if p in idom]
+            new_idom = processed[0]
+            for p in processed[1:]:
+                new_idom = intersect(p, new_idom)
+            if idom.get(block_id) != new_idom:
+                idom[block_id] = new_idom
+                changed = True
+    return idom
+
+def dominance_frontiers(graph: ControlFlowGraph, idom: Dict[int, int]) -> Dict[int, Set[int]]:
+    """ Returns the dominance frontier of each block: the blocks it doesn't strictly dominate, but one of their predecessors. """
+    frontiers: Dict[int, Set[int]] = {block_id: set() for block_id in idom}
+    for block_id, predecessors in graph.predecessors().items():
+        predecessors = [p for p in predecessors if p in idom]
+        if block_id not in idom or len(predecessors) < 2:
+            continue
+        for p in predecessors:
+            runner = p
+            while runner != idom[block_id]:
+                frontiers[runner].add(block_id)
+                runner = idom[runner]
+    return frontiers
+
+@dataclass
+class Phi:
+    """ A phi function at the start of a block, choosing a value by the predecessor control came from. """
+    variable: str
+    dest: str
+    """ The version the phi defines. """
+    sources: Dict[int, ArgumentType] = field(default_factory=dict)
+    """ The value flowing in from each predecessor (by block id). """
+
+def _rename_dest(instr: Quad, name: str) -> Quad:
+    slot = layout(instr[0]).dest
+    assert slot is not None, f"{instr[0].name} assigns no variable!"
+    updated = list(instr)
+    updated[slot] = name
+    return tuple(updated)  # type: ignore
+
+class SSAForm:
+    """
+    The SSA form of a CFG, built in place: the instructions of the blocks read and assign versions,
+    and the phis of each block are kept aside. Unreachable blocks are removed, and if the entry block
+    is a jump target, an empty entry block is added before it.
+    """
+    def __init__(self, graph: ControlFlowGraph) -> None:
+        self.graph = graph
+        reachable = set(graph.reachable())
+        graph.blocks = [b for b in graph.blocks if b.id in reachable]
+        if any(graph.blocks[0].id in b.successors() for b in graph.blocks):
+            graph.blocks.insert(0, graph.new_block(fallthrough=graph.blocks[0].id))
+        self.idom = dominators(graph)
+        self.phis: Dict[int, List[Phi]] = {b.id: [] for b in graph.blocks}
+        self.variables: Dict[str, str] = {}
+        """ The variable of each version. """
+        self._versions: Dict[str, int] = {}
+        self._place_phis()
+        self._rename()
+
+    def variable(self, name: str) -> str:
+        """ Returns the variable a version (or the initial value of a variable) belongs to. """
+        return self.variables.get(name, name)
+
+    def _place_phis(self) -> None:
+        frontiers = dominance_frontiers(self.graph, self.idom)
+        live_in = Liveness(self.graph).solve().block_in
+        assigned: Dict[str, Set[int]] = {}
+        for block in self.graph:
+            for instr in block.instructions:
+                dest = defs(instr)
+                if dest is not None:
+                    assigned.setdefault(dest, set()).add(block.id)
+        for name, blocks in assigned.items():
+            pending = list(blocks)
+            placed: Set[int] = set()
+            while pending:
+                for block_id in frontiers[pending.pop()]:
+                    # Only where the variable is live, so no dead phis are placed.
+                    if block_id not in placed and name in live_in[block_id]:
+                        placed.add(block_id)
+                        self.phis[block_id].append(Phi(name, name))
+                        if block_id not in blocks:
+                            pending.append(block_id)
+
+    def _new_version(self, name: str) -> str:
+        self._versions[name] = self._versions.get(name, 0) + 1
+        version = f"{name}.{self._versions[name]}"
+        self.variables[version] = name
+        return version
+
+    def _rename(self) -> None:
+        blocks = self.graph.block_map()
+        children: Dict[int, List[int]] = {block_id: [] for block_id in self.idom}
+        for block in self.graph:
+            if self.idom[block.id] != block.id:
+                children[self.idom[block.id]].append(block.id)
+
+        # The current version of each variable (its initial value, if not yet assigned) along the dominator tree.
+        current: Dict[str, List[str]] = {}
+
+        def top(name: str) -> str:
+            stack = current.get(name)
+            return stack[-1] if stack else name
+
+        # Walk the dominator tree iteratively; an exit marker pops the versions pushed by a block.
+        work: List[Tuple[int, Optional[List[str]]]] = [(self.graph.blocks[0].id, None)]
+        while work:
+            block_id, pushed = work.pop()
+            if pushed is not None:
+                for name in pushed:
+                    current[name].pop()
+                continue
+            block = blocks[block_id]
+            pushed = []
+            for phi in self.phis[block_id]:
+                phi.dest = self._new_version(phi.variable)
+                current.setdefault(phi.variable, []).append(phi.dest)
+                pushed.append(phi.variable)
+            for i, instr in enumerate(block.instructions):
+                instr = rename_sources(instr, {name: top(name) for name in uses(instr)})
+                dest = defs(instr)
+                if dest is not None:
+                    version = self._new_version(dest)
+                    instr = _rename_dest(instr, version)
+                    current.setdefault(dest, []).append(version)
+                    pushed.append(dest)
+                block.instructions[i] = instr
+            for s in block.successors():
+                if s != EXIT:
+                    for phi in self.phis[s]:
+                        phi.sources[block_id] = top(phi.variable)
+            work.append((block_id, pushed))
+            work.extend((child, None) for child in reversed(children[block_id]))
+
+    def _liveness(self) -> Tuple[Dict[int, Set[str]], Dict[int, Set[str]]]:
+        """
+        Returns the versions live at the end of each block, and the versions live-in, right after the
+        phis of each block (the phis read their sources at the end of the predecessors).
+        """
+        live_out: Dict[int, Set[str]] = {b.id: set() for b in self.graph}
+        live_in: Dict[int, Set[str]] = {b.id: set() for b in self.graph}
+        changed = True
+        while changed:
+            changed = False
+            for block in reversed(self.graph.blocks):
+                out: Set[str] = set()
+                for s in block.successors():
+                    if s != EXIT:
+                        out |= live_in[s] - {phi.dest for phi in self.phis[s]}
+                        out |= {phi.sources[block.id] for phi in self.phis[s]
+                                if isinstance(phi.sources.get(block.id), str)}  # type: ignore
+                live = set(out)
+                for instr in reversed(block.instructions):
+                    live.discard(defs(instr))  # type: ignore
+                    live.update(uses(instr))
+                if out != live_out[block.id] or live != live_in[block.id]:
+                    live_out[block.id], live_in[block.id] = out, live
+                    changed = True
+        return live_out, live_in
+
+    def _interference(self) -> Set[Tuple[str, str]]:
+        """ Returns the pairs of versions of the same variable that are live at the same time (both orders). """
+        live_out, live_in = self._liveness()
+        pairs: Set[Tuple[str, str]] = set()
+
+        def assign(dest: str, live: Set[str]) -> None:
+            for other in live:
+                if other != dest and self.variable(other) == self.variable(dest):
+                    pairs.update(((dest, other), (other, dest)))
+
+        for block in self.graph:
+            live = set(live_out[block.id])
+            for instr in reversed(block.instructions):
+                dest = defs(instr)
+                if dest is not None:
+                    assign(dest, live)
+                    live.discard(dest)
+                live.update(uses(instr))
+            for phi in self.phis[block.id]:
+                assign(phi.dest, live_in[block.id])
+        return pairs
+
+    def _names(self) -> Dict[str, str]:
+        """ Returns the name of each version out of SSA form: its variable's, or a new temp's where they interfere. """
+        interference = self._interference()
+        names: Dict[str, str] = {}
+        taken: Dict[str, List[str]] = {}
+        """ The versions named after each variable. """
+        versions = sorted(self.variables, key=lambda v: int(v.rsplit('.', 1)[1]))
+        for version in versions:
+            variable = self.variables[version]
+            named = taken.setdefault(variable, [variable])
+            if any((version, other) in interference for other in named):
+                names[version] = self.graph.code.newtemp(self.graph.code.symbols[variable])
+            else:
+                names[version] = variable
+                named.append(version)
+        return names
+
+    def _copies(self, copies: List[Tuple[str, ArgumentType]]) -> List[Quad]:
+        """ Returns copies performing the given ones in parallel (each reads the values before any is made). """
+        symbols = self.graph.code.symbols
+        pending = [(dest, source) for dest, source in copies if dest != source]
+        result: List[Quad] = []
+        while pending:
+            read = {source for _, source in pending}
+            ready = next((c for c in pending if c[0] not in read), None)
+            if ready is None:
+                # A cycle (e.g. a swap): save one of the destinations first.
+                dest = pending[0][0]
+                saved = self.graph.code.newtemp(symbols[dest])
+                result.append((QuadInstructionType.ASN.get_bytype(symbols[dest]), saved, dest, None))
+                pending = [(d, saved if s == dest else s) for d, s in pending]
+                continue
+            pending.remove(ready)
+            dest, source = ready
+            result.append((QuadInstructionType.ASN.get_bytype(symbols[dest]), dest, source, None))
+        return result
+
+    def to_graph(self) -> ControlFlowGraph:
+        """ Translates the graph out of SSA form (in place), and returns it. """
+        names = self._names()
+
+        def name(arg: ArgumentType) -> ArgumentType:
+            return names.get(arg, arg) if isinstance(arg, str) else arg
+
+        for block in self.graph:
+            for i, instr in enumerate(block.instructions):
+                instr = rename_sources(instr, names)  # type: ignore
+                dest = defs(instr)
+                block.instructions[i] = _rename_dest(instr, names[dest]) if dest is not None else instr
+
+        blocks = self.graph.block_map()
+        split: List[BasicBlock] = []
+        for block_id, phis in self.phis.items():
+            if block_id not in blocks:
+                continue
+            for p in sorted({p for phi in phis for p in phi.sources if p in blocks}):
+                copies = self._copies([(names[phi.dest], name(phi.sources[p])) for phi in phis if p in phi.sources])
+                if not copies:
+                    continue
+                predecessor = blocks[p]
+                last = predecessor.instructions[-1] if predecessor.instructions else None
+                if last is not None and last[0] in CONDITIONAL_BRANCHES:
+                    # The copies may only run on this edge.
+                    edge = self.graph.new_block(copies, fallthrough=block_id)
+                    if target(last) == block_id:
+                        predecessor.instructions[-1] = retarget(last, edge.id)
+                    if predecessor.fallthrough == block_id:
+                        predecessor.fallthrough = edge.id
+                    split.append(edge)
+                elif predecessor.fallthrough is None:
+                    # Before the JUMP to the block.
+                    predecessor.instructions[-1:-1] = copies
+                    predecessor.lines[-1:-1] = [None] * len(copies)
+                else:
+                    predecessor.instructions.extend(copies)
+                    predecessor.lines.extend([None] * len(copies))
+
+        # Edge blocks are laid out right after the predecessor they are the fall-through of, if they are.
+        for edge in split:
+            position = next((i + 1 for i, b in enumerate(self.graph.blocks) if b.fallthrough == edge.id),
+                            len(self.graph.blocks))
+            self.graph.blocks.insert(position, edge)
+        self.phis = {}
+        return self.graph
@@ -0,0 +1,383 @@
+"""
+This module implements the loop unrolling pass over resolved Quad code.
+Every while loop is compiled into a header (the condition and a JMPZ past the loop), followed by
+the body, ending with a JUMP back to the header. A counting loop - whose condition compares an int
+variable, stepped by a constant once per iteration, against a loop invariant bound - pays for the
+compare, the JMPZ and the JUMP on every iteration. The pass unrolls such loops by a factor k:
+    guard:  g := i + (k-1)*step; the condition, on g; JMPZ header     (k more iterations run?)
+            body; body; ... (k times, without the header's checks)
+            JUMP guard
+    header: the original loop, running the remaining iterations
+As the condition is monotonic in the variable, it holds for the k next values of the variable if
+it holds for the last of them. Loops whose trip count is a constant (the variable is assigned a
+literal before the loop, and the bound is constant) are fully unrolled instead, if small enough.
+A break inside the body jumps to the loop's exit from any of the copies, so it stays correct.
+Only innermost loops are unrolled, whose header is entered from outside the loop only (as WhileStmt
+emits them) - so the pass should run before loop rotation (see quad_layout).
+"""
+import logging
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set
+
+from consts import Dtype, QuadInstruction
+from quad_cfg import CONDITIONAL_BRANCHES, EXIT, BasicBlock, ControlFlowGraph, defs, rename_sources, \
+    retarget, target, uses
+from quad_code import QuadCode
+from quad_dataflow import INITIAL, ReachingDefinitions
+from quad_exec import BINARY_OPS, COMPARE_BRANCHES, QuadRuntimeError
+from quad_profile import QuadProfile
+
+logger = logging.getLogger("LoopUnrolling")
+
+UNROLL_FACTOR = 4
+""" The default number of copies of the body in a partially unrolled loop. """
+
+MAX_UNROLLED_SIZE = 96
+""" The maximal number of instructions in the copies of a partially unrolled body (the factor is reduced to fit). """
+
+FULL_UNROLL_SIZE = 64
+""" The maximal number of instructions in a fully unrolled loop. """
+
+_IO = {QuadInstruction.IINP, QuadInstruction.RINP, QuadInstruction.IPRT, QuadInstruction.RPRT}
+
+_DIRECTIONS = {
+    (QuadInstruction.ILSS, 2): 1, (QuadInstruction.ILSS, 3): -1,
+    (QuadInstruction.IGRT, 2): -1, (QuadInstruction.IGRT, 3): 1,
+}
+"""
+The direction of a comparison reading the variable in an argument slot: 1 if the comparison holding for
+a value implies it holds for the smaller values (i < n), -1 if it implies it holds for the larger ones (i > n).
+"""
+
+@dataclass
+class _Loop:
+    """ An innermost while loop. """
+    header: BasicBlock
+    """ Computes the condition, and branches past the loop (to exit) if it doesn't hold. """
+    body: List[BasicBlock]
+    """ The other blocks of the loop, in layout order. """
+    latch: BasicBlock
+    """ The block of the body jumping back to the header. """
+    exit: int
+    variable: Optional[str] = None
+    """ The induction variable, compared by the condition. """
+    step: int = 0
+    """ The constant added to the variable on each iteration. """
+
+    @property
+    def size(self) -> int:
+        """ The number of instructions in the body (not counting the JUMP back to the header). """
+        return sum(len(b.instructions) for b in self.body) - 1
+
+    def ids(self) -> Set[int]:
+        return {self.header.id, *(b.id for b in self.body)}
+
+def _condition_holds(header: BasicBlock, variable: str, value: int) -> Optional[bool]:
+    """ Evaluates the condition of a loop for a value of its variable, if all its other operands are constant. """
+    values: Dict[str, object] = {variable: value}
+
+    def resolve(arg):
+        return values.get(arg) if isinstance(arg, str) else arg
+
+    try:
+        for op, dest, a, b in header.instructions[:-1]:
+            if op not in BINARY_OPS or resolve(a) is None or resolve(b) is None:
+                return None
+            values[dest] = BINARY_OPS[op](resolve(a), resolve(b))  # type: ignore
+        op, _, a, b = header.instructions[-1]
+        if op == QuadInstruction.JMPZ:
+            condition = resolve(a)
+        elif resolve(a) is not None and resolve(b) is not None:
+            condition = BINARY_OPS[COMPARE_BRANCHES[op]](resolve(a), resolve(b))  # type: ignore
+        else:
+            return None
+    except QuadRuntimeError:
+        return None
+    return None if condition is None else condition != 0
+
+class LoopUnrolling:
+    """ Performs the loop unrolling pass over a single CFG. """
+    def __init__(self, graph: ControlFlowGraph, factor: int = UNROLL_FACTOR) -> None:
+        if factor < 1:
+            raise ValueError("The unroll factor must be positive!")
+        self.graph = graph
+        self.factor = factor
+        self.unrolled = 0
+        self.fully_unrolled = 0
+        self._done: Set[int] = set()
+        """ The headers of the loops already unrolled, and of the loops they were unrolled into. """
+
+    def _natural_loop(self, header: BasicBlock, predecessors: Dict[int, List[int]]) -> Optional[_Loop]:
+        """ Returns the loop a block is the header of, if it is the header of an innermost while loop. """
+        blocks = self.graph.block_map()
+        last = header.instructions[-1] if header.instructions else None
+        if last is None or last[0] not in CONDITIONAL_BRANCHES:
+            return None
+        exit_id, entry_id = target(last), header.fallthrough
+        if entry_id is None or entry_id in (EXIT, exit_id, header.id):
+            return None
+        latches = [p for p in predecessors[header.id] if blocks[p].instructions
+                   and blocks[p].instructions[-1][0] == QuadInstruction.JUMP and p != header.id]
+        for latch_id in latches:
+            # The body is everything reaching the latch without passing through the header.
+            body_ids = {latch_id}
+            stack = [latch_id]
+            while stack:
+                for p in predecessors[stack.pop()]:
+                    if p != header.id and p not in body_ids:
+                        body_ids.add(p)
+                        stack.append(p)
+            if entry_id not in body_ids or exit_id in body_ids:
+                continue
+            # The header must be the only way into the loop, and the latch the only way back to the header.
+            if any(p != header.id and p not in body_ids for b in body_ids for p in predecessors[b]) \
+                    or any(p in body_ids for p in predecessors[header.id] if p != latch_id):
+                return None
+            if not self._is_acyclic(body_ids):
+                return None
+            body = [b for b in self.graph.blocks if b.id in body_ids]
+            return _Loop(header, body, blocks[latch_id], exit_id)  # type: ignore
+        return None
+
+    def _is_acyclic(self, body_ids: Set[int]) -> bool:
+        """ Returns whether the body of a loop contains no other loop. """
+        blocks = self.graph.block_map()
+        state: Dict[int, bool] = {}
+        """ Whether the DFS is done with each block visited (False while its successors are being visited). """
+
+        def visit(block_id: int) -> bool:
+            state[block_id] = False
+            for s in blocks[block_id].successors():
+                if s in body_ids and (state.get(s) is False or (s not in state and not visit(s))):
+                    return False
+            state[block_id] = True
+            return True
+
+        return all(block_id in state or visit(block_id) for block_id in body_ids)
+
+    def _step(self, loop: _Loop, variable: str) -> Optional[int]:
+        """
+        Returns the step of a variable, if it's an int variable whose only assignment in the loop is
+        adding a nonzero constant to it in the latch (IADD i i c, or IADD t i c; IASN i t).
+        """
+        if self.graph.code.symbols.get(variable) != Dtype.INT:
+            return None
+        assignments = [(b, i) for b in [loop.header, *loop.body] for i, instr in enumerate(b.instructions)
+                       if defs(instr) == variable]
+        if len(assignments) != 1 or assignments[0][0] is not loop.latch:
+            return None
+        _, q = assignments[0]
+        instr = loop.latch.instructions[q]
+        if instr[0] == QuadInstruction.IASN and isinstance(instr[2], str):
+            temp = instr[2]
+            temp_assignments = [i for i, other in enumerate(loop.latch.instructions) if defs(other) == temp]
+            if len(temp_assignments) != 1 or temp_assignments[0] > q or any(
+                    defs(other) == temp for b in [loop.header, *loop.body] if b is not loop.latch
+                    for other in b.instructions):
+                return None
+            instr = loop.latch.instructions[temp_assignments[0]]
+        op, _, a, b = instr
+        if op == QuadInstruction.IADD:
+            step = b if a == variable else a if b == variable else None
+        elif op == QuadInstruction.ISUB and a == variable and type(b) is int:
+            step = -b
+        else:
+            return None
+        return step if type(step) is int and step != 0 else None
+
+    def _direction(self, loop: _Loop, variable: str) -> Optional[int]:
+        """
+        Returns the direction in which the condition of a loop is monotonic in a variable (see _DIRECTIONS),
+        if it is: a comparison of the variable to a loop invariant operand, possibly negated.
+        The header must compute nothing else, but loop invariant values only read by itself.
+        """
+        assigned = {defs(instr) for b in loop.body for instr in b.instructions} | {variable}
+        use_counts = self.graph.use_counts()
+        header_uses: Dict[str, int] = {}
+        for instr in loop.header.instructions:
+            for name in uses(instr):
+                header_uses[name] = header_uses.get(name, 0) + 1
+
+        computed = {defs(instr) for instr in loop.header.instructions}
+        directions: Dict[str, Optional[int]] = {}
+        """ The direction of each value computed by the header (None for loop invariant ones). """
+
+        def direction_of(op, a, b) -> Optional[int]:
+            if op in COMPARE_BRANCHES:
+                op = COMPARE_BRANCHES[op]
+            if (a == variable) == (b == variable):
+                return None
+            return _DIRECTIONS.get((op, 2 if a == variable else 3))
+
+        def invariant(arg) -> bool:
+            if not isinstance(arg, str):
+                return True
+            return directions[arg] is None if arg in directions else arg not in assigned | computed
+
+        for instr in loop.header.instructions[:-1]:
+            op, dest, a, b = instr
+            if op in _IO or dest in directions or dest in assigned or \
+                    use_counts.get(dest, 0) != header_uses.get(dest, 0):  # type: ignore
+                return None
+            if invariant(a) and invariant(b):
+                directions[dest] = None  # type: ignore
+            elif op == QuadInstruction.IEQL and b == 0 and directions.get(a) is not None:
+                directions[dest] = -directions[a]  # type: ignore
+            elif direction_of(op, a, b) is not None and invariant(b if a == variable else a):
+                directions[dest] = direction_of(op, a, b)  # type: ignore
+            else:
+                return None
+
+        op, _, a, b = loop.header.instructions[-1]
+        if op == QuadInstruction.JMPZ:
+            return directions.get(a)  # type: ignore
+        if direction_of(op, a, b) is not None and invariant(b if a == variable else a):
+            return direction_of(op, a, b)
+        return None
+
+    def _find_counting_loop(self) -> Optional[_Loop]:
+        """ Returns the first loop (in layout order) not yet unrolled which may be unrolled, if any. """
+        reachable = set(self.graph.reachable())
+        predecessors = {block_id: [p for p in preds if p in reachable]
+                        for block_id, preds in self.graph.predecessors().items()}
+        for header in self.graph.blocks:
+            if header.id not in reachable or header.id in self._done:
+                continue
+            loop = self._natural_loop(header, predecessors)
+            if loop is None:
+                continue
+            for variable in dict.fromkeys(name for instr in header.instructions for name in uses(instr)):
+                step = self._step(loop, variable)
+                direction = self._direction(loop, variable) if step is not None else None
+                if step is not None and direction is not None and (step > 0) == (direction > 0):
+                    loop.variable, loop.step = variable, step
+                    return loop
+        return None
+
+    def _initial_value(self, loop: _Loop) -> Optional[int]:
+        """ Returns the value of the variable of a loop when entering it, if it's a constant. """
+        reaching = ReachingDefinitions(self.graph).solve()
+        entering = next(value for i, _, value in reaching.states(loop.header) if i == 0)
+        outside = [p for p in entering & reaching.definitions[loop.variable]  # type: ignore
+                   if p[0] not in loop.ids()]
+        if len(outside) != 1:
+            return None
+        (block_id, i), = outside
+        if block_id == INITIAL:
+            return 0
+        instr = self.graph.block_map()[block_id].instructions[i]
+        return instr[2] if instr[0] == QuadInstruction.IASN and type(instr[2]) is int else None  # type: ignore
+
+    def _trip_count(self, loop: _Loop) -> Optional[int]:
+        """ Returns the number of iterations of a loop, if it's constant and the fully unrolled loop is small enough. """
+        value = self._initial_value(loop)
+        if value is None:
+            return None
+        for trips in range(FULL_UNROLL_SIZE // max(loop.size, 1) + 1):
+            holds = _condition_holds(loop.header, loop.variable, value)  # type: ignore
+            if holds is None:
+                return None
+            if not holds:
+                return trips
+            value += loop.step
+        return None
+
+    def _copy_body(self, loop: _Loop, continuation: int) -> List[BasicBlock]:
+        """
+        Returns a copy of the body of a loop, continuing to the given block (instead of the header)
+        after an iteration. The first block of the copy is its entry.
+        """
+        copies = {b.id: self.graph.new_block() for b in loop.body}
+        mapping = {**{block_id: copy.id for block_id, copy in copies.items()}, loop.header.id: continuation}
+        # Blocks leaving the loop by a single JUMP (a break) are jumped over, to the JUMP's target.
+        for block in self.graph.blocks:
+            if block.id not in mapping and len(block.instructions) == 1 \
+                    and block.instructions[0][0] == QuadInstruction.JUMP:
+                mapping[block.id] = target(block.instructions[0])  # type: ignore
+        for block in loop.body:
+            copy = copies[block.id]
+            instructions = list(block.instructions)
+            lines = list(block.lines)
+            fallthrough = block.fallthrough
+            if block is loop.latch:
+                instructions.pop()
+                lines = lines[:len(instructions)]
+                fallthrough = loop.header.id
+            copy.instructions = [retarget(instr, mapping.get(target(instr), target(instr)))  # type: ignore
+                                 if target(instr) is not None else instr for instr in instructions]
+            copy.lines = lines
+            copy.fallthrough = mapping.get(fallthrough, fallthrough) if fallthrough is not None else None
+        entry = copies[loop.header.fallthrough]  # type: ignore
+        return [entry] + [copies[b.id] for b in loop.body if copies[b.id] is not entry]
+
+    def _replace_header(self, loop: _Loop, replacement: int, new_blocks: List[BasicBlock]) -> None:
+        """ Lays out new blocks before the header of a loop, and redirects the entries into the loop to replacement. """
+        loop_ids = loop.ids()
+        for block in self.graph.blocks:
+            if block.id in loop_ids:
+                continue
+            if block.instructions and target(block.instructions[-1]) == loop.header.id:
+                block.instructions[-1] = retarget(block.instructions[-1], replacement)
+            if block.fallthrough == loop.header.id:
+                block.fallthrough = replacement
+        position = self.graph.blocks.index(loop.header)
+        self.graph.blocks[position:position] = new_blocks
+
+    def unroll(self, loop: _Loop, factor: int) -> None:
+        """ Unrolls a loop by a factor, keeping the original loop for the remaining iterations. """
+        header = loop.header
+        last = header.instructions[-1]
+        ahead = self.graph.code.newtemp(Dtype.INT)
+        guard = self.graph.new_block(
+            [(QuadInstruction.IADD, ahead, loop.variable, (factor - 1) * loop.step)] +
+            [rename_sources(instr, {loop.variable: ahead}) for instr in header.instructions[:-1]] +  # type: ignore
+            [retarget(rename_sources(last, {loop.variable: ahead}), header.id)],  # type: ignore
+            [header.lines[-1]] + list(header.lines))
+        copies: List[List[BasicBlock]] = []
+        continuation = guard.id
+        for _ in range(factor):
+            copies.insert(0, self._copy_body(loop, continuation))
+            continuation = copies[0][0].id
+        guard.fallthrough = continuation
+        self._replace_header(loop, guard.id, [guard] + [b for copy in copies for b in copy])
+        self._done.update((header.id, guard.id))
+        self.unrolled += 1
+
+    def unroll_fully(self, loop: _Loop, trips: int) -> None:
+        """ Replaces a loop by copies of its body, one per iteration. """
+        copies: List[List[BasicBlock]] = []
+        continuation = loop.exit
+        for _ in range(trips):
+            copies.insert(0, self._copy_body(loop, continuation))
+            continuation = copies[0][0].id
+        if not copies:
+            copies.append([self.graph.new_block(fallthrough=loop.exit)])
+            continuation = copies[0][0].id
+        self._replace_header(loop, continuation, [b for copy in copies for b in copy])
+        # The original loop is now unreachable (as is any dead code jumping into it).
+        reachable = set(self.graph.reachable())
+        self.graph.blocks = [b for b in self.graph.blocks if b.id in reachable]
+        self.fully_unrolled += 1
+
+    def run(self) -> ControlFlowGraph:
+        loop = self._find_counting_loop()
+        while loop is not None:
+            trips = self._trip_count(loop)
+            if trips is not None:
+                self.unroll_fully(loop, trips)
+            else:
+                factor = min(self.factor, MAX_UNROLLED_SIZE // max(loop.size, 1))
+                if factor > 1:
+                    self.unroll(loop, factor)
+                else:
+                    self._done.add(loop.header.id)
+            loop = self._find_counting_loop()
+        return self.graph
+
+def unroll_loops(code: QuadCode, profile: Optional[QuadProfile] = None, factor: int = UNROLL_FACTOR) -> QuadCode:
+    """ Runs the loop unrolling pass over resolved Quad code. The profile is unused. """
+    unrolling = LoopUnrolling(ControlFlowGraph.from_code(code), factor)
+    graph = unrolling.run()
+    if unrolling.unrolled or unrolling.fully_unrolled:
+        logger.info(f"Unrolled {unrolling.unrolled} loop(s) by {factor}, fully unrolled {unrolling.fully_unrolled}")
+    return graph.to_code()